@@ -0,0 +1,49 @@
+"""Compare encoding large vector and landmarks payloads with the standard
+library ``json`` module, as the SDK used to, and with the JSON codecs in
+``runway.codec``.
+
+    python benchmarks/json_codec.py
+
+The ``orjson`` codec is only measured if it is installed.
+"""
+
+import os
+import sys
+import json
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+from runway.codec import load_codec
+from runway.data_types import vector, image_landmarks
+
+NUMBER = 20
+
+
+def bench(label, fn):
+    seconds = min(timeit.repeat(fn, number=NUMBER, repeat=5)) / NUMBER
+    print('%-50s %8.2f ms' % (label, seconds * 1e3))
+
+
+def main():
+    payloads = {
+        'vector (100k floats)': (vector(length=100000), np.random.normal(size=100000)),
+        'landmarks (20k points)': (image_landmarks(20000), np.random.uniform(size=(20000, 2)))
+    }
+    codecs = []
+    for name in ['json', 'orjson']:
+        try:
+            codecs.append(load_codec(name))
+        except ImportError:
+            print('%s is not installed, skipping it' % name)
+
+    for label, (data_type, value) in payloads.items():
+        bench('%s: serialize + json.dumps' % label, lambda: json.dumps({'output': data_type.serialize(value)}))
+        for name, dumps, _ in codecs:
+            bench('%s: serialize + %s' % (label, name), lambda: dumps({'output': data_type.serialize(value)}))
+            bench('%s: %s on numpy array' % (label, name), lambda: dumps({'output': value}))
+        print()
+
+
+if __name__ == '__main__':
+    main()
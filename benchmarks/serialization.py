@@ -0,0 +1,64 @@
+"""Compare the per-request overhead of the generic ``deserialize_data()`` and
+``serialize_data()`` helpers with the plans compiled by ``@runway.command()``.
+
+    python benchmarks/serialization.py
+
+Only the SDK's own bookkeeping is measured: the data types used here do
+little work of their own.
+"""
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from runway.data_types import number, text, boolean, category
+from runway.utils import deserialize_data, serialize_data, compile_deserializer, compile_serializer, cast_to_obj
+
+NUMBER = 100000
+
+
+def make_fields(spec):
+    fields = []
+    for name, field in spec.items():
+        field = cast_to_obj(field)
+        field.name = name
+        fields.append(field)
+    return fields
+
+
+def bench(label, fn):
+    seconds = min(timeit.repeat(fn, number=NUMBER, repeat=5))
+    print('%-40s %.2f us/call' % (label, seconds / NUMBER * 1e6))
+    return seconds
+
+
+def main():
+    inputs = make_fields({
+        'prompt': text,
+        'steps': number(default=10),
+        'style': category(choices=['day', 'night']),
+        'upscale': boolean
+    })
+    single_output = make_fields({'caption': text})
+    outputs = make_fields({'caption': text, 'score': number, 'safe': boolean})
+
+    input_data = {'prompt': 'a cat', 'style': 'night'}
+    output_data = {'caption': 'a cat at night', 'score': 0.9, 'safe': True}
+
+    deserialize = compile_deserializer(inputs)
+    serialize_single = compile_serializer(single_output)
+    serialize = compile_serializer(outputs)
+
+    for label, generic, compiled in [
+        ('deserialize 4 inputs', lambda: deserialize_data(input_data, inputs), lambda: deserialize(input_data)),
+        ('serialize 1 output', lambda: serialize_data('a cat', single_output), lambda: serialize_single('a cat')),
+        ('serialize 3 outputs', lambda: serialize_data(output_data, outputs), lambda: serialize(output_data)),
+    ]:
+        generic_seconds = bench(label + ' (generic)', generic)
+        compiled_seconds = bench(label + ' (compiled)', compiled)
+        print('%-40s %.2fx\n' % ('speedup', generic_seconds / compiled_seconds))
+
+
+if __name__ == '__main__':
+    main()
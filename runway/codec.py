@@ -0,0 +1,66 @@
+"""JSON encoding and decoding of requests, responses and websocket messages.
+
+`orjson <https://github.com/ijl/orjson>`_ is used if it is installed, and the
+standard library ``json`` module otherwise. The ``RW_JSON_CODEC`` environment
+variable can be set to ``orjson`` or ``json`` to choose one explicitly. Both
+codecs encode numpy arrays and scalars, and produce compact UTF-8 bytes.
+"""
+
+import os
+import json
+import numpy as np
+
+
+def encode_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
+def make_stdlib_codec():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=encode_default)
+
+    def dumps(obj):
+        return encoder.encode(obj).encode('utf8')
+
+    return dumps, json.loads
+
+
+def make_orjson_codec():
+    import orjson
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=encode_default, option=option)
+
+    return dumps, orjson.loads
+
+
+CODECS = {
+    'orjson': make_orjson_codec,
+    'json': make_stdlib_codec
+}
+
+
+def load_codec(name=None):
+    """Return the name, ``dumps`` and ``loads`` functions of the JSON codec
+    called ``name``, or of the fastest codec available if ``name`` is None.
+    """
+    if name is not None:
+        return (name,) + CODECS[name]()
+    for name in ['orjson', 'json']:
+        try:
+            return (name,) + CODECS[name]()
+        except ImportError:
+            continue
+
+
+JSON_CODEC, json_dumps, json_loads = load_codec(os.getenv('RW_JSON_CODEC'))
+
+
+def json_response(data, status=200):
+    """Return a Flask response with ``data`` encoded as JSON."""
+    from flask import Response
+    return Response(json_dumps(data), status=status, mimetype='application/json')
@@ -0,0 +1,319 @@
+"""Compression of HTTP responses and decompression of request bodies.
+
+gzip is always available. Brotli (``br``) is supported if version 1.2 or
+later of the `brotli <https://pypi.org/project/Brotli/>`_ package is
+installed, and zstd if either
+`zstandard <https://pypi.org/project/zstandard/>`_, ``compression.zstd``
+(Python 3.14+) or `backports.zstd <https://pypi.org/project/backports.zstd/>`_
+is available.
+
+Responses are compressed with the best encoding the client accepts, except for
+responses that are too small to be worth it, and JSON responses that mostly
+consist of base64 encoded JPEG, PNG, WebP or video data, which are already
+compressed. Request bodies are decompressed incrementally, and are rejected
+with a ``RequestTooLargeError`` once they grow past ``RW_MAX_REQUEST_SIZE``
+bytes.
+"""
+
+import os
+import re
+import zlib
+from .exceptions import RequestTooLargeError
+
+# Responses smaller than this many bytes are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv('RW_COMPRESSION_MIN_SIZE', 500))
+
+# Largest accepted request body, in bytes, after decompression
+MAX_REQUEST_SIZE = int(os.getenv('RW_MAX_REQUEST_SIZE', 256 * 2 ** 20))
+
+# Skip compressing JSON responses if at least this fraction of their body
+# is made of data URIs of already compressed media
+COMPRESSED_MEDIA_RATIO = 0.5
+
+COMPRESSIBLE_MIMETYPES = [
+    'application/json',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/xml'
+]
+
+COMPRESSED_MEDIA_URI_REGEX = re.compile(
+    br'"data:(?:image/(?:jpeg|jpg|png|webp|gif)|video/[\w.+-]+|audio/(?:mpeg|mp4|aac|ogg|webm));base64,'
+)
+
+DECOMPRESSION_CHUNK_SIZE = 2 ** 16
+
+
+class GzipEncoding(object):
+    name = 'gzip'
+    default_level = 6
+
+    def compress(self, data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data, max_size):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            output = decompressor.decompress(data, max_size + 1)
+        except zlib.error as err:
+            raise ValueError(str(err))
+        if len(output) > max_size:
+            raise RequestTooLargeError(max_size)
+        return output
+
+
+class BrotliEncoding(object):
+    name = 'br'
+    default_level = 4
+
+    def __init__(self):
+        import brotli
+        # Decompressing with a bounded output needs Brotli 1.2+, so older
+        # versions are skipped like a missing package
+        if not hasattr(brotli.Decompressor, 'can_accept_more_data'):
+            raise ImportError('Brotli 1.2 or later is required')
+        self.brotli = brotli
+
+    def compress(self, data, level):
+        return self.brotli.compress(data, quality=level)
+
+    def decompress(self, data, max_size):
+        decompressor = self.brotli.Decompressor()
+        output = []
+        output_size = 0
+        try:
+            for start in range(0, len(data), DECOMPRESSION_CHUNK_SIZE):
+                chunk = data[start:start + DECOMPRESSION_CHUNK_SIZE]
+                while True:
+                    output.append(decompressor.process(chunk, output_buffer_limit=max_size + 1 - output_size))
+                    output_size += len(output[-1])
+                    if output_size > max_size:
+                        raise RequestTooLargeError(max_size)
+                    if decompressor.can_accept_more_data():
+                        break
+                    chunk = b''
+        except self.brotli.error as err:
+            raise ValueError(str(err))
+        return b''.join(output)
+
+
+class ZstandardEncoding(object):
+    """zstd using the ``zstandard`` package."""
+    name = 'zstd'
+    default_level = 3
+
+    def __init__(self):
+        import zstandard
+        self.zstandard = zstandard
+
+    def compress(self, data, level):
+        return self.zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data, max_size):
+        reader = self.zstandard.ZstdDecompressor().stream_reader(data)
+        output = []
+        output_size = 0
+        try:
+            while True:
+                chunk = reader.read(DECOMPRESSION_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.append(chunk)
+                output_size += len(chunk)
+                if output_size > max_size:
+                    raise RequestTooLargeError(max_size)
+        except self.zstandard.ZstdError as err:
+            raise ValueError(str(err))
+        return b''.join(output)
+
+
+class ZstdEncoding(object):
+    """zstd using ``compression.zstd`` or its ``backports.zstd`` backport."""
+    name = 'zstd'
+    default_level = 3
+
+    def __init__(self):
+        try:
+            from compression import zstd
+        except ImportError:
+            from backports import zstd
+        self.zstd = zstd
+
+    def compress(self, data, level):
+        return self.zstd.compress(data, level=level)
+
+    def decompress(self, data, max_size):
+        decompressor = self.zstd.ZstdDecompressor()
+        try:
+            output = decompressor.decompress(data, max_size + 1)
+        except self.zstd.ZstdError as err:
+            raise ValueError(str(err))
+        if len(output) > max_size:
+            raise RequestTooLargeError(max_size)
+        return output
+
+
+def load_encodings():
+    """Return the available encodings by name, in order of preference."""
+    encodings = {}
+    for name, candidates in [('zstd', [ZstandardEncoding, ZstdEncoding]), ('br', [BrotliEncoding])]:
+        for cls in candidates:
+            try:
+                encodings[name] = cls()
+                break
+            except ImportError:
+                continue
+    encodings['gzip'] = GzipEncoding()
+    return encodings
+
+
+def parse_accept_encoding(value):
+    """Return a dict of the content codings in an ``Accept-Encoding`` header
+    mapped to their quality values.
+    """
+    qualities = {}
+    for item in (value or '').split(','):
+        params = item.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            key, _, param_value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def get_compressed_media_size(body):
+    """Return how many bytes of a JSON body are taken by data URIs of
+    already compressed images, video or audio.
+    """
+    size = 0
+    for match in COMPRESSED_MEDIA_URI_REGEX.finditer(body):
+        end = body.find(b'"', match.end())
+        if end == -1:
+            end = len(body)
+        size += end - match.start()
+    return size
+
+
+class CompressionPolicy(object):
+    """Decides whether and how responses are compressed, and decompresses
+    request bodies.
+
+    :param min_size: Responses smaller than this many bytes are sent
+        uncompressed
+    :type min_size: int
+    :param levels: Compression levels by encoding name, e.g. ``{'gzip': 6}``
+    :type levels: dict
+    :param route_levels: Compression levels by encoding name for the
+        responses of particular Flask endpoints, e.g.
+        ``{'command_route': {'gzip': 1}}``
+    :type route_levels: dict
+    :param max_request_size: Largest accepted request body in bytes, after
+        decompression
+    :type max_request_size: int
+    :param skip_compressed_media: Send JSON responses that are mostly base64
+        encoded JPEG, PNG, WebP or video data uncompressed
+    :type skip_compressed_media: bool
+    """
+
+    def __init__(self, min_size=COMPRESSION_MIN_SIZE, levels=None, route_levels=None,
+                 max_request_size=MAX_REQUEST_SIZE, skip_compressed_media=True):
+        self._encodings = None
+        self.min_size = min_size
+        self.levels = levels or {}
+        # Command outputs are compressed on every request, so favour speed
+        self.route_levels = {'command_route': {'gzip': 1, 'br': 1, 'zstd': 1}}
+        self.route_levels.update(route_levels or {})
+        self.max_request_size = max_request_size
+        self.skip_compressed_media = skip_compressed_media
+
+    @property
+    def encodings(self):
+        # Loaded on first use, so that importing runway doesn't import brotli
+        if self._encodings is None:
+            self._encodings = load_encodings()
+        return self._encodings
+
+    def choose_encoding(self, accept_encoding):
+        """Return the name of the encoding to use for a response given the
+        request's ``Accept-Encoding`` header, or None to send it as is.
+        """
+        qualities = parse_accept_encoding(accept_encoding)
+        best = None
+        best_quality = 0
+        for name in ['zstd', 'br', 'gzip']:
+            if name not in self.encodings:
+                continue
+            quality = qualities.get(name, qualities.get('*', 0))
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    def get_level(self, encoding, endpoint=None):
+        route_levels = self.route_levels.get(endpoint, {})
+        if encoding in route_levels:
+            return route_levels[encoding]
+        return self.levels.get(encoding, self.encodings[encoding].default_level)
+
+    def should_compress(self, response):
+        if response.status_code < 200 or response.status_code >= 300 or response.status_code == 204:
+            return False
+        if response.direct_passthrough or response.is_streamed:
+            return False
+        if 'Content-Encoding' in response.headers:
+            return False
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return False
+        return True
+
+    def compress_response(self, response):
+        """Compress a Flask response in place, if the client accepts it and
+        it's worth it. Meant to be used as an ``after_request`` hook.
+        """
+        from flask import request
+        if not self.should_compress(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        if self.skip_compressed_media and response.mimetype == 'application/json' \
+                and get_compressed_media_size(body) >= COMPRESSED_MEDIA_RATIO * len(body):
+            return response
+        level = self.get_level(encoding, request.endpoint)
+        response.set_data(self.encodings[encoding].compress(body, level))
+        response.headers['Content-Encoding'] = encoding
+        # A strong ETag identifies the exact bytes sent, so it must differ
+        # between encodings, whereas a weak one can be shared by all of them
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag('%s:%s' % (etag, encoding))
+        return response
+
+    def decompress_request_body(self, data, content_encoding):
+        """Decompress a request body sent with the given ``Content-Encoding``.
+        Raises ``RequestTooLargeError`` if the result would be larger than
+        ``max_request_size``, and ``ValueError`` if the body can't be
+        decoded.
+        """
+        content_encoding = (content_encoding or '').strip().lower()
+        if content_encoding in ['', 'identity']:
+            if len(data) > self.max_request_size:
+                raise RequestTooLargeError(self.max_request_size)
+            return data
+        if content_encoding not in self.encodings:
+            raise ValueError('Unsupported content encoding: %s' % content_encoding)
+        return self.encodings[content_encoding].decompress(data, self.max_request_size)
@@ -4,22 +4,11 @@ import base64
 import inspect
 import json
 import os
-import tarfile
 from io import BytesIO as IO
 import numpy as np
 from PIL import Image
-from .utils import is_url, extract_tarball, try_cast_np_scalar, download_file, get_color_palette, encode_image
+from .utils import is_url, download_and_extract, LazyPath, memory_map, MemoryMappedDirectory, try_cast_np_scalar, get_color_palette, encode_image, BinaryData
 from .exceptions import MissingArgumentError, InvalidArgumentError
-try:
-    from scipy.spatial.distance import cdist
-except Exception as e:
-    # For some reason, the docs generation process triggered by `make docs` throws an exception
-    # importing this module. We haven't noticed the exception causing a problem at runtime,
-    # but it prevents the inline docs from being generated.
-    if str(e) == '__name__ must be set to a string object':
-        print('Ignoring import error loading scipy module: {}'.format(e))
-    else:
-        raise e
 
 class BaseType(object):
     """An abstract class that defines a base data type interface. This type
@@ -47,6 +36,38 @@ class BaseType(object):
     def deserialize(self, value):
         raise NotImplementedError()
 
+    def serialize_binary(self, value, output_format=None):
+        """Serialize a value for websocket sessions that accept binary
+        frames. Data types that have a raw binary representation (e.g. the
+        encoded bytes of an image) return it wrapped in a
+        ``runway.utils.BinaryData``, others serialize the value as usual.
+        """
+        return self.serialize(value, output_format)
+
+    def serialize_preview(self, value, size, quality=60, binary=False):
+        """Serialize a cheaper, lower fidelity version of a value, sent in
+        place of the intermediate outputs of generator commands when previews
+        are requested. Data types without a cheaper representation serialize
+        the value as is.
+
+        :param size: The maximum width and height of images, in pixels
+        :type size: int
+        :param quality: The JPEG quality of images, from 1 to 95
+        :type quality: int
+        :param binary: Whether to serialize the value as with
+            ``serialize_binary()``, defaults to False
+        :type binary: bool
+        """
+        if binary:
+            return self.serialize_binary(value)
+        return self.serialize(value)
+
+    def warmup_value(self):
+        """Return a synthetic value of this type, serialized as it would be
+        sent in a request, used to warm up commands before the model serves.
+        """
+        raise NotImplementedError()
+
     def to_dict(self):
         return {
             'name': self.name,
@@ -86,6 +107,9 @@ class any(BaseType):
     def deserialize(self, v):
         return v
 
+    def warmup_value(self):
+        return None
+
     def to_dict(self):
         return super(any, self).to_dict()
 
@@ -130,6 +154,12 @@ class array(BaseType):
     def serialize(self, items, output_format=None):
         return [self.item_type.serialize(item) for item in items]
 
+    def serialize_preview(self, items, size, quality=60, binary=False):
+        return [self.item_type.serialize_preview(item, size, quality) for item in items]
+
+    def warmup_value(self):
+        return [self.item_type.warmup_value() for _ in range(max(self.min_length, 1))]
+
     def to_dict(self):
         ret = super(array, self).to_dict()
         ret['itemType'] = self.item_type.to_dict()
@@ -229,10 +259,7 @@ class image(BaseType):
             deserialized_image = deserialized_image.convert(self.get_pil_mode())
         return deserialized_image
 
-    def serialize(self, value, output_format=None):
-        if output_format is None:
-            output_format = self.default_output_format
-        should_output_32bit = output_format.upper() == 'EXR'
+    def to_pil_image(self, value, should_output_32bit=False):
         if type(value) is np.ndarray:
             if not should_output_32bit:
                 value = value.astype(np.uint8)
@@ -243,10 +270,48 @@ class image(BaseType):
             raise InvalidArgumentError(self.name, 'value is not a PIL or numpy image')
         if not should_output_32bit and im_pil.mode != self.get_pil_mode():
             im_pil = im_pil.convert(self.get_pil_mode())
+        return im_pil
+
+    def serialize(self, value, output_format=None):
+        if output_format is None:
+            output_format = self.default_output_format
+        im_pil = self.to_pil_image(value, output_format.upper() == 'EXR')
         encoded = encode_image(im_pil, output_format)
         body = base64.b64encode(encoded).decode('utf8')
         return 'data:image/{format};base64,{body}'.format(format=output_format.lower(), body=body)
 
+    def serialize_binary(self, value, output_format=None):
+        if output_format is None:
+            output_format = self.default_output_format
+        im_pil = self.to_pil_image(value, output_format.upper() == 'EXR')
+        return BinaryData(encode_image(im_pil, output_format), 'image/' + output_format.lower())
+
+    def serialize_preview(self, value, size, quality=60, binary=False):
+        """Serialize the image scaled down to fit in ``size`` x ``size``
+        pixels, as a JPEG of the given ``quality``. Images with an alpha
+        channel are sent as (scaled down) PNGs instead.
+        """
+        im_pil = self.to_pil_image(value)
+        width, height = im_pil.size
+        scale = float(size) / max(width, height)
+        if scale < 1:
+            new_size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+            im_pil = im_pil.resize(new_size, Image.BILINEAR)
+        output_format = 'PNG' if self.channels == 4 else 'JPEG'
+        if output_format == 'JPEG':
+            encoded = encode_image(im_pil, output_format, quality=quality)
+        else:
+            encoded = encode_image(im_pil, output_format)
+        if binary:
+            return BinaryData(encoded, 'image/' + output_format.lower())
+        body = base64.b64encode(encoded).decode('utf8')
+        return 'data:image/{format};base64,{body}'.format(format=output_format.lower(), body=body)
+
+    def warmup_value(self):
+        width = self.width or self.min_width or 256
+        height = self.height or self.min_height or 256
+        return self.serialize(Image.new(self.get_pil_mode(), (width, height)))
+
     def to_dict(self):
         ret = super(image, self).to_dict()
         ret['channels'] = self.channels
@@ -309,6 +374,14 @@ class vector(BaseType):
     def serialize(self, value, output_format=None):
         return value.tolist()
 
+    def serialize_binary(self, value, output_format=None):
+        return BinaryData(np.asarray(value, dtype='<f4').tobytes(), 'application/octet-stream; dtype=float32')
+
+    def warmup_value(self):
+        if self.default is not None:
+            return list(self.default)
+        return np.random.normal(self.sampling_mean, self.sampling_std, self.length).tolist()
+
     def to_dict(self):
         ret = super(vector, self).to_dict()
         ret['length'] = self.length
@@ -366,6 +439,9 @@ class category(BaseType):
     def serialize(self, value, output_format=None):
         return value
 
+    def warmup_value(self):
+        return self.default
+
     def to_dict(self):
         ret = super(category, self).to_dict()
         ret['oneOf'] = self.choices
@@ -413,6 +489,9 @@ class number(BaseType):
     def serialize(self, value, output_format=None):
         return try_cast_np_scalar(value)
 
+    def warmup_value(self):
+        return self.default
+
     def to_dict(self):
         ret = super(number, self).to_dict()
         ret['default'] = self.default
@@ -461,6 +540,12 @@ class text(BaseType):
     def serialize(self, value, output_format=None):
         return str(value)
 
+    def warmup_value(self):
+        default = self.default or ''
+        if len(default) >= self.min_length:
+            return default
+        return 'a' * self.min_length
+
     def to_dict(self):
         ret = super(text, self).to_dict()
         ret['default'] = self.default
@@ -493,27 +578,56 @@ class file(BaseType):
     :type extension: string, optional
     :param default: Use this path if no input file or directory is provided.
     :type default: string, optional
+    :param lazy: Download remote files in the background instead of blocking until
+        the download completes. The deserialized value is a path-like object that
+        only blocks when it is first used (e.g. by ``open()``, ``os.fspath()``, or
+        ``str()``), so expensive setup work that doesn't need the file can run while
+        it downloads. Defaults to False.
+    :type lazy: bool, optional
+    :param mmap: Deserialize the local or downloaded file as a read-only ``numpy.memmap``
+        of bytes instead of a path. Processes that map the same file share one copy of it
+        in the page cache, which helps several workers on one host fit in memory. For
+        directories, the value is a path-like mapping of relative file paths to memory-mapped
+        files. Cannot be combined with ``lazy``. Defaults to False.
+    :type mmap: bool, optional
+    :raises InvalidArgumentError: An invalid argument error if both ``lazy`` and ``mmap``
+        are specified.
     """
 
-    def __init__(self, description=None, is_directory=False, extension=None, default=None):
+    def __init__(self, description=None, is_directory=False, extension=None, default=None, lazy=False, mmap=False):
         super(file, self).__init__('file', description=description)
+        if lazy and mmap:
+            raise InvalidArgumentError(self.name, 'lazy and mmap cannot be combined')
         self.is_directory = is_directory
         self.extension = extension
         self.default = default
+        self.lazy = lazy
+        self.mmap = mmap
 
-    def deserialize(self, path_or_url):
+    def deserialize(self, path_or_url, progress=None):
         if is_url(path_or_url):
-            downloaded_path = download_file(path_or_url)
-            if tarfile.is_tarfile(downloaded_path):
-                return extract_tarball(downloaded_path)
-            else:
-                return downloaded_path
+            if self.lazy:
+                return LazyPath(download_and_extract, path_or_url, progress=progress)
+            path = download_and_extract(path_or_url, progress=progress)
         else:
             if not os.path.exists(path_or_url):
                 raise InvalidArgumentError(self.name, 'file path provided does not exist')
             if self.extension and not path_or_url.endswith(self.extension):
                 raise InvalidArgumentError(self.name, 'file path does not have expected extension')
-            return path_or_url
+            path = path_or_url
+        if self.mmap:
+            return self.map_into_memory(path)
+        return path
+
+    def warmup_value(self):
+        if self.default is None:
+            raise InvalidArgumentError(self.name, 'a default path is needed to warm up commands with file inputs')
+        return self.default
+
+    def map_into_memory(self, path):
+        if os.path.isdir(path):
+            return MemoryMappedDirectory(path)
+        return memory_map(path)
 
     def serialize(self, value, output_format=None):
         return value
@@ -543,10 +657,16 @@ class directory(file):
     :param description: A description of this variable and how its used in the model,
         defaults to None
     :type description: string, optional
+    :param lazy: Download and extract remote tarballs in the background, see ``runway.file``.
+        Defaults to False.
+    :type lazy: bool, optional
+    :param mmap: Deserialize the directory as a mapping of relative file paths to
+        read-only memory-mapped files, see ``runway.file``. Defaults to False.
+    :type mmap: bool, optional
     """
 
-    def __init__(self, description=None, default=None):
-        super(directory, self).__init__(description=description, is_directory=True, default=default)
+    def __init__(self, description=None, default=None, lazy=False, mmap=False):
+        super(directory, self).__init__(description=description, is_directory=True, default=default, lazy=lazy, mmap=mmap)
 
 class segmentation(BaseType):
     """A datatype that represents a pixel-level segmentation of an image.
@@ -626,6 +746,9 @@ class segmentation(BaseType):
         return colors
 
     def colormap_to_segmentation(self, img):
+        # scipy takes a long time to import and is only needed to parse
+        # colormaps, so it is imported on first use
+        from scipy.spatial.distance import cdist
         cmap = np.array(img)[:, :, :3]
         cmap_colors = cmap.reshape(-1, 3)
         labels = list(self.label_to_color.keys())
@@ -657,7 +780,7 @@ class segmentation(BaseType):
             msg = 'unable to parse expected base64-encoded image'
             raise InvalidArgumentError(self.name, msg)
 
-    def serialize(self, value, output_format=None):
+    def encode(self, value):
         if type(value) is np.ndarray:
             im_pil = Image.fromarray(value)
         elif issubclass(type(value), Image.Image):
@@ -668,7 +791,19 @@ class segmentation(BaseType):
             im_pil = self.segmentation_to_colormap(im_pil)
         buffer = IO()
         im_pil.save(buffer, format='PNG')
-        return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('utf8')
+        return buffer.getvalue()
+
+    def serialize(self, value, output_format=None):
+        return 'data:image/png;base64,' + base64.b64encode(self.encode(value)).decode('utf8')
+
+    def serialize_binary(self, value, output_format=None):
+        return BinaryData(self.encode(value), 'image/png')
+
+    def warmup_value(self):
+        width = self.width or self.min_width or 256
+        height = self.height or self.min_height or 256
+        label_id = self.label_to_id[self.default_label]
+        return self.serialize(Image.new('L', (width, height), label_id))
 
     def to_dict(self):
         ret = super(segmentation, self).to_dict()
@@ -724,6 +859,9 @@ class boolean(BaseType):
         self.validate(value)
         return value
 
+    def warmup_value(self):
+        return self.default
+
     def to_dict(self):
         ret = super(boolean, self).to_dict()
         ret['default'] = self.default
@@ -765,6 +903,9 @@ class image_point(BaseType):
         self.validate(value)
         return value
 
+    def warmup_value(self):
+        return [0.5, 0.5]
+
 
 class image_bounding_box(BaseType):
     """An bounding box data type, representing a rectangular region in an image.
@@ -809,6 +950,9 @@ class image_bounding_box(BaseType):
         self.validate(value)
         return value
 
+    def warmup_value(self):
+        return [0.25, 0.25, 0.75, 0.75]
+
 
 class image_landmarks(BaseType):
     """An image landmarks data type, representing a fixed-length array of (x, y) coordinates, such as facial landmarks.
@@ -916,9 +1060,14 @@ class image_landmarks(BaseType):
 
     def serialize(self, value, output_format=None):
         self.validate(value)
+        if isinstance(value, np.ndarray):
+            return value.tolist()
         value = [[try_cast_np_scalar(pt[0]), try_cast_np_scalar(pt[1])] for pt in value]
         return value
 
+    def warmup_value(self):
+        return [[0.5, 0.5] for _ in range(self.length)]
+
     def to_dict(self):
         ret = super(image_landmarks, self).to_dict()
         ret['length'] = self.length
@@ -154,3 +154,67 @@ class MissingArgumentError(RunwayError):
         super(MissingArgumentError, self).__init__()
         self.message = 'Missing argument: %s.' % arg
         self.code = 500
+
+
+class ModelNotReadyError(RunwayError):
+    """An error thrown if a command is requested while the model server is
+    still setting up the model in the background and setup doesn't finish in
+    time, or if setup failed.
+
+    :ivar message: An error message, set to "Model is not ready: {STATUS}."
+    :type message: string
+    :ivar code: An HTTP error code, set to 503
+    :type code: number
+    """
+    def __init__(self, status):
+        super(ModelNotReadyError, self).__init__()
+        self.message = 'Model is not ready: %s.' % status
+        self.code = 503
+
+
+class RequestTooLargeError(RunwayError):
+    """An error thrown if the body of a request, once decompressed, is larger
+    than the server accepts.
+
+    :ivar message: An error message, set to "Request body is larger than
+        {MAX_SIZE} bytes."
+    :type message: string
+    :ivar code: An HTTP error code, set to 413
+    :type code: number
+    """
+    def __init__(self, max_size):
+        super(RequestTooLargeError, self).__init__()
+        self.message = 'Request body is larger than %s bytes.' % max_size
+        self.code = 413
+
+
+class DeadlineExceededError(RunwayError):
+    """An error thrown if a command's deadline passes before it is run, or
+    while a generator command is running.
+
+    :ivar message: An error message, set to "Deadline of {DEADLINE}ms
+        exceeded."
+    :type message: string
+    :ivar code: An HTTP error code, set to 504
+    :type code: number
+    """
+    def __init__(self, deadline_ms):
+        super(DeadlineExceededError, self).__init__()
+        self.message = 'Deadline of %sms exceeded.' % deadline_ms
+        self.code = 504
+
+
+class UnknownInputHandleError(RunwayError):
+    """An error thrown if a websocket ``submit`` message references an
+    uploaded input that its session doesn't have, e.g. because it was evicted
+    to make room for newer uploads.
+
+    :ivar message: An error message, set to "Unknown input handle: {HANDLE}."
+    :type message: string
+    :ivar code: An HTTP error code, set to 404
+    :type code: number
+    """
+    def __init__(self, handle):
+        super(UnknownInputHandleError, self).__init__()
+        self.message = 'Unknown input handle: %s.' % handle
+        self.code = 404
@@ -0,0 +1,322 @@
+"""Commands submitted over the websocket connections of the model server."""
+
+import os
+import time
+from collections import OrderedDict, Counter
+import gevent
+from .exceptions import DeadlineExceededError, RequestTooLargeError, UnknownInputHandleError, InvalidArgumentError
+from .utils import LRUCache
+from .codec import json_dumps
+
+# Number of seconds finished jobs are kept, e.g. to ignore resubmitted ids
+JOB_TTL = float(os.getenv('RW_JOB_TTL', 60))
+
+# Maximum number of finished jobs kept across all sessions
+MAX_FINISHED_JOBS = int(os.getenv('RW_MAX_FINISHED_JOBS', 1000))
+
+# Maximum estimated size in bytes of the inputs uploaded by each session
+MAX_SESSION_INPUT_BYTES = int(os.getenv('RW_MAX_SESSION_INPUT_BYTES', 512 * 2 ** 20))
+
+JOB_STATES = ['queued', 'running', 'done', 'failed', 'cancelled']
+
+
+def get_type_signature(field):
+    """Return a key identifying the data type of an input, and the way it
+    deserializes values, regardless of its name and description.
+    """
+    signature = field.to_dict()
+    signature.pop('name', None)
+    signature.pop('description', None)
+    return json_dumps(signature)
+
+
+class JobCancelled(Exception):
+    """Raised in a job's greenlet to stop it once the job is cancelled."""
+    pass
+
+
+class Job(object):
+    """A command submitted over a websocket, run by a greenlet of the model
+    server that advances the command on the inference pool.
+
+    Cancellation is cooperative: a cancelled job stops at the next yield of
+    its (generator) command, and a job still waiting for a concurrency slot is
+    stopped right away. Either way its slot is released as soon as it is
+    cancelled.
+
+    :param job_id: The id of the job, unique within its session
+    :type job_id: string
+    :param command_name: The name of the command to run
+    :type command_name: string
+    :param deadline: The deadline of the job, if any
+    :type deadline: runway.utils.Deadline, optional
+    """
+
+    def __init__(self, job_id, command_name, deadline=None):
+        self.id = job_id
+        self.command_name = command_name
+        self.deadline = deadline
+        self.state = 'queued'
+        self.greenlet = None
+        self.slots = None
+        self.finished_at = None
+
+    @property
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def acquire_slot(self, slots):
+        """Wait for a slot of the command's concurrency limit, if it has one,
+        then mark the job as running.
+        """
+        if slots is not None:
+            timeout = self.deadline.remaining() if self.deadline is not None else None
+            if not slots.acquire(timeout=timeout):
+                raise DeadlineExceededError(self.deadline.millis)
+            self.slots = slots
+        self.check()
+        self.state = 'running'
+
+    def release_slot(self):
+        if self.slots is not None:
+            self.slots.release()
+            self.slots = None
+
+    def check(self):
+        """Raise ``JobCancelled`` if the job was cancelled, or
+        ``DeadlineExceededError`` if its deadline has passed.
+        """
+        if self.cancelled:
+            raise JobCancelled()
+        if self.deadline is not None:
+            self.deadline.check()
+
+    def finish(self, state):
+        """Record that the job stopped running, as ``done`` or ``failed``,
+        and release its slot. A cancelled job stays cancelled.
+        """
+        if not self.cancelled:
+            self.state = state
+        self.release_slot()
+
+    def cancel(self):
+        """Cancel the job. Returns False if it had already finished."""
+        if self.state not in ['queued', 'running']:
+            return False
+        queued = self.state == 'queued'
+        self.state = 'cancelled'
+        self.release_slot()
+        if queued and self.greenlet is not None:
+            self.greenlet.kill(JobCancelled(), block=False)
+        return True
+
+
+class JobRegistry(object):
+    """The jobs of each open websocket session. Jobs are removed from their
+    session once their greenlet exits, and kept as finished jobs for ``ttl``
+    seconds, up to ``max_finished`` of them. Closing a session cancels its
+    jobs and forgets its finished ones.
+
+    Each session also keeps the deserialized inputs it uploaded, by handle,
+    forgetting the least recently used ones once they take more than
+    ``max_input_bytes``.
+
+    :param ttl: The number of seconds finished jobs are kept
+    :type ttl: float
+    :param max_finished: The maximum number of finished jobs kept
+    :type max_finished: int
+    :param max_input_bytes: The maximum estimated size in bytes of the inputs
+        uploaded by a session
+    :type max_input_bytes: int
+    """
+
+    def __init__(self, ttl=JOB_TTL, max_finished=MAX_FINISHED_JOBS, max_input_bytes=MAX_SESSION_INPUT_BYTES):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.max_input_bytes = max_input_bytes
+        self.sessions = {}
+        self.inputs = {}
+        self.finished = OrderedDict()
+        self.submitted_count = 0
+
+    def open_session(self, session_id):
+        self.sessions[session_id] = {}
+        # entries are (value, estimated size, type signature) tuples
+        self.inputs[session_id] = LRUCache(max_bytes=self.max_input_bytes, sizeof=lambda entry: entry[1])
+
+    def close_session(self, session_id):
+        self.inputs.pop(session_id, None)
+        for job in list(self.sessions.pop(session_id, {}).values()):
+            job.cancel()
+        for key in [key for key in self.finished if key[0] == session_id]:
+            del self.finished[key]
+
+    def get(self, session_id, job_id):
+        """Return a job of the session that hasn't finished yet, or None."""
+        return self.sessions.get(session_id, {}).get(job_id)
+
+    def contains(self, session_id, job_id):
+        """Whether the session has a job with this id, finished or not."""
+        self.reap()
+        return job_id in self.sessions.get(session_id, {}) or (session_id, job_id) in self.finished
+
+    def put_input(self, session_id, handle, field, value, nbytes):
+        """Keep an input of ``nbytes`` bytes, uploaded for and deserialized by
+        the data type ``field``, for the session, under ``handle``, replacing
+        any input it had with the same handle.
+        """
+        if nbytes > self.max_input_bytes:
+            raise RequestTooLargeError(self.max_input_bytes)
+        self.inputs[session_id].put(handle, (value, nbytes, get_type_signature(field)))
+
+    def get_inputs(self, session_id, handles, fields):
+        """Return the uploaded inputs referenced by a dict of input names to
+        handles, by input name. Each input must have been uploaded for a data
+        type identical to that of the input ``fields`` it is passed as.
+
+        The values are shared by every job that uses the same handle, so they
+        must be copied before they are passed to a command, as the compiled
+        deserializers of commands do.
+        """
+        if not isinstance(handles, dict):
+            raise InvalidArgumentError('inputHandles', 'value must map input names to handles')
+        fields = {field.name: field for field in fields}
+        inputs = self.inputs.get(session_id)
+        values = {}
+        for name, handle in handles.items():
+            if name not in fields:
+                raise InvalidArgumentError('inputHandles', '%s is not an input of the command' % name)
+            entry = inputs.get(handle) if inputs is not None else None
+            if entry is None:
+                raise UnknownInputHandleError(handle)
+            value, _, signature = entry
+            if signature != get_type_signature(fields[name]):
+                raise InvalidArgumentError(name, 'input %s was uploaded for a different data type' % handle)
+            values[name] = value
+        return values
+
+    def add(self, session_id, job):
+        self.sessions[session_id][job.id] = job
+        self.submitted_count += 1
+
+    def release(self, session_id, job):
+        """Move a job whose greenlet exited to the finished jobs."""
+        jobs_for_session = self.sessions.get(session_id)
+        if jobs_for_session is None or jobs_for_session.get(job.id) is not job:
+            return
+        del jobs_for_session[job.id]
+        job.finished_at = time.time()
+        self.finished[(session_id, job.id)] = job
+        self.reap()
+
+    def reap(self):
+        """Forget finished jobs older than ``ttl`` seconds, and the oldest
+        ones beyond ``max_finished``.
+        """
+        expires_before = time.time() - self.ttl
+        while self.finished:
+            key, job = next(iter(self.finished.items()))
+            if len(self.finished) <= self.max_finished and job.finished_at > expires_before:
+                break
+            del self.finished[key]
+
+    def active_jobs(self):
+        for jobs_for_session in self.sessions.values():
+            for job in jobs_for_session.values():
+                yield job
+
+    def to_dict(self):
+        """Return job-count gauges, by state, for ``/metrics``."""
+        self.reap()
+        counts = Counter(job.state for job in self.active_jobs())
+        counts.update(job.state for job in self.finished.values())
+        return dict(
+            sessions=len(self.sessions),
+            active=sum(len(jobs) for jobs in self.sessions.values()),
+            retained=len(self.finished),
+            submitted=self.submitted_count,
+            states={state: counts[state] for state in JOB_STATES}
+        )
+
+
+class OutputStream(object):
+    """Sends the outputs of a websocket job, skipping intermediate outputs
+    of generator commands that the client doesn't have time for. Skipped
+    outputs are never serialized.
+
+    :param send: A function that serializes and sends an output, called
+        with the output and whether it is the job's final output
+    :type send: function
+    :param interval: Send at most one intermediate output every ``interval``
+        seconds, defaults to 0 (no limit)
+    :type interval: float
+    :param latest_only: Send intermediate outputs from a separate greenlet,
+        and while it is busy (e.g. the socket is backed up) keep only the
+        latest output, defaults to False
+    :type latest_only: bool
+    :param previews: Whether intermediate outputs are sent as reduced
+        previews, in which case a generator that doesn't return a final
+        output has its last intermediate output sent again as the final one,
+        defaults to False
+    :type previews: bool
+    """
+
+    def __init__(self, send, interval=0, latest_only=False, previews=False):
+        self.send = send
+        self.interval = interval
+        self.latest_only = latest_only
+        self.previews = previews
+        self.last_output = None
+        self.last_sent_at = None
+        self.pending = []
+        self.sender = None
+        self.error = None
+
+    def deliver(self, output, final=False):
+        self.last_sent_at = time.time()
+        if self.previews and not final:
+            self.last_output = output
+        self.send(output, final)
+
+    def deliver_pending(self):
+        try:
+            while self.pending:
+                self.deliver(self.pending.pop())
+        except BaseException as err:
+            self.error = err
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, output):
+        """Send an intermediate output, unless it is throttled."""
+        self.raise_error()
+        # only the latest skipped output is kept, to send when the job ends
+        self.pending = [output]
+        if self.interval and self.last_sent_at is not None \
+                and time.time() - self.last_sent_at < self.interval:
+            return
+        if self.latest_only:
+            if self.sender is None or self.sender.dead:
+                self.sender = gevent.spawn(self.deliver_pending)
+            return
+        self.pending = []
+        self.deliver(output)
+
+    def close(self, output=None):
+        """Send the final ``output`` of the job, or if it is None, the latest
+        intermediate output that was skipped, or with previews, the latest
+        one that was sent.
+        """
+        if output is None and self.pending:
+            output = self.pending.pop()
+        self.pending = []
+        if self.sender is not None:
+            self.sender.join()
+        self.raise_error()
+        if output is None:
+            output = self.last_output
+        self.last_output = None
+        if output is not None:
+            self.deliver(output, final=True)
@@ -0,0 +1,294 @@
+"""Extract the manifest of a Runway model, i.e. the options and commands it
+declares, without running the model.
+
+The model file is parsed and its ``@runway.setup()`` and ``@runway.command()``
+declarations are evaluated on their own, so neither the web server stack nor
+the model's own dependencies are imported. If a declaration depends on
+something that can't be evaluated this way (e.g. choices computed by a
+function), or is made somewhere other than on a module-level function of the
+model file (e.g. inside a function, behind a conditional, on a
+``RunwayModel`` instance or in a module imported from the model's
+directory), the model is run with ``RW_META=1`` instead.
+
+.. code-block:: bash
+
+    python -m runway.meta runway_model.py --output manifest.json
+
+The manifest file can then be passed to ``runway.run()`` with the
+``manifest_path`` argument (or the ``RW_MANIFEST_PATH`` environment variable)
+to be served by the ``/meta`` route.
+"""
+
+import os
+import sys
+import ast
+import json
+import builtins
+import argparse
+import subprocess
+from types import SimpleNamespace
+from . import data_types
+from .model import RunwayModel
+
+DATA_TYPES = {
+    name: value for name, value in vars(data_types).items()
+    if isinstance(value, type) and issubclass(value, data_types.BaseType)
+}
+
+SAFE_BUILTINS = {
+    name: getattr(builtins, name) for name in [
+        'bool', 'dict', 'enumerate', 'float', 'int', 'len', 'list', 'max',
+        'min', 'range', 'reversed', 'sorted', 'str', 'tuple', 'zip'
+    ]
+}
+
+DECORATORS = ['setup', 'command']
+
+UNEVALUATED = object()
+
+
+class StaticExtractionError(Exception):
+    pass
+
+
+def get_imported_names(node):
+    """Return the names bound by a ``runway`` import statement in the model
+    file, mapped to what they refer to: a data type, the data types module,
+    the runway module, or one of the ``setup``/``command`` decorators.
+    """
+    data_types_module = SimpleNamespace(**DATA_TYPES)
+    runway_module = SimpleNamespace(data_types=data_types_module, **DATA_TYPES)
+    names = {}
+    if isinstance(node, ast.Import):
+        for alias in node.names:
+            if alias.name == 'runway':
+                names[alias.asname or 'runway'] = runway_module
+            elif alias.name == 'runway.data_types':
+                if alias.asname:
+                    names[alias.asname] = data_types_module
+                else:
+                    names['runway'] = runway_module
+    elif isinstance(node, ast.ImportFrom) and node.module in ['runway', 'runway.data_types']:
+        for alias in node.names:
+            if alias.name == '*':
+                names.update(DATA_TYPES)
+            elif alias.name in DATA_TYPES:
+                names[alias.asname or alias.name] = DATA_TYPES[alias.name]
+            elif node.module == 'runway' and alias.name == 'data_types':
+                names[alias.asname or alias.name] = data_types_module
+            elif node.module == 'runway' and alias.name in DECORATORS:
+                names[alias.asname or alias.name] = alias.name
+    if isinstance(node, ast.ImportFrom) and node.module in ['runway', 'runway.model']:
+        for alias in node.names:
+            if alias.name == 'RunwayModel':
+                names[alias.asname or alias.name] = alias.name
+    return names
+
+
+def get_all_imported_names(tree):
+    names = {}
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update(get_imported_names(node))
+    return names
+
+
+def evaluate(node, namespace, filename):
+    code = compile(ast.Expression(body=node), filename, 'eval')
+    return eval(code, {'__builtins__': SAFE_BUILTINS}, namespace)
+
+
+def get_decorator_name(node, namespace):
+    if isinstance(node, ast.Call):
+        node = node.func
+    if isinstance(node, ast.Name) and isinstance(namespace.get(node.id), str) \
+            and namespace[node.id] in DECORATORS:
+        return namespace[node.id]
+    if isinstance(node, ast.Attribute) and node.attr in DECORATORS \
+            and isinstance(node.value, ast.Name) \
+            and isinstance(namespace.get(node.value.id), SimpleNamespace):
+        return node.attr
+    return None
+
+
+def is_runway_model(node, namespace):
+    if isinstance(node, ast.Name):
+        return namespace.get(node.id) == 'RunwayModel'
+    return isinstance(node, ast.Attribute) and node.attr == 'RunwayModel' \
+        and isinstance(node.value, ast.Name) \
+        and isinstance(namespace.get(node.value.id), SimpleNamespace)
+
+
+def find_unresolved_declarations(tree, resolved=()):
+    """Return the line numbers of the setup and command declarations of a
+    module that aren't in ``resolved``, the ids of the decorators that were
+    evaluated, along with any ``RunwayModel`` instances it creates.
+    """
+    namespace = get_all_imported_names(tree)
+    lines = set()
+    for node in ast.walk(tree):
+        if id(node) in resolved:
+            continue
+        if isinstance(node, ast.Call):
+            if get_decorator_name(node, namespace) is not None or is_runway_model(node.func, namespace):
+                lines.add(node.lineno)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            for decorator in node.decorator_list:
+                if id(decorator) not in resolved and get_decorator_name(decorator, namespace) is not None:
+                    lines.add(decorator.lineno)
+    return sorted(lines)
+
+
+def get_local_module_path(name, model_dir):
+    base = os.path.join(model_dir, *name.split('.'))
+    for path in [base + '.py', os.path.join(base, '__init__.py')]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def check_imported_modules(tree, model_dir):
+    """Raise ``StaticExtractionError`` if a module imported by the model from
+    its own directory declares setup or commands, which would be missing
+    from a manifest extracted from the model file alone.
+    """
+    module_names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            module_names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            module_names.add(node.module)
+            module_names.update('%s.%s' % (node.module, alias.name) for alias in node.names)
+    for name in sorted(module_names):
+        path = get_local_module_path(name, model_dir)
+        if path is None:
+            continue
+        try:
+            with open(path, 'rb') as f:
+                module_tree = ast.parse(f.read(), path)
+        except (OSError, SyntaxError):
+            continue
+        lines = find_unresolved_declarations(module_tree)
+        if lines:
+            msg = 'imported module %s declares setup, commands or a RunwayModel on line %d' % (name, lines[0])
+            raise StaticExtractionError(msg)
+
+
+def extract_manifest_statically(source, filename='<model>', model_dir=None):
+    """Build the manifest of a model from its source code. Module-level
+    assignments are evaluated in order with only the runway data types and a
+    few builtins available, and assignments that can't be evaluated are
+    skipped. Raises ``StaticExtractionError`` if a setup or command
+    declaration can't be evaluated, if one isn't a decorator of a
+    module-level function (e.g. it is made inside a function or behind a
+    conditional), if the model creates its own ``RunwayModel``, or if the
+    model declares no commands. If ``model_dir`` is given, the modules
+    imported from it are checked for declarations too.
+    """
+    tree = ast.parse(source, filename)
+    model = RunwayModel()
+    namespace = {}
+    resolved = set()
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            namespace.update(get_imported_names(node))
+        elif isinstance(node, ast.Assign):
+            try:
+                value = evaluate(node.value, namespace, filename)
+            except Exception:
+                value = UNEVALUATED
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    if value is UNEVALUATED:
+                        namespace.pop(target.id, None)
+                    else:
+                        namespace[target.id] = value
+        elif isinstance(node, ast.FunctionDef):
+            for decorator in node.decorator_list:
+                decorator_name = get_decorator_name(decorator, namespace)
+                if decorator_name is None:
+                    continue
+                resolved.add(id(decorator))
+                try:
+                    args = []
+                    kwargs = {}
+                    if isinstance(decorator, ast.Call):
+                        args = [evaluate(arg, namespace, filename) for arg in decorator.args]
+                        kwargs = {kw.arg: evaluate(kw.value, namespace, filename) for kw in decorator.keywords}
+                    if decorator_name == 'setup' and not isinstance(decorator, ast.Call):
+                        model.setup(node.name)
+                    else:
+                        getattr(model, decorator_name)(*args, **kwargs)(node.name)
+                except Exception as err:
+                    msg = 'unable to evaluate @%s on line %d: %r' % (decorator_name, decorator.lineno, err)
+                    raise StaticExtractionError(msg)
+    unresolved_lines = find_unresolved_declarations(tree, resolved)
+    if unresolved_lines:
+        msg = 'unable to resolve the setup, command or RunwayModel declared on line %d' % unresolved_lines[0]
+        raise StaticExtractionError(msg)
+    if model_dir is not None:
+        check_imported_modules(tree, model_dir)
+    if len(model.commands) == 0:
+        raise StaticExtractionError('no commands found')
+    return model.get_manifest()
+
+
+def extract_manifest_by_running(model_path):
+    """Build the manifest of a model by running it with ``RW_META=1``."""
+    model_dir = os.path.dirname(os.path.abspath(model_path))
+    env = dict(os.environ, RW_META='1')
+    output = subprocess.check_output([sys.executable, os.path.abspath(model_path)], cwd=model_dir, env=env)
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def extract_manifest(model_path, fallback=True):
+    """Build the manifest of the model defined in ``model_path``, statically
+    if possible. If static extraction fails and ``fallback`` is True, the
+    model is run with ``RW_META=1`` instead.
+    """
+    with open(model_path, 'rb') as f:
+        source = f.read()
+    model_dir = os.path.dirname(os.path.abspath(model_path))
+    try:
+        return extract_manifest_statically(source, model_path, model_dir)
+    except (StaticExtractionError, SyntaxError) as err:
+        if not fallback:
+            raise
+        sys.stderr.write('Running model to extract its manifest: %s\n' % err)
+        return extract_manifest_by_running(model_path)
+
+
+def write_manifest(manifest, path):
+    partial_path = path + '.partial'
+    with open(partial_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(partial_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m runway.meta',
+        description='Print the options and commands of a Runway model as JSON.'
+    )
+    parser.add_argument('model_path', help='The Python file defining the model.')
+    parser.add_argument('-o', '--output', help='Write the manifest to this file instead of printing it.')
+    parser.add_argument('--no-fallback', action='store_true',
+                        help='Fail instead of running the model if the manifest can\'t be extracted statically.')
+    args = parser.parse_args(argv)
+    try:
+        manifest = extract_manifest(args.model_path, fallback=not args.no_fallback)
+    except StaticExtractionError as err:
+        sys.stderr.write('Unable to extract manifest: %s\n' % err)
+        return 1
+    except subprocess.CalledProcessError as err:
+        sys.stderr.write('Unable to extract manifest: running the model failed with exit status %d\n' % err.returncode)
+        return 1
+    if args.output:
+        write_manifest(manifest, args.output)
+    else:
+        print(json.dumps(manifest))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
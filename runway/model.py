@@ -1,29 +1,63 @@
 import os
 import sys
 import logging
-import datetime
-import traceback
 import inspect
 import json
+import gc
+import shutil
+import hashlib
+import tempfile
+import threading
 import gevent
+import gevent.lock
+import gevent.event
 import time
-from multiprocessing import Process
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from six import reraise
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from flask_sockets import Sockets
-from gevent.pywsgi import WSGIServer
-from geventwebsocket.handler import WebSocketHandler
-import werkzeug.serving
-from flask_compress import Compress
 from .exceptions import RunwayError, MissingInputError, MissingOptionError, \
-    InferenceError, UnknownCommandError, SetupError
+    InferenceError, UnknownCommandError, SetupError, InvalidArgumentError, ModelNotReadyError, \
+    DeadlineExceededError
 from .data_types import *
-from .utils import gzipped, parse_output_formats_from_header, serialize_command, cast_to_obj, timestamp_millis, \
+from .utils import parse_output_formats_from_header, serialize_command, cast_to_obj, timestamp_millis, \
         validate_post_request_body_is_json, get_json_or_none_if_invalid, argspec, \
-        deserialize_data, serialize_data, generate_uuid
+        compile_deserializer, compile_serializer, generate_uuid, is_url, DownloadProgress, LRUCache, estimate_size, \
+        parse_model_options, parse_deadline, call_before_deadline, DEADLINE_EXCEEDED, next_output, split_binary_data, PrecomputedJSON, save_snapshot, load_snapshot, load_snapshot_metadata, get_code_hash, \
+        get_resource_version
+from .compression import CompressionPolicy
+from .monitoring import LoopBlockMonitor
+from .jobs import Job, JobCancelled, JobRegistry, OutputStream
+from .codec import json_dumps, json_loads, json_response
 from .__version__ import __version__ as model_sdk_version
 
+fork_hook_registered = False
+
+def register_fork_hook():
+    """Reinitialize the gevent hub in processes forked by the model server
+    (e.g. by a command), which must be done before the child can use it once
+    the hub's threadpool or the inference pool has been started. Called when
+    the server starts or a thread pool is first used rather than on import,
+    so that importing runway doesn't hook the forks of other code.
+    """
+    global fork_hook_registered
+    if fork_hook_registered or not hasattr(os, 'register_at_fork'):
+        return
+    os.register_at_fork(after_in_child=gevent.reinit)
+    fork_hook_registered = True
+
+def run_off_hub(fn, *args):
+    """Call ``fn(*args)`` on the gevent hub's threadpool without blocking
+    the server, or directly if the current thread doesn't run a hub (e.g. a
+    command running on the inference pool).
+    """
+    from gevent._hub_local import get_hub_if_exists
+    hub = get_hub_if_exists()
+    if hub is None or hub.thread_ident != threading.get_ident():
+        return fn(*args)
+    register_fork_hook()
+    return hub.threadpool.apply(fn, args)
+
 class RunwayModel(object):
     """A Runway Model server. A singleton instance of this class is created automatically
        when the runway module is imported.
@@ -36,22 +70,56 @@ class RunwayModel(object):
         self.setup_fn = None
         self.commands = {}
         self.command_fns = {}
-        self.jobs = {}
+        self.jobs = JobRegistry()
         self.model = None
+        self.model_options = {}
+        self.model_cache = LRUCache(max_size=1)
+        self.model_leases = Counter()
+        self.model_unloaded = False
+        self.model_snapshot_path = None
+        self.snapshot_dir = None
+        self.restored_snapshot = None
+        self.setup_lock = gevent.lock.Semaphore()
         self.running_status = 'STARTING'
-        self.app = Flask(__name__)
-        self.sockets = Sockets(self.app)
-        # Support utf-8 in application/json requests and responses.
-        # We wrap this in a try/except block because, for whatever reason,
-        # `make docs` throws a TypeError that keys are unassignable to
-        # self.app.config. This DOES NOT occur when using the RunwayModel module
-        # anywere except in the docs build environment.
-        try: self.app.config['JSON_AS_ASCII'] = False
-        except TypeError: pass
-        CORS(self.app)
-        Compress(self.app)
-        self.define_error_handlers()
-        self.define_routes()
+        self.setup_progress = {}
+        self.setup_finished = gevent.event.Event()
+        self.setup_timeout = 0
+        self.inference_threads = 1
+        self.inference_pool = None
+        self.setup_on_inference_thread = False
+        self.cached_manifest = None
+        self.precomputed_manifest = None
+        self.precomputed_commands = {}
+        self.compression = CompressionPolicy()
+        self.loop_monitor = LoopBlockMonitor()
+        self.sockets = None
+        self._app = None
+
+    @property
+    def app(self):
+        """The Flask app serving the model. It is created on first use, so
+        that importing runway (e.g. to print the model's manifest) doesn't load
+        the web server stack.
+        """
+        if self._app is None:
+            from flask import Flask
+            from flask_cors import CORS
+            from flask_sockets import Sockets
+            self._app = Flask(__name__)
+            self.sockets = Sockets(self._app)
+            # Support utf-8 in application/json requests and responses.
+            # We wrap this in a try/except block because, for whatever reason,
+            # `make docs` throws a TypeError that keys are unassignable to
+            # self.app.config. This DOES NOT occur when using the RunwayModel module
+            # anywere except in the docs build environment.
+            try: self._app.config['JSON_AS_ASCII'] = False
+            except TypeError: pass
+            CORS(self._app)
+            self._app.extensions['runway_compression'] = self.compression
+            self._app.after_request(self.compression.compress_response)
+            self.define_error_handlers()
+            self.define_routes()
+        return self._app
 
     def define_error_handlers(self):
 
@@ -61,190 +129,288 @@ class RunwayModel(object):
         def unauthorized(e):
             msg = 'Unauthorized (well... '
             msg += 'really unauthenticated but hey I didn\'t write the spec).'
-            return jsonify(dict(error=msg)), 401
+            return json_response(dict(error=msg), 401)
 
         # not yet implemented, but if and when it is lets make sure its returned
         # as JSON
         @self.app.errorhandler(403)
         def forbidden(e):
-            return jsonify(dict(error='Forbidden.')), 403
+            return json_response(dict(error='Forbidden.'), 403)
 
         @self.app.errorhandler(404)
         def page_not_found(e):
-            return jsonify(dict(error='Not found.')), 404
+            return json_response(dict(error='Not found.'), 404)
 
         @self.app.errorhandler(405)
         def method_not_allowed(e):
-            return jsonify(dict(error='Method not allowed.')), 405
+            return json_response(dict(error='Method not allowed.'), 405)
 
         # we shouldn't have any of these as we are wrapping errors in
         # RunwayError objects and returning stacktraces, but it can't hurt
         # to be safe.
         @self.app.errorhandler(500)
         def internal_server_error(e):
-            return jsonify(dict(error='Internal server error.')), 500
+            return json_response(dict(error='Internal server error.'), 500)
 
     def define_routes(self):
+        from flask import Response, request
+
+        def precomputed_json_response(precomputed, extra_data=None):
+            if request.if_none_match.contains_weak(precomputed.etag):
+                response = Response(status=304)
+            else:
+                accepts_gzip = request.accept_encodings['gzip'] > 0
+                body = precomputed.render(extra_data, gzipped=accepts_gzip)
+                response = Response(body, mimetype='application/json')
+                if accepts_gzip:
+                    response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(precomputed.etag, weak=True)
+            response.vary.add('Accept-Encoding')
+            return response
 
         @self.app.route('/', methods=['GET'])
         @self.app.route('/meta', methods=['GET'])
         def manifest():
-            return jsonify(dict(
-                modelSDKVersion=model_sdk_version,
+            return precomputed_json_response(self.get_precomputed_manifest(), dict(
                 millisRunning=self.millis_running(),
-                millisSinceLastCommand=self.millis_since_last_command(),
-                GPU=os.environ.get('GPU') == '1',
-                options=[opt.to_dict() for opt in self.options],
-                commands=[serialize_command(cmd) for cmd in self.commands.values()]
+                millisSinceLastCommand=self.millis_since_last_command()
             ))
 
         @self.app.route('/healthcheck', methods=['GET'])
         def healthcheck_route():
-            return jsonify(dict(status=self.running_status))
+            health = dict(status=self.running_status)
+            if self.model_unloaded:
+                health['idle'] = True
+            if self.running_status == 'STARTING' and self.setup_progress:
+                health['progress'] = {name: progress.to_dict() for name, progress in self.setup_progress.items()}
+            return json_response(health)
+
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics_route():
+            return json_response(dict(eventLoop=self.loop_monitor.to_dict(), jobs=self.jobs.to_dict()))
 
         @self.app.route('/setup', methods=['POST'])
         @validate_post_request_body_is_json
         def setup_route():
             opts = get_json_or_none_if_invalid(request)
             try:
-                self.setup_model(opts)
-                return jsonify(dict(success=True))
+                with self.loop_monitor.label('setup'):
+                    self.setup_model_in_background(opts)
+                return json_response(dict(success=True))
             except RunwayError as err:
                 err.print_exception()
-                return jsonify(err.to_response()), err.code
+                return json_response(err.to_response(), err.code)
 
         @self.app.route('/setup', methods=['GET'])
         def setup_options_route():
-            return jsonify(self.options)
+            return json_response(self.options)
 
         @self.app.route('/<command_name>', methods=['POST'])
-        @validate_post_request_body_is_json
         def command_route(command_name):
+            with self.loop_monitor.label(command_name):
+                return run_command_route(command_name)
+
+        @validate_post_request_body_is_json
+        def run_command_route(command_name):
             try:
                 try:
                     command_fn = self.command_fns[command_name]
                 except KeyError:
                     raise UnknownCommandError(command_name)
-                inputs = self.commands[command_name]['inputs']
-                outputs = self.commands[command_name]['outputs']
+                command = self.commands[command_name]
                 output_formats_header = request.headers.get('X-Runway-Output-Format')
                 if output_formats_header:
                     output_formats = parse_output_formats_from_header(output_formats_header)
                 else:
                     output_formats = {}
+                model_options_header = request.headers.get('X-Runway-Model-Options')
+                if model_options_header:
+                    model_options = parse_model_options(model_options_header)
+                else:
+                    model_options = None
+                deadline_header = request.headers.get('X-Runway-Deadline-Ms')
+                if deadline_header:
+                    deadline = parse_deadline(deadline_header)
+                else:
+                    deadline = None
                 input_dict = get_json_or_none_if_invalid(request)
-                deserialized_inputs = deserialize_data(input_dict, inputs)
+                deserialized_inputs = self.run_in_inference_pool(
+                    command['deserialize_inputs'], input_dict, deadline=deadline
+                )
                 self.millis_last_command = timestamp_millis()
-                try:
-                    if inspect.isgeneratorfunction(command_fn):
-                        g = command_fn(self.model, deserialized_inputs)
-                        try:
-                            while True:
-                                output_data = next(g)
-                        except StopIteration as err:
-                            if hasattr(err, 'value') and err.value is not None:
-                                output_data = err.value
-                    else:
-                        output_data = command_fn(self.model, deserialized_inputs)
-                except Exception as err:
-                    raise reraise(InferenceError, InferenceError(repr(err)), sys.exc_info()[2])
-                if type(output_data) == tuple:
-                    output_data, _ = output_data
-                return jsonify(serialize_data(output_data, outputs, output_formats=output_formats))
+                self.wait_until_running(deadline)
+                with self.lease_model(model_options) as model:
+                    # the model stays leased until the command returns, even
+                    # if the request gives up on it at its deadline
+                    output_data = self.run_in_inference_pool(
+                        self.run_command, command, command_fn, model, deserialized_inputs, output_formats, deadline,
+                        slots=command['slots'], deadline=deadline, on_done=self.retain_model(model)
+                    )
+                return json_response(output_data)
             except RunwayError as err:
                 err.print_exception()
-                return jsonify(err.to_response()), err.code
+                return json_response(err.to_response(), err.code)
         
         @self.sockets.route('/')
         def inference_socket(ws):
             session_id = generate_uuid()
-            self.jobs[session_id] = jobs_for_session = {}
-
-            def send_message(job_id, message_type, data={}):
-                ws.send(json.dumps(dict(type=message_type, id=job_id, **data)))
-
-            def start_inference(job_id, command_name, input_dict):
+            self.jobs.open_session(session_id)
+            send_lock = gevent.lock.Semaphore()
+            # Clients that connect with ?binaryFrames=1 receive image, segmentation
+            # and vector outputs as raw bytes: output messages list them in their
+            # binaryData field, and are followed by one binary frame for each.
+            binary_frames = request.args.get('binaryFrames', '').lower() in ['1', 'true']
+
+            def send_message(job_id, message_type, data={}, frames=()):
+                with send_lock:
+                    ws.send(json_dumps(dict(type=message_type, id=job_id, **data)).decode('utf8'))
+                    for frame in frames:
+                        ws.send(frame, binary=True)
+
+            def run_job(job, message, uploaded_inputs):
                 try:
                     try:
-                        command_fn = self.command_fns[command_name]
+                        command_fn = self.command_fns[job.command_name]
                     except KeyError:
-                        raise UnknownCommandError(command_name)
+                        raise UnknownCommandError(job.command_name)
 
-                    input_spec = self.commands[command_name]['inputs']
-                    output_spec = self.commands[command_name]['outputs']
-                    deserialized_inputs = deserialize_data(input_dict, input_spec)
+                    command = self.commands[job.command_name]
+                    deserialized_inputs = self.run_in_inference_pool(
+                        command['deserialize_inputs'], message.get('inputData', {}), uploaded_inputs)
                     time_start = timestamp_millis()
 
-                    def send_output(output):
+                    preview_size = command['preview_size']
+                    if message.get('previewSize') is not None:
+                        try:
+                            preview_size = int(message['previewSize']) or None
+                        except (TypeError, ValueError):
+                            raise InvalidArgumentError('previewSize', 'value must be a number of pixels')
+                    preview_quality = command['preview_quality']
+                    if message.get('previewQuality') is not None:
+                        try:
+                            preview_quality = min(max(int(message['previewQuality']), 1), 95)
+                        except (TypeError, ValueError):
+                            raise InvalidArgumentError('previewQuality', 'value must be a number from 1 to 95')
+                    if preview_size is not None:
+                        serialize_previews = compile_serializer(command['outputs'], preview_size, preview_quality,
+                                                                binary=binary_frames)
+                    if binary_frames:
+                        serialize_outputs = command['serialize_binary_outputs']
+                    else:
+                        serialize_outputs = command['serialize_outputs']
+
+                    def send_output(output, final=False):
                         progress = None
                         if type(output) == tuple:
                             output, progress = output
-                        output = serialize_data(output, output_spec)
+                        if final or preview_size is None:
+                            serialize = serialize_outputs
+                        else:
+                            serialize = serialize_previews
+                        output = self.run_in_inference_pool(serialize, output)
+                        job.check()
                         to_send = {'outputData': output}
+                        frames = ()
+                        if binary_frames:
+                            binary_data, frames = split_binary_data(output)
+                            if binary_data:
+                                to_send['binaryData'] = binary_data
                         if progress is not None:
                             to_send['progress'] = progress
-                        send_message(job_id, 'output', to_send)
+                        send_message(job.id, 'output', to_send, frames)
 
-                    if inspect.isgeneratorfunction(command_fn):
-                        g = command_fn(self.model, deserialized_inputs)
-                        try:
-                            while True:
-                                output = next(g)
-                                send_output(output)
-                        except StopIteration as err:
-                            if hasattr(err, 'value') and err.value is not None:
-                                send_output(err.value)
-                        except Exception as err:
-                            raise reraise(InferenceError, InferenceError(repr(err)), sys.exc_info()[2])
-                    else:
+                    output_interval = command['output_interval']
+                    if message.get('outputInterval') is not None:
                         try:
-                            output = command_fn(self.model, deserialized_inputs)
-                            send_output(output)
-                        except Exception as err:
-                            raise reraise(InferenceError, InferenceError(repr(err)), sys.exc_info()[2])
-
-                    send_message(job_id, 'succeeded', {
+                            output_interval = float(message['outputInterval']) / 1000.0
+                        except (TypeError, ValueError):
+                            raise InvalidArgumentError('outputInterval', 'value must be a number of milliseconds')
+                    latest_output_only = bool(message.get('latestOutputOnly', command['latest_output_only']))
+                    outputs = OutputStream(send_output, output_interval, latest_output_only,
+                                           previews=preview_size is not None)
+
+                    # waited for here so that the session's other messages
+                    # are handled while the model is set up
+                    self.wait_until_running(job.deadline)
+                    job.acquire_slot(command['slots'])
+                    with self.lease_model(message.get('modelOptions')) as model:
+                        job.check()
+                        self.run_job_command(job, command_fn, model, deserialized_inputs, outputs)
+
+                    job.finish('done')
+                    send_message(job.id, 'succeeded', {
                         'timeElapsed': timestamp_millis() - time_start
                     })
 
+                except JobCancelled:
+                    pass
+
                 except RunwayError as err:
-                    send_message(job_id, 'failed', err.to_response())
+                    job.finish('failed')
+                    send_message(job.id, 'failed', err.to_response())
                     err.print_exception()
 
                 except Exception as err:
-                    send_message(job_id, 'failed', {'error': 'An unknown error occurred'})
+                    job.finish('failed')
+                    send_message(job.id, 'failed', {'error': 'An unknown error occurred'})
                     print(err)
 
-            while not ws.closed:
-                message = ws.receive()
-                try:
-                    message = json.loads(message)
-                except:
-                    continue
-
-                if message['type'] == 'submit':
-                    command_name = message['command']
-                    input_dict = message['inputData']
-                    self.millis_last_command = timestamp_millis()
-                    if 'id' in message:
-                        job_id = message['id']
-                        if job_id in self.jobs:
-                            continue
-                    else:
-                        job_id = generate_uuid()
-                    job = self.jobs[job_id] = Process(target=start_inference, args=(job_id, command_name, input_dict))
-                    job.start()
-                    jobs_for_session[job_id] = job
-                    send_message(job_id, 'started')
-
-                elif message['type'] == 'cancel':
-                    command_name = message['id']
-                    if job_id in jobs_for_session:
-                        jobs_for_session[job_id].terminate()
-                        send_message(job_id, 'cancelled')
-
-            for job in jobs_for_session.values():
-                job.terminate()
+            try:
+                while not ws.closed:
+                    message = ws.receive()
+                    try:
+                        message = json_loads(message)
+                    except:
+                        continue
+
+                    if message['type'] == 'submit':
+                        with self.loop_monitor.label(message.get('command')):
+                            command_name = message['command']
+                            self.millis_last_command = timestamp_millis()
+                            if 'id' in message:
+                                job_id = message['id']
+                                if self.jobs.contains(session_id, job_id):
+                                    continue
+                            else:
+                                job_id = generate_uuid()
+                            try:
+                                deadline = None
+                                if message.get('deadline') is not None:
+                                    deadline = parse_deadline(message['deadline'], 'deadline')
+                                if deadline is not None:
+                                    deadline.check()
+                                # resolved now, so that later uploads can't evict them
+                                uploaded_inputs = {}
+                                if command_name in self.commands:
+                                    uploaded_inputs = self.jobs.get_inputs(
+                                        session_id, message.get('inputHandles', {}), self.commands[command_name]['inputs']
+                                    )
+                            except RunwayError as err:
+                                send_message(job_id, 'failed', err.to_response())
+                                continue
+                            job = Job(job_id, command_name, deadline)
+                            self.jobs.add(session_id, job)
+                            send_message(job_id, 'started')
+                            job.greenlet = gevent.spawn(run_job, job, message, uploaded_inputs)
+                            job.greenlet.link(lambda _, job=job: self.jobs.release(session_id, job))
+
+                    elif message['type'] == 'upload':
+                        # Handled before the next message, so that the submit
+                        # messages that follow can reference the upload
+                        with self.loop_monitor.label(message.get('command')):
+                            try:
+                                handle, nbytes = self.upload_input(session_id, message)
+                            except RunwayError as err:
+                                send_message(message.get('id'), 'failed', err.to_response())
+                                continue
+                            send_message(message.get('id'), 'uploaded', dict(handle=handle, size=nbytes))
+
+                    elif message['type'] == 'cancel':
+                        job = self.jobs.get(session_id, message.get('id'))
+                        if job is not None and job.cancel():
+                            send_message(job.id, 'cancelled')
+            finally:
+                self.jobs.close_session(session_id)
 
         @self.app.route('/<command_name>', methods=['GET'])
         def usage_route(command_name):
@@ -253,10 +419,30 @@ class RunwayModel(object):
                     command = self.commands[command_name]
                 except KeyError:
                     raise UnknownCommandError(command_name)
-                return jsonify(serialize_command(command))
+                if command_name not in self.precomputed_commands:
+                    self.precomputed_commands[command_name] = PrecomputedJSON(serialize_command(command))
+                return precomputed_json_response(self.precomputed_commands[command_name])
             except RunwayError as err:
                 err.print_exception()
-                return jsonify(err.to_response()), err.code
+                return json_response(err.to_response(), err.code)
+
+    def get_manifest(self):
+        return dict(
+            options=[opt.to_dict() for opt in self.options],
+            commands=[serialize_command(cmd) for cmd in self.commands.values()]
+        )
+
+    def get_precomputed_manifest(self):
+        """Return the static fields of the ``/meta`` response, encoded once
+        for every change to the model's options or commands.
+        """
+        if self.precomputed_manifest is None:
+            self.precomputed_manifest = PrecomputedJSON(dict(
+                modelSDKVersion=model_sdk_version,
+                GPU=os.environ.get('GPU') == '1',
+                **(self.cached_manifest or self.get_manifest())
+            ))
+        return self.precomputed_manifest
 
     def millis_running(self):
         if self.millis_run_started_at is None: return None
@@ -275,7 +461,11 @@ class RunwayModel(object):
 
         This endpoint exposes a ``/setup`` HTTP route and calls the wrapped
         (decorated) function once on ``runway.run()`` and whenever a new POST
-        request is made to the ``/setup`` route.
+        request is made to the ``/setup`` route. Models requested through the
+        ``/setup`` route are built on a background thread while the previous
+        model keeps serving commands. The new model replaces the previous one
+        only once setup succeeds, and commands that are already running finish
+        with the model they started with.
 
         .. code-block:: python
 
@@ -297,6 +487,13 @@ class RunwayModel(object):
             This is example code for demonstration purposes only. It will not
             run, as the ``your_code`` import is not a real python module.
 
+        Options of type ``runway.file`` or ``runway.directory`` that point to a
+        URL are all downloaded concurrently before the wrapped function is
+        called. At most four downloads run at the same time, which can be
+        changed with the ``RW_MAX_CONCURRENT_DOWNLOADS`` environment variable,
+        and the progress of each download is reported by the ``/healthcheck``
+        route while the model is starting.
+
         :param decorated_fn: A function to be decorated. This argument is automatically
             assigned the value of the wrapped function if the decorator syntax is used
             without a function call
@@ -312,10 +509,12 @@ class RunwayModel(object):
         """
 
         if decorated_fn:
+            self.precomputed_manifest = None
             self.options = []
             self.setup_fn = decorated_fn
         else:
             def decorator(fn):
+                self.precomputed_manifest = None
                 self.options = []
                 for name, opt in options.items():
                     opt = cast_to_obj(opt)
@@ -325,7 +524,8 @@ class RunwayModel(object):
                 return fn
             return decorator
 
-    def command(self, name, inputs={}, outputs={}, description=None):
+    def command(self, name, inputs={}, outputs={}, description=None, warmup=0, concurrency=None,
+                output_interval=0, latest_output_only=False, preview_size=None, preview_quality=60):
         """This decorator function is used to define the interface for your
         model. All functions that are wrapped by this decorator become exposed
         via HTTP requests to ``/<command_name>``. Each command that you define
@@ -395,6 +595,45 @@ class RunwayModel(object):
             If this parameter is present its value will be rendered as a tooltip
             in Runway. Defaults to None.
         :type description: string, optional
+        :param warmup: The number of times to run this command on synthetic
+            inputs after the model is set up and before it is reported as
+            ``RUNNING``, defaults to 0. Inputs are generated from each input's
+            data type (e.g. a random ``vector`` drawn from its sampling
+            distribution, a blank ``image`` of its declared size, or the default
+            ``category``) and go through the same deserialization and
+            serialization as a real request, so lazy framework initialization
+            doesn't slow down the first request.
+        :type warmup: int, optional
+        :param concurrency: The maximum number of HTTP requests to this command
+            that run at the same time, defaults to no limit other than the
+            number of inference threads (see the ``inference_threads``
+            argument of ``runway.run()``). Further requests wait for a slot.
+        :type concurrency: int, optional
+        :param output_interval: The minimum number of seconds between two
+            intermediate outputs of a generator command sent over a websocket,
+            defaults to ``0`` (no limit). Outputs yielded sooner are skipped
+            without being serialized, and the last output is always sent.
+            Clients can override it with the ``outputInterval`` field (in
+            milliseconds) of their ``submit`` messages.
+        :type output_interval: float, optional
+        :param latest_output_only: Whether to skip the intermediate outputs
+            of a generator command that are superseded by a newer one while
+            the websocket is busy sending, defaults to ``False``. Clients can
+            override it with the ``latestOutputOnly`` field of their ``submit``
+            messages.
+        :type latest_output_only: bool, optional
+        :param preview_size: If set, the intermediate outputs of a generator
+            command sent over a websocket are reduced previews: images are
+            scaled down to fit in ``preview_size`` x ``preview_size`` pixels
+            and sent as JPEGs of quality ``preview_quality``. The final output
+            is always sent in full. Defaults to ``None`` (no previews).
+            Clients can override it with the ``previewSize`` field of their
+            ``submit`` messages, ``0`` disabling previews.
+        :type preview_size: int, optional
+        :param preview_quality: The JPEG quality of previews, from 1 to 95,
+            defaults to ``60``. Clients can override it with the
+            ``previewQuality`` field of their ``submit`` messages.
+        :type preview_quality: int, optional
         :raises Exception: An exception if there isn't at least one key value
             pair for both inputs and outputs dictionaries
         :return: A decorated function
@@ -422,10 +661,21 @@ class RunwayModel(object):
             name=name,
             description=description,
             inputs=inputs_as_list,
-            outputs=outputs_as_list
+            outputs=outputs_as_list,
+            warmup=warmup,
+            slots=gevent.lock.BoundedSemaphore(concurrency) if concurrency else None,
+            output_interval=output_interval,
+            latest_output_only=latest_output_only,
+            preview_size=preview_size,
+            preview_quality=preview_quality,
+            deserialize_inputs=compile_deserializer(inputs_as_list),
+            serialize_outputs=compile_serializer(outputs_as_list),
+            serialize_binary_outputs=compile_serializer(outputs_as_list, binary=True)
         )
 
         self.commands[name] = command_info
+        self.precomputed_manifest = None
+        self.precomputed_commands.pop(name, None)
 
         def decorator(fn):
             self.command_fns[name] = fn
@@ -433,35 +683,564 @@ class RunwayModel(object):
 
         return decorator
 
-    def setup_model(self, opts):
-        self.running_status = 'STARTING'
+    def prefetch_options(self, remote_opts):
+        """Resolve all URL-backed options concurrently, recording the progress
+        of each transfer in ``self.setup_progress``. The number of transfers
+        actually in flight is capped by ``RW_MAX_CONCURRENT_DOWNLOADS``.
+        """
+        self.setup_progress = {name: DownloadProgress() for name in remote_opts}
+        if len(remote_opts) == 0:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(remote_opts)) as executor:
+            futures = {}
+            for name, (opt, value) in remote_opts.items():
+                progress = self.setup_progress[name]
+                futures[name] = executor.submit(opt.deserialize, value, progress=progress)
+        return {name: future.result() for name, future in futures.items()}
+
+    def deserialize_options(self, opts):
+        deserialized_opts = {}
+        remote_opts = {}
+        for opt in self.options:
+            name = opt.name
+            if name in opts:
+                value = opts[name]
+            elif hasattr(opt, 'default'):
+                # defaults are deserialized like supplied values, e.g. so that
+                # a default path of a file(mmap=True) option is mapped too
+                value = opt.default
+                if value is None:
+                    deserialized_opts[name] = None
+                    continue
+            else:
+                raise MissingOptionError(name)
+            if isinstance(opt, file) and is_url(value):
+                remote_opts[name] = (opt, value)
+            else:
+                deserialized_opts[name] = opt.deserialize(value)
+        deserialized_opts.update(self.prefetch_options(remote_opts))
+        return deserialized_opts
+
+    def get_snapshot_dir(self, opts):
+        """Return the snapshot directory of a model set up with ``opts``. It
+        is keyed by the options, the version of the files they point to (see
+        ``get_resource_version()``), the model's source files and the SDK's
+        version. Returns ``None`` if the version of a remote file is unknown.
+        """
+        key = [self.get_options_key(opts)]
+        for opt in self.options:
+            if not isinstance(opt, file):
+                continue
+            value = opts.get(opt.name, getattr(opt, 'default', None))
+            if value is None:
+                continue
+            version = get_resource_version(value)
+            if version is None:
+                return None
+            key.append('%s=%s' % (opt.name, version))
+        key.extend([get_code_hash(self.setup_fn), model_sdk_version])
+        return os.path.join(self.snapshot_dir, hashlib.sha1('\n'.join(key).encode('utf8')).hexdigest())
+
+    def build_model(self, opts):
+        model = self.restore_or_run_setup_fn(opts)
+        self.warm_up_model(model)
+        return model
+
+    def restore_or_run_setup_fn(self, opts):
+        """Set up a model with the given options. If a snapshot directory is
+        configured, a model previously set up with the same options, files
+        and source code is restored from its snapshot instead, and newly set
+        up models are saved there.
+        """
+        self.restored_snapshot = None
+        if self.snapshot_dir is None or self.setup_fn is None:
+            return self.run_setup_fn(opts)
+        try:
+            snapshot_dir = self.get_snapshot_dir(opts)
+        except RunwayError:
+            raise
+        except Exception as err:
+            print('Unable to check the version of the model\'s files, running setup without a snapshot: %r' % err)
+            snapshot_dir = None
+        if snapshot_dir is None:
+            return self.run_setup_fn(opts)
+        if os.path.isdir(snapshot_dir):
+            try:
+                model = load_snapshot(snapshot_dir)
+                self.restored_snapshot = load_snapshot_metadata(snapshot_dir)
+                return model
+            except Exception as err:
+                print('Unable to restore model snapshot, running setup instead: %r' % err)
+        setup_start = time.time()
+        model = self.run_setup_fn(opts)
+        metadata = dict(setupDuration=time.time() - setup_start)
+        try:
+            save_snapshot(model, snapshot_dir, metadata=metadata)
+        except Exception as err:
+            print('Unable to save model snapshot: %r' % err)
+        return model
+
+    def run_setup_fn(self, opts):
         if self.setup_fn and self.options:
-            deserialized_opts = {}
-            for opt in self.options:
-                name = opt.name
-                opt = cast_to_obj(opt)
-                opt.name = name
-                if name in opts:
-                    deserialized_opts[name] = opt.deserialize(opts[name])
-                elif hasattr(opt, 'default'):
-                    deserialized_opts[name] = opt.default
-                else:
-                    raise MissingOptionError(name)
+            deserialized_opts = self.deserialize_options(opts)
             try:
-                self.model = self.setup_fn(deserialized_opts)
+                return self.setup_fn(deserialized_opts)
             except Exception as err:
                 raise reraise(SetupError, SetupError(repr(err)), sys.exc_info()[2])
         elif self.setup_fn:
             try:
                 if len(argspec(self.setup_fn).args) == 0:
-                    self.model = self.setup_fn()
+                    return self.setup_fn()
                 else:
-                    self.model = self.setup_fn({})
+                    return self.setup_fn({})
             except Exception as err:
                 raise reraise(SetupError, SetupError(repr(err)), sys.exc_info()[2])
+        return None
+
+    def run_command_fn(self, command_fn, model, inputs, check=None):
+        """Run a command function and return its output. Generator commands
+        are run to completion, and ``check``, if given, is called after each of
+        their yields: if it raises, the generator is closed and the exception
+        propagated.
+        """
+        if inspect.isgeneratorfunction(command_fn):
+            g = command_fn(model, inputs)
+            try:
+                while True:
+                    output_data = next(g)
+                    if check is not None:
+                        try:
+                            check()
+                        except:
+                            g.close()
+                            raise
+            except StopIteration as err:
+                if hasattr(err, 'value') and err.value is not None:
+                    output_data = err.value
+        else:
+            output_data = command_fn(model, inputs)
+        if type(output_data) == tuple:
+            output_data, _ = output_data
+        return output_data
+
+    def run_command(self, command, command_fn, model, inputs, output_formats=None, deadline=None):
+        """Run a command on deserialized inputs and return its serialized
+        outputs. Exceptions raised by the command are wrapped in an
+        ``InferenceError``. If a ``deadline`` is given, generator commands
+        are stopped at the first yield after it passes, and outputs are only
+        serialized if it hasn't passed.
+        """
+        check = deadline.check if deadline is not None else None
+        try:
+            output_data = self.run_command_fn(command_fn, model, inputs, check)
+        except DeadlineExceededError:
+            raise
+        except Exception as err:
+            raise reraise(InferenceError, InferenceError(repr(err)), sys.exc_info()[2])
+        if deadline is not None:
+            deadline.check()
+        return command['serialize_outputs'](output_data, output_formats=output_formats)
+
+    def get_inference_pool(self):
+        if self.inference_pool is None:
+            from gevent.threadpool import ThreadPool
+            register_fork_hook()
+            self.inference_pool = ThreadPool(self.inference_threads)
+        return self.inference_pool
+
+    def run_in_inference_pool(self, fn, *args, slots=None, deadline=None, on_done=None):
+        """Call ``fn(*args)`` on a native thread of the inference pool and
+        wait for its result without blocking the gevent hub, so that the server
+        keeps answering other requests (e.g. ``/healthcheck``) meanwhile. If
+        ``slots`` is a semaphore, a slot is held for the duration of the call.
+
+        If a ``deadline`` is given, ``DeadlineExceededError`` is raised as
+        soon as it passes, and calls still waiting for a slot or a thread at
+        that point are dropped without running.
+
+        ``on_done``, if given, is called once the call returns, even if the
+        caller stopped waiting for it, e.g. to release the lease on a model
+        that the call still uses (see ``retain_model()``). It is called right
+        away if ``fn`` doesn't run.
+        """
+        if deadline is None and slots is None and on_done is None:
+            return self.get_inference_pool().apply(fn, args)
+        done_callbacks = [on_done] if on_done is not None else []
+
+        def finish(_=None):
+            while done_callbacks:
+                done_callbacks.pop()()
+
+        try:
+            if slots is not None:
+                if deadline is None:
+                    slots.acquire()
+                elif not slots.acquire(timeout=deadline.remaining()):
+                    raise DeadlineExceededError(deadline.millis)
+                done_callbacks.append(slots.release)
+            if deadline is None:
+                result = self.get_inference_pool().spawn(fn, *args)
+            else:
+                result = self.get_inference_pool().spawn(call_before_deadline, deadline, fn, *args)
+        except:
+            finish()
+            raise
+        # the slot and anything released by on_done are held until the call
+        # actually returns, even if we stop waiting for it
+        result.rawlink(finish)
+        try:
+            value = result.get(timeout=deadline.remaining() if deadline is not None else None)
+        except gevent.Timeout:
+            raise DeadlineExceededError(deadline.millis)
+        finally:
+            if result.ready():
+                finish()
+        if value is DEADLINE_EXCEEDED:
+            raise DeadlineExceededError(deadline.millis)
+        return value
+
+    def upload_input(self, session_id, message):
+        """Deserialize the ``data`` of a websocket ``upload`` message as the
+        input ``input`` of the command ``command``, and keep it for the
+        session under the message's ``handle``, or a new one. Returns the
+        handle and the estimated size of the input in bytes.
+        """
+        command_name = message.get('command')
+        if command_name not in self.commands:
+            raise UnknownCommandError(command_name)
+        fields = {inp.name: inp for inp in self.commands[command_name]['inputs']}
+        input_name = message.get('input')
+        if input_name not in fields:
+            raise InvalidArgumentError('input', 'value must be the name of an input of %s' % command_name)
+        if 'data' not in message:
+            raise MissingInputError(input_name)
+
+        def deserialize(data):
+            value = fields[input_name].deserialize(data)
+            return value, estimate_size(value)
+
+        try:
+            value, nbytes = self.run_in_inference_pool(deserialize, message['data'])
+        except RunwayError:
+            raise
+        except Exception:
+            raise InvalidArgumentError(input_name, 'value could not be deserialized')
+        handle = message.get('handle') or generate_uuid()
+        self.jobs.put_input(session_id, handle, fields[input_name], value, nbytes)
+        return handle, nbytes
+
+    def run_job_command(self, job, command_fn, model, inputs, outputs):
+        """Run the command of a websocket job, sending its outputs to the
+        ``OutputStream`` ``outputs``. Generator commands are advanced one
+        yield at a time on the inference pool, and closed at the first yield
+        after the job is cancelled or its deadline passes, so that their
+        ``finally`` blocks and context managers release what they hold.
+
+        Calls still queued for an inference thread when the job's deadline
+        passes are dropped without running. The job fails as soon as the
+        deadline passes while other commands run. Generator commands finish
+        the step they are running first, since they can't be closed while
+        it runs.
+        """
+        deadline = job.deadline
+        if not inspect.isgeneratorfunction(command_fn):
+            try:
+                output = self.run_in_inference_pool(command_fn, model, inputs, deadline=deadline,
+                                                    on_done=self.retain_model(model))
+            except DeadlineExceededError:
+                raise
+            except Exception as err:
+                raise reraise(InferenceError, InferenceError(repr(err)), sys.exc_info()[2])
+            job.check()
+            outputs.deliver(output, final=True)
+            return
+        g = command_fn(model, inputs)
+        try:
+            while True:
+                try:
+                    step = self.run_in_inference_pool(call_before_deadline, deadline, next_output, g)
+                except Exception as err:
+                    raise reraise(InferenceError, InferenceError(repr(err)), sys.exc_info()[2])
+                if step is DEADLINE_EXCEEDED:
+                    raise DeadlineExceededError(deadline.millis)
+                finished, output = step
+                job.check()
+                if finished:
+                    outputs.close(output)
+                    return
+                outputs.put(output)
+        finally:
+            self.run_in_inference_pool(g.close)
+
+    def warm_up_model(self, model):
+        """Run each command declared with ``warmup=N`` N times on synthetic
+        inputs. A command that fails to warm up is reported and skipped, and
+        fails again when it is actually requested.
+        """
+        for name, command in self.commands.items():
+            if command['warmup'] == 0 or name not in self.command_fns:
+                continue
+            try:
+                for _ in range(command['warmup']):
+                    input_dict = {inp.name: inp.warmup_value() for inp in command['inputs']}
+                    inputs = command['deserialize_inputs'](input_dict)
+                    output_data = self.run_command_fn(self.command_fns[name], model, inputs)
+                    command['serialize_outputs'](output_data)
+            except Exception as err:
+                print('Unable to warm up command %s: %r' % (name, err))
+
+    def get_options_key(self, opts):
+        """Return a canonical key identifying a set of setup options, with
+        defaults filled in for any options that are missing.
+        """
+        canonical_opts = {}
+        for opt in self.options:
+            if opt.name in opts:
+                canonical_opts[opt.name] = opts[opt.name]
+            elif hasattr(opt, 'default'):
+                canonical_opts[opt.name] = opt.default
+            else:
+                raise MissingOptionError(opt.name)
+        return json.dumps(canonical_opts, sort_keys=True, default=repr)
+
+    def get_or_build_model(self, opts, build_fn):
+        key = self.get_options_key(opts)
+        # the current model may have been evicted from the cache by a variant
+        if self.model is not None and not self.model_unloaded \
+                and key == self.get_options_key(self.model_options):
+            return self.model
+        if key in self.model_cache:
+            return self.model_cache.get(key)
+        model = build_fn(opts)
+        self.model_cache.put(key, model)
+        return model
+
+    def run_setup_step(self, fn, *args):
+        """Call ``fn(*args)`` to set up or restore a model without blocking
+        the server. If ``setup_on_inference_thread`` is set, it is called on
+        the inference thread that runs commands, so that thread-local state
+        created by setup (e.g. a TensorFlow 1 default graph or session) is
+        visible to them.
+        """
+        if self.setup_on_inference_thread:
+            return self.run_in_inference_pool(fn, *args)
+        return run_off_hub(fn, *args)
+
+    def build_model_in_background(self, opts):
+        return self.run_setup_step(self.build_model, opts)
+
+    def get_model_variant(self, model_options):
+        if type(model_options) != dict:
+            raise InvalidArgumentError('model options', 'value must be an object')
+        opts = dict(self.model_options)
+        opts.update(model_options)
+        if self.get_options_key(opts) == self.get_options_key(self.model_options):
+            if self.model_unloaded:
+                self.reload_model()
+            return self.model
+        with self.setup_lock:
+            return self.get_or_build_model(opts, self.build_model_in_background)
+
+    def is_model_retained(self, model):
+        return model is self.model or self.model_cache.contains_value(model)
+
+    @contextmanager
+    def lease_model(self, model_options=None):
+        """Pin a model for the duration of a request. If the model is swapped
+        out while the request is in flight, the request keeps using the model
+        it started with, and that model is released once its last request
+        finishes.
+
+        By default the current model is leased. If ``model_options`` are
+        given, the model variant set up with the current options updated by
+        ``model_options`` is leased instead, and set up if it isn't cached.
+        """
+        if model_options is None:
+            if self.model_unloaded:
+                self.reload_model()
+            model = self.model
+        else:
+            model = self.get_model_variant(model_options)
+        release = self.retain_model(model)
+        try:
+            yield model
+        finally:
+            del model
+            release()
+
+    def retain_model(self, model):
+        """Lease ``model`` until the returned function is called, e.g. by a
+        call on the inference pool that outlives the request that made it.
+        The model is released once its last lease is, unless it is still the
+        current model or cached.
+        """
+        key = id(model)
+        self.model_leases[key] += 1
+        leased = [model]
+
+        def release():
+            self.model_leases[key] -= 1
+            if self.model_leases[key] == 0:
+                del self.model_leases[key]
+                if not self.is_model_retained(leased.pop()):
+                    gc.collect()
+
+        return release
+
+    def swap_model(self, model, opts):
+        previous_model = self.model
+        self.model = model
+        self.model_options = opts
+        self.model_unloaded = False
+        self.discard_model_snapshot()
+        if previous_model is not None and self.model_leases[id(previous_model)] == 0 \
+                and not self.is_model_retained(previous_model):
+            del previous_model
+            gc.collect()
+
+    def setup_model(self, opts):
+        if self.running_status != 'RUNNING':
+            self.running_status = 'STARTING'
+        build_fn = self.build_model
+        if self.setup_on_inference_thread:
+            build_fn = self.build_model_in_background
+        self.swap_model(self.get_or_build_model(opts, build_fn), opts)
         self.running_status = 'RUNNING'
+        self.setup_finished.set()
 
-    def run(self, host='0.0.0.0', port=9000, model_options={}, debug=False, meta=False, no_serve=False):
+    def setup_model_in_background(self, opts):
+        """Build a new model on a background thread while the current model
+        keeps serving requests, then swap it in. If setup fails, the current
+        model stays in place, and if there is no current model the status
+        becomes ``FAILED``. Concurrent calls are serialized.
+        """
+        with self.setup_lock:
+            if self.running_status != 'RUNNING':
+                self.running_status = 'STARTING'
+                self.setup_finished.clear()
+            try:
+                model = self.get_or_build_model(opts, self.build_model_in_background)
+                self.swap_model(model, opts)
+                self.running_status = 'RUNNING'
+            except RunwayError:
+                if self.running_status == 'STARTING':
+                    self.running_status = 'FAILED'
+                raise
+            finally:
+                self.setup_finished.set()
+
+    def initialize_model_in_background(self, opts):
+        initialization_start = time.time()
+        try:
+            self.setup_model_in_background(opts)
+        except RunwayError as err:
+            err.print_exception()
+            return
+        self.print_initialization_time(time.time() - initialization_start)
+
+    def wait_until_running(self, deadline=None):
+        """Wait up to ``self.setup_timeout`` seconds for a model that is being
+        set up in the background, raising ``ModelNotReadyError`` if it isn't
+        running by then, or ``DeadlineExceededError`` if ``deadline`` passes
+        first.
+        """
+        if self.running_status == 'STARTING' and self.setup_timeout > 0:
+            timeout = self.setup_timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline.remaining())
+            self.setup_finished.wait(timeout)
+            if deadline is not None and self.running_status == 'STARTING':
+                deadline.check()
+        if self.running_status != 'RUNNING':
+            raise ModelNotReadyError(self.running_status)
+
+    def print_initialization_time(self, initialization_duration):
+        if initialization_duration < 5:
+            initialization_color = '\033[92m'
+        elif initialization_duration < 10:
+            initialization_color = '\033[93m'
+        else:
+            initialization_color = '\033[91m'
+
+        if self.restored_snapshot is not None:
+            print('Model initialized %s(%.2fs restoring snapshot, %.2fs setup)\033[0m' % (
+                initialization_color,
+                initialization_duration,
+                self.restored_snapshot['setupDuration'],
+            ))
+        else:
+            print('Model initialized %s(%.2fs)\033[0m' % (
+                initialization_color,
+                initialization_duration,
+            ))
+
+    def discard_model_snapshot(self):
+        if self.model_snapshot_path is not None:
+            shutil.rmtree(self.model_snapshot_path, ignore_errors=True)
+            self.model_snapshot_path = None
+
+    def is_idle(self, idle_timeout):
+        if self.model_unloaded or self.running_status != 'RUNNING':
+            return False
+        if len(self.model_leases) > 0 or self.setup_lock.locked():
+            return False
+        millis_idle = self.millis_since_last_command()
+        if millis_idle is None:
+            millis_idle = self.millis_running()
+        return millis_idle is not None and millis_idle >= idle_timeout * 1000
+
+    def unload_model(self, snapshot=False):
+        """Release the current model and all cached model variants to free the
+        memory they hold. The model is set up again the next time a command
+        needs it. If ``snapshot`` is True, the model is first saved to a
+        local snapshot and restored from it instead, falling back to running
+        setup if the model can't be pickled.
+        """
+        with self.setup_lock:
+            if snapshot:
+                path = os.path.join(tempfile.gettempdir(), 'runway-idle-model-%s' % generate_uuid())
+                try:
+                    run_off_hub(save_snapshot, self.model, path)
+                    self.model_snapshot_path = path
+                except Exception as err:
+                    print('Unable to snapshot idle model, it will be set up again when needed: %r' % err)
+            self.model = None
+            self.model_cache.clear()
+            self.model_unloaded = True
+            gc.collect()
+
+    def reload_model(self):
+        """Set up (or restore from its snapshot) a model released by
+        ``unload_model()``. Concurrent callers wait for a single reload.
+        """
+        with self.setup_lock:
+            if not self.model_unloaded:
+                return
+            model = None
+            restored = False
+            if self.model_snapshot_path is not None:
+                try:
+                    model = self.run_setup_step(load_snapshot, self.model_snapshot_path)
+                    restored = True
+                except Exception as err:
+                    print('Unable to restore idle model snapshot, setting it up again: %r' % err)
+            if not restored:
+                model = self.build_model_in_background(self.model_options)
+            self.model_cache.put(self.get_options_key(self.model_options), model)
+            self.swap_model(model, self.model_options)
+
+    def unload_when_idle(self, idle_timeout, snapshot=False):
+        check_interval = max(0.01, min(1, idle_timeout / 10.0))
+        while True:
+            gevent.sleep(check_interval)
+            if self.is_idle(idle_timeout):
+                print('Unloading model after %ss without commands...' % idle_timeout)
+                self.unload_model(snapshot=snapshot)
+
+    def run(self, host='0.0.0.0', port=9000, model_options={}, debug=False, meta=False, no_serve=False,
+            model_cache_size=1, model_cache_memory=None, idle_timeout=None, idle_snapshot=False,
+            snapshot_dir=None, background_setup=False, setup_timeout=0, manifest_path=None,
+            inference_threads=1, setup_on_inference_thread=False, loop_block_threshold=0.1):
         """Run the model and start listening for HTTP requests on the network.
         By default, the server will run on port ``9000`` and listen on all
         network interfaces (``0.0.0.0``).
@@ -514,6 +1293,93 @@ class RunwayModel(object):
             mock HTTP requests using Flask's ``app.test_client()``
             (see Flask's testing_ docs for more details).
         :type meta: boolean, optional
+        :param model_cache_size: The number of models set up with different
+            options to keep in memory, defaults to ``1``. Switching back to a
+            cached set of options with a POST request to ``/setup`` is instant.
+            Commands can use a cached model without switching to it by sending
+            the options to update as a JSON object in the
+            ``X-Runway-Model-Options`` header (or the ``modelOptions`` field of
+            a WebSocket ``submit`` message). This value will be overwritten by
+            the ``RW_MODEL_CACHE_SIZE`` environment variable if it is present.
+        :type model_cache_size: int, optional
+        :param model_cache_memory: The maximum estimated size in bytes of all
+            cached models, defaults to ``None`` (unbounded). The least recently
+            used models are released first when the budget is exceeded. This
+            value will be overwritten by the ``RW_MODEL_CACHE_MEMORY``
+            environment variable if it is present.
+        :type model_cache_memory: int, optional
+        :param idle_timeout: The number of seconds without commands after which
+            the model is released to free its memory, defaults to ``None``
+            (never). The model is set up again transparently by the next
+            command, and concurrent commands wait for a single reload. This
+            value will be overwritten by the ``RW_IDLE_TIMEOUT`` environment
+            variable if it is present.
+        :type idle_timeout: float, optional
+        :param idle_snapshot: Save an idle model to a local snapshot before
+            releasing it and restore it from there instead of running setup
+            again, defaults to ``False``. This value will be overwritten by the
+            ``RW_IDLE_SNAPSHOT`` environment variable if it is present.
+        :type idle_snapshot: boolean, optional
+        :param snapshot_dir: A directory in which to cache snapshots of set up
+            models, defaults to ``None`` (disabled). After a model is set up,
+            the object returned by ``@runway.setup()`` is pickled to a
+            snapshot keyed by the setup options, the ETag or Last-Modified
+            header (for URLs) or the size and modification time (for local
+            paths) of the files they point to, and the source of the file
+            defining the setup function and of the modules loaded from its
+            directory. Later runs with the same key restore the snapshot
+            instead of running setup, memory-mapping numpy arrays larger than
+            1MB. Models with remote files served without either header are
+            never snapshotted, and modules only imported by the setup function
+            itself aren't part of the key. This value will be overwritten by
+            the ``RW_SNAPSHOT_DIR`` environment variable if it is present.
+        :type snapshot_dir: string, optional
+        :param background_setup: Start serving right away and set up the model
+            in the background, defaults to ``False``. While setup runs,
+            ``/healthcheck`` reports a ``STARTING`` status along with the
+            progress of any downloads, and becomes ``FAILED`` if setup fails.
+            This value will be overwritten by the ``RW_BACKGROUND_SETUP``
+            environment variable if it is present.
+        :type background_setup: boolean, optional
+        :param setup_timeout: The number of seconds commands wait for a model
+            that is being set up in the background before failing with a 503
+            error, defaults to ``0`` (fail right away). This value will be
+            overwritten by the ``RW_SETUP_TIMEOUT`` environment variable if it
+            is present.
+        :type setup_timeout: float, optional
+        :param manifest_path: A manifest file written by
+            ``python -m runway.meta --output``, defaults to ``None``. If
+            present, the ``/meta`` route serves the options and commands in
+            this file as they are. This value will be overwritten by the
+            ``RW_MANIFEST_PATH`` environment variable if it is present.
+        :type manifest_path: string, optional
+        :param inference_threads: The number of native threads on which HTTP
+            commands are run, defaults to ``1``, so that commands run one at a
+            time as they always have. Commands run off the server's event loop,
+            which keeps answering other requests meanwhile. Raise this value
+            for models that are safe to call concurrently, and limit individual
+            commands with the ``concurrency`` argument of
+            ``@runway.command()``. This value will be overwritten by the
+            ``RW_INFERENCE_THREADS`` environment variable if it is present.
+        :type inference_threads: int, optional
+        :param setup_on_inference_thread: Set up the model on the inference
+            thread that runs its commands, defaults to ``False``. Enable it
+            for models whose setup creates thread-local state that commands
+            rely on, such as a TensorFlow 1 default graph or session. Requires
+            ``inference_threads=1``, and models requested by a POST request to
+            ``/setup`` then wait for running commands to finish, and commands
+            wait for them to be set up. This value will be overwritten by the
+            ``RW_SETUP_ON_INFERENCE_THREAD`` environment variable if it is
+            present.
+        :type setup_on_inference_thread: boolean, optional
+        :param loop_block_threshold: The number of seconds after which the
+            server's event loop is reported as blocked, defaults to ``0.1``.
+            Each time the loop doesn't switch between requests for this long, a
+            warning with the stack of the blocking code and the command being
+            served is logged and added to the ``/metrics`` route. ``0``
+            disables the detector. This value will be overwritten by the
+            ``RW_LOOP_BLOCK_THRESHOLD`` environment variable if it is present.
+        :type loop_block_threshold: float, optional
 
         .. _testing: http://flask.pocoo.org/docs/1.0/testing/
 
@@ -546,14 +1412,64 @@ class RunwayModel(object):
             - ``RW_NO_SERVE``: Forces ``runway.run()`` to not start its Flask
               server. This environment variable overwrites any value passed as
               the ``no_serve`` keyword argument.
+            - ``RW_MODEL_CACHE_SIZE``: Defines the number of models to keep in
+              memory. This environment variable overwrites any value passed as
+              the ``model_cache_size`` keyword argument.
+            - ``RW_MODEL_CACHE_MEMORY``: Defines the memory budget in bytes of
+              the cached models. This environment variable overwrites any value
+              passed as the ``model_cache_memory`` keyword argument.
+            - ``RW_IDLE_TIMEOUT``: Defines the number of seconds without
+              commands after which the model is released. This environment
+              variable overwrites any value passed as the ``idle_timeout``
+              keyword argument.
+            - ``RW_IDLE_SNAPSHOT``: Defines whether idle models are saved to a
+              local snapshot before they are released. ``RW_IDLE_SNAPSHOT=1``
+              enables snapshots. This environment variable overwrites any value
+              passed as the ``idle_snapshot`` keyword argument.
+            - ``RW_SNAPSHOT_DIR``: Defines the directory in which snapshots of
+              set up models are cached. This environment variable overwrites
+              any value passed as the ``snapshot_dir`` keyword argument.
+            - ``RW_BACKGROUND_SETUP``: Defines whether the model is set up in
+              the background while the server starts. ``RW_BACKGROUND_SETUP=1``
+              enables background setup. This environment variable overwrites
+              any value passed as the ``background_setup`` keyword argument.
+            - ``RW_SETUP_TIMEOUT``: Defines the number of seconds commands wait
+              for background setup to finish. This environment variable
+              overwrites any value passed as the ``setup_timeout`` keyword
+              argument.
+            - ``RW_MANIFEST_PATH``: Defines the manifest file served by the
+              ``/meta`` route. This environment variable overwrites any value
+              passed as the ``manifest_path`` keyword argument.
+            - ``RW_INFERENCE_THREADS``: Defines the number of threads on which
+              commands are run. This environment variable overwrites any value
+              passed as the ``inference_threads`` keyword argument.
+            - ``RW_SETUP_ON_INFERENCE_THREAD``: Defines whether the model is
+              set up on the inference thread. ``RW_SETUP_ON_INFERENCE_THREAD=1``
+              enables it. This environment variable overwrites any value passed
+              as the ``setup_on_inference_thread`` keyword argument.
+            - ``RW_LOOP_BLOCK_THRESHOLD``: Defines the number of seconds after
+              which the event loop is reported as blocked. This environment
+              variable overwrites any value passed as the
+              ``loop_block_threshold`` keyword argument.
         """
 
-        env_host          = os.getenv('RW_HOST')
-        env_port          = os.getenv('RW_PORT')
-        env_meta          = os.getenv('RW_META')
-        env_debug         = os.getenv('RW_DEBUG')
-        env_no_serve      = os.getenv('RW_NO_SERVE')
-        env_model_options = os.getenv('RW_MODEL_OPTIONS')
+        env_host                      = os.getenv('RW_HOST')
+        env_port                      = os.getenv('RW_PORT')
+        env_meta                      = os.getenv('RW_META')
+        env_debug                     = os.getenv('RW_DEBUG')
+        env_no_serve                  = os.getenv('RW_NO_SERVE')
+        env_model_options             = os.getenv('RW_MODEL_OPTIONS')
+        env_model_cache_size          = os.getenv('RW_MODEL_CACHE_SIZE')
+        env_model_cache_memory        = os.getenv('RW_MODEL_CACHE_MEMORY')
+        env_idle_timeout              = os.getenv('RW_IDLE_TIMEOUT')
+        env_idle_snapshot             = os.getenv('RW_IDLE_SNAPSHOT')
+        env_snapshot_dir              = os.getenv('RW_SNAPSHOT_DIR')
+        env_background_setup          = os.getenv('RW_BACKGROUND_SETUP')
+        env_setup_timeout             = os.getenv('RW_SETUP_TIMEOUT')
+        env_manifest_path             = os.getenv('RW_MANIFEST_PATH')
+        env_inference_threads         = os.getenv('RW_INFERENCE_THREADS')
+        env_setup_on_inference_thread = os.getenv('RW_SETUP_ON_INFERENCE_THREAD')
+        env_loop_block_threshold      = os.getenv('RW_LOOP_BLOCK_THRESHOLD')
 
         if env_host is not None:
             host = env_host
@@ -567,33 +1483,68 @@ class RunwayModel(object):
             no_serve = bool(int(env_no_serve))
         if env_model_options is not None:
             model_options = json.loads(env_model_options)
+        if env_model_cache_size is not None:
+            model_cache_size = int(env_model_cache_size)
+        if env_model_cache_memory is not None:
+            model_cache_memory = int(env_model_cache_memory)
+        if env_idle_timeout is not None:
+            idle_timeout = float(env_idle_timeout)
+        if env_idle_snapshot is not None:
+            idle_snapshot = bool(int(env_idle_snapshot))
+        if env_snapshot_dir is not None:
+            snapshot_dir = env_snapshot_dir
+        if env_background_setup is not None:
+            background_setup = bool(int(env_background_setup))
+        if env_setup_timeout is not None:
+            setup_timeout = float(env_setup_timeout)
+        if env_manifest_path is not None:
+            manifest_path = env_manifest_path
+        if env_inference_threads is not None:
+            inference_threads = int(env_inference_threads)
+        if env_setup_on_inference_thread is not None:
+            setup_on_inference_thread = bool(int(env_setup_on_inference_thread))
+        if env_loop_block_threshold is not None:
+            loop_block_threshold = float(env_loop_block_threshold)
+
+        if inference_threads < 1:
+            raise InvalidArgumentError('inference_threads', 'value must be at least 1')
+        if setup_on_inference_thread and inference_threads != 1:
+            raise InvalidArgumentError('setup_on_inference_thread', 'inference_threads must be 1')
+
+        self.model_cache.max_size = model_cache_size
+        self.model_cache.max_bytes = model_cache_memory
+        self.snapshot_dir = snapshot_dir
+        self.setup_timeout = setup_timeout
+        self.inference_threads = inference_threads
+        self.setup_on_inference_thread = setup_on_inference_thread
+        if self.inference_pool is not None:
+            self.inference_pool.maxsize = inference_threads
+        self.loop_monitor.threshold = loop_block_threshold
 
         if meta:
-            print(json.dumps(dict(
-                options=[opt.to_dict() for opt in self.options],
-                commands=[serialize_command(cmd) for cmd in self.commands.values()]
-            )))
+            print(json.dumps(self.get_manifest()))
             return
 
-        print('Initializing model...')
+        if manifest_path is not None:
+            with open(manifest_path) as f:
+                self.cached_manifest = json.load(f)
+            self.precomputed_manifest = None
 
-        initialization_start = time.time()
-        try:
-            self.setup_model(model_options)
-        except RunwayError as err:
-            err.print_exception()
-            sys.exit(1)
-        initialization_duration = time.time() - initialization_start
-        if initialization_duration < 5:
-            initialization_color = '\033[92m'
-        elif initialization_duration < 10:
-            initialization_color = '\033[93m'
+        # there is no server to answer requests while setup runs if we aren't
+        # going to serve, so set up the model in the foreground in that case
+        background_setup = background_setup and not no_serve
+
+        if background_setup:
+            print('Initializing model in the background...')
         else:
-            initialization_color = '\033[91m'
-        print('Model initialized %s(%.2fs)\033[0m' % (
-            initialization_color,
-            initialization_duration,
-        ))
+            print('Initializing model...')
+            initialization_start = time.time()
+            try:
+                self.setup_model(model_options)
+            except RunwayError as err:
+                err.print_exception()
+                sys.exit(1)
+            self.print_initialization_time(time.time() - initialization_start)
 
         # start the run started at millis timer even if we don't actually serve
         self.millis_run_started_at = timestamp_millis()
@@ -602,18 +1553,30 @@ class RunwayModel(object):
             print('Not starting model server because "no_serve" directive is present.')
             return
 
+        from gevent.pywsgi import WSGIServer
+        from geventwebsocket.handler import WebSocketHandler
+        register_fork_hook()
+
         def run_server():
+            if loop_block_threshold:
+                self.loop_monitor.start()
             http_server = WSGIServer((host, port), self.app, handler_class=WebSocketHandler)
+            # spawned here rather than in run() since the reloader of debug
+            # mode serves from a new process and never returns
+            if background_setup:
+                gevent.spawn(self.initialize_model_in_background, model_options)
+            if idle_timeout:
+                gevent.spawn(self.unload_when_idle, idle_timeout, idle_snapshot)
             try:
                 http_server.serve_forever()
             except KeyboardInterrupt:
                 print('Stopping server...')
-                for jobs_for_session in self.jobs.values():
-                    for job in jobs_for_session.values():
-                        job.terminate()
+                for session_id in list(self.jobs.sessions):
+                    self.jobs.close_session(session_id)
 
         if debug:
             logging.basicConfig(level=logging.DEBUG)
+            import werkzeug.serving
             run_server = werkzeug.serving.run_with_reloader(run_server)
         else:
             logging.basicConfig(level=logging.INFO)
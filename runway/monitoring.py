@@ -0,0 +1,116 @@
+"""Detection of code that blocks the gevent event loop of the model server.
+
+The server runs on a single gevent hub without monkey patching, so any request
+handler that doesn't yield (decoding a large image, parsing a huge JSON body,
+running a model on the hub...) stalls every other connection. The
+``LoopBlockMonitor`` uses gevent's monitoring thread to notice when the hub
+hasn't switched greenlets for longer than a threshold, and records the stack
+of the blocking code along with the route or command it was serving.
+"""
+
+import sys
+import time
+import logging
+import warnings
+import traceback
+import weakref
+from collections import deque
+from contextlib import contextmanager
+import gevent
+
+logger = logging.getLogger(__name__)
+
+
+class LoopBlockMonitor(object):
+    """Records the times the gevent hub was blocked for longer than
+    ``threshold`` seconds.
+
+    :param threshold: The number of seconds without a greenlet switch after
+        which the hub is reported as blocked
+    :type threshold: float
+    :param max_reports: The number of most recent reports kept for
+        ``/metrics``
+    :type max_reports: int
+    """
+
+    def __init__(self, threshold=0.1, max_reports=20):
+        self.threshold = threshold
+        self.hub = None
+        self.blocked_count = 0
+        self.reports = deque(maxlen=max_reports)
+        self.labels = weakref.WeakKeyDictionary()
+
+    @property
+    def running(self):
+        return self.hub is not None
+
+    def start(self):
+        """Start watching the hub of the current thread."""
+        import gevent.events
+        if self.running:
+            return
+        self.hub = gevent.get_hub()
+        gevent.config.monitor_thread = True
+        gevent.config.max_blocking_time = self.threshold
+        # reports are logged by on_event() instead of printed by gevent
+        gevent.config.print_blocking_reports = False
+        gevent.events.subscribers.append(self.on_event)
+        with warnings.catch_warnings():
+            # gevent warns that it can't also monitor memory usage without psutil
+            warnings.simplefilter('ignore')
+            self.hub.start_periodic_monitoring_thread()
+
+    def stop(self):
+        import gevent.events
+        if not self.running:
+            return
+        gevent.events.subscribers.remove(self.on_event)
+        self.hub = None
+
+    @contextmanager
+    def label(self, name):
+        """Attribute blocking by the current greenlet to ``name`` (e.g. a
+        command name) for the duration of the block.
+        """
+        current = gevent.getcurrent()
+        previous = self.labels.get(current)
+        self.labels[current] = name
+        try:
+            yield
+        finally:
+            if previous is None:
+                self.labels.pop(current, None)
+            else:
+                self.labels[current] = previous
+
+    def on_event(self, event):
+        # Called on gevent's monitoring thread
+        import gevent.events
+        if not isinstance(event, gevent.events.EventLoopBlocked) or event.hub is not self.hub:
+            return
+        frame = sys._current_frames().get(self.hub.thread_ident)
+        if frame is not None:
+            stack = [line.rstrip('\n') for line in traceback.format_stack(frame)]
+        else:
+            stack = list(event.info)
+        report = dict(
+            timestamp=int(time.time() * 1000),
+            thresholdMillis=int(event.blocking_time * 1000),
+            command=self.labels.get(event.greenlet),
+            greenlet=repr(event.greenlet),
+            stack=stack
+        )
+        self.blocked_count += 1
+        self.reports.append(report)
+        logger.warning(
+            'Event loop blocked for more than %dms while serving %s:\n%s',
+            report['thresholdMillis'], report['command'] or 'no command', '\n'.join(stack)
+        )
+
+    def to_dict(self):
+        return dict(
+            enabled=self.running,
+            thresholdMillis=int(self.threshold * 1000),
+            blockedCount=self.blocked_count,
+            recentBlocks=list(self.reports)
+        )
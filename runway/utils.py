@@ -1,24 +1,34 @@
 import tempfile
 import tarfile
+import copy
+import collections.abc
+import types
 import inspect
 import re
 import os
+import zlib
+import bz2
+import lzma
+import hashlib
+import shutil
 import functools
+import threading
+import time
 import sys
 import gzip
 import datetime
-import colorcet
 import uuid
-import urllib3
-import multiprocessing
-import certifi
 import json
-import imageio
+import pickle
+import queue
+from collections import OrderedDict
+from six import reraise
 from unidecode import unidecode
 from io import BytesIO as IO
 from urllib.parse import urlparse
 import numpy as np
-from flask import after_this_request, request, jsonify
+from .exceptions import InvalidArgumentError, RunwayError, DeadlineExceededError
+from .codec import json_dumps, json_loads, json_response
 
 
 URL_REGEX = re.compile(
@@ -32,21 +42,34 @@ URL_REGEX = re.compile(
 def validate_post_request_body_is_json(f):
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
-        json = get_json_or_none_if_invalid(request)
+        from flask import request
+        try:
+            json = get_json_or_none_if_invalid(request)
+        except RunwayError as err:
+            return json_response(err.to_response(), err.code)
         if json is not None:
             return f(*args, **kwargs)
         else:
             err_msg = 'The body of all POST requests must contain JSON'
-            return jsonify(dict(error=err_msg)), 400
+            return json_response(dict(error=err_msg), 400)
     return wrapped
 
 def get_json_or_none_if_invalid(request):
-    if request.headers.get('content-encoding') == 'gzip' and request.headers.get('content-type') == 'application/json':
-        data = request.get_data()
-        decompressed = gzip_decompress(data)
-        return json.loads(decompressed)
-    else:
-        return request.get_json(force=True, silent=True)
+    """Return the decoded JSON body of a request, or None if it isn't valid
+    JSON. Bodies sent with a ``Content-Encoding`` are decompressed by the
+    app's compression policy, which raises ``RequestTooLargeError`` for
+    bodies that are too large. The result is cached for the request, since
+    it's needed by both the route and ``validate_post_request_body_is_json``.
+    """
+    from flask import current_app
+    if not hasattr(request, 'runway_json'):
+        compression = current_app.extensions['runway_compression']
+        try:
+            data = compression.decompress_request_body(request.get_data(), request.headers.get('content-encoding'))
+            request.runway_json = json_loads(data)
+        except ValueError:
+            request.runway_json = None
+    return request.runway_json
 
 def serialize_command(cmd):
     ret = {}
@@ -78,8 +101,76 @@ def get_download_chunks(total_size, chunk_size=1e7):
         yield [start, end]
 
 
-def download_worker(url, queue, filename):
-    http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('RW_MAX_CONCURRENT_DOWNLOADS', 4))
+download_slots = threading.BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
+
+
+class DownloadProgress(object):
+    """Thread-safe progress of a single remote file transfer, reported by
+    ``/healthcheck`` while the model is starting.
+    """
+
+    def __init__(self):
+        self.status = 'queued'
+        self.bytes_downloaded = 0
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    def start(self, total_bytes=None):
+        with self.lock:
+            self.status = 'downloading'
+            self.bytes_downloaded = 0
+            self.total_bytes = total_bytes
+
+    def update(self, n_bytes):
+        with self.lock:
+            self.bytes_downloaded += n_bytes
+
+    def finish(self, status='done'):
+        with self.lock:
+            self.status = status
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'status': self.status,
+                'bytesDownloaded': self.bytes_downloaded,
+                'totalBytes': self.total_bytes
+            }
+
+
+class ProgressStream(object):
+    """A read-only file-like object that reports the number of bytes read from
+    the underlying stream to a ``DownloadProgress``.
+    """
+
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.stream.read()
+        else:
+            data = self.stream.read(size)
+        self.progress.update(len(data))
+        return data
+
+
+def get_pool_manager():
+    import urllib3
+    import certifi
+    return urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+
+
+def get_content_length(headers):
+    if headers.get('content-length') is None:
+        return None
+    return int(headers['content-length'])
+
+
+def download_worker(url, queue, filename, progress_queue=None):
+    http = get_pool_manager()
     while True:
         try:
             rng = queue.get_nowait()
@@ -91,43 +182,372 @@ def download_worker(url, queue, filename):
         f.seek(start)
         f.write(resp.data)
         f.close()
+        if progress_queue is not None:
+            progress_queue.put(len(resp.data))
 
 
-def download_file(url, n_processes=16):
+def drain_progress_queue(progress_queue, progress):
+    while True:
+        try:
+            progress.update(progress_queue.get_nowait())
+        except queue.Empty:
+            break
+
+
+def check_response_status(response, url):
+    if response.status < 200 or response.status >= 300:
+        raise IOError('Unable to download %s: HTTP status %d' % (url, response.status))
+
+
+def download_file(url, n_processes=16, progress=None, head=b''):
+    """Download a remote file to a temporary file, in parallel segments if the
+    server supports range requests. ``head`` holds the first bytes of the
+    file if they were already downloaded, and is only fetched again if the
+    file can't be downloaded in segments.
+    """
+    if progress is None:
+        progress = DownloadProgress()
     tmp = tempfile.NamedTemporaryFile(suffix=get_file_suffix_from_url(url), delete=False)
     filename = tmp.name
-    http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+    http = get_pool_manager()
     initial_response = http.request('HEAD', url)
-    enable_segmented_download = 'accept-ranges' in initial_response.headers and \
-        'content-length' in initial_response.headers and \
-        initial_response.headers['accept-ranges'] == 'bytes' and \
-        initial_response.headers['content-length'] is not None
-    if enable_segmented_download:
+    check_response_status(initial_response, url)
+    progress.start(get_content_length(initial_response.headers))
+    if supports_segmented_download(initial_response.headers):
         content_length = int(initial_response.headers['content-length'])
-        manager = multiprocessing.Manager()
-        queue = manager.Queue()
-        [queue.put(chunk) for chunk in get_download_chunks(content_length)]
-        processes = [multiprocessing.Process(target=download_worker, args=(url, queue, filename)) for _ in range(n_processes)]
-        [process.start() for process in processes]
-        [process.join() for process in processes]
+        with open(filename, 'wb') as f:
+            f.write(head)
+        progress.update(len(head))
+        offset = len(head)
+        if offset < content_length:
+            import multiprocessing
+            manager = multiprocessing.Manager()
+            chunks = manager.Queue()
+            progress_queue = manager.Queue()
+            for start, end in get_download_chunks(content_length - offset):
+                chunks.put([start + offset, end + offset])
+            processes = [multiprocessing.Process(target=download_worker, args=(url, chunks, filename, progress_queue)) for _ in range(n_processes)]
+            [process.start() for process in processes]
+            while any(process.is_alive() for process in processes):
+                drain_progress_queue(progress_queue, progress)
+                time.sleep(0.1)
+            [process.join() for process in processes]
+            drain_progress_queue(progress_queue, progress)
     else:
         resp = http.request('GET', url)
         f = open(filename, 'wb')
         f.write(resp.data)
         f.close()
+        progress.update(len(resp.data))
+    progress.finish()
     return filename
 
 
-def extract_tarball(path):
-    extracted_dir = tempfile.mkdtemp()
-    with tarfile.open(path, 'r:*', errors='ignore') as tar:
-        def encode_ascii(member):
+TAR_MAGIC_OFFSET = 257
+TAR_MAGICS = [b'ustar\x0000', b'ustar  \x00']
+TAR_SNIFF_LIMIT = 2 ** 20
+TAR_STREAM_CHUNK_SIZE = 2 ** 16
+TARBALL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'runway-tarballs')
+
+# Extracted tarballs are kept in TARBALL_CACHE_DIR until they take more than
+# this many bytes, at which point the least recently used ones are deleted
+TARBALL_CACHE_MAX_BYTES = int(os.getenv('RW_TARBALL_CACHE_MAX_BYTES', 20 * 2 ** 30))
+
+
+class ReplayStream(object):
+    """A read-only file-like object that replays already consumed bytes before
+    reading the rest of the underlying stream.
+    """
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.head + self.stream.read()
+            self.head = b''
+            return data
+        if self.head:
+            data = self.head[:size]
+            self.head = self.head[size:]
+            return data
+        return self.stream.read(size)
+
+
+def get_decompressor(head):
+    if head.startswith(b'\x1f\x8b'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if head.startswith(b'BZh'):
+        return bz2.BZ2Decompressor()
+    if head.startswith(b'\xfd7zXZ\x00'):
+        return lzma.LZMADecompressor()
+    return None
+
+
+def sniff_tarball(stream, limit=TAR_SNIFF_LIMIT):
+    """Read just enough of a stream to tell whether it holds a (possibly
+    compressed) tar archive. Returns a tuple of whether the stream is a tarball
+    and the bytes consumed while sniffing, which must be replayed to read the
+    full stream.
+    """
+    head = b''
+    decompressed = b''
+    decompressor = None
+    while len(head) < limit:
+        chunk = stream.read(512 if len(head) == 0 else TAR_STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        if len(head) == 0:
+            decompressor = get_decompressor(chunk)
+        head += chunk
+        if decompressor is None:
+            decompressed = head
+        else:
+            try:
+                decompressed += decompressor.decompress(chunk)
+            except (zlib.error, OSError, EOFError, lzma.LZMAError):
+                return False, head
+        if len(decompressed) >= TAR_MAGIC_OFFSET + 8:
+            break
+    magic = decompressed[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + 8]
+    return magic in TAR_MAGICS, head
+
+
+def extract_tarball_stream(stream, extracted_dir):
+    with tarfile.open(fileobj=stream, mode='r|*', errors='ignore') as tar:
+        for member in tar:
             member.name = unidecode(member.name)
-        [encode_ascii(member) for member in tar.getmembers()]
-        tar.extractall(path=extracted_dir)
+            tar.extract(member, path=extracted_dir)
     return extracted_dir
 
 
+def get_validator(headers):
+    return headers.get('etag') or headers.get('last-modified')
+
+
+def get_tarball_cache_dir(url, validator):
+    key = hashlib.sha1(('%s\n%s' % (url, validator)).encode('utf8')).hexdigest()
+    return os.path.join(TARBALL_CACHE_DIR, key)
+
+
+def get_directory_size(path):
+    total = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def prune_tarball_cache(keep, max_bytes=None):
+    """Delete the least recently used extracted tarballs from
+    ``TARBALL_CACHE_DIR``, other than ``keep``, until the cache takes at most
+    ``max_bytes`` (``TARBALL_CACHE_MAX_BYTES`` by default). Extractions still
+    in progress are left alone.
+    """
+    if max_bytes is None:
+        max_bytes = TARBALL_CACHE_MAX_BYTES
+    entries = []
+    for name in os.listdir(TARBALL_CACHE_DIR):
+        path = os.path.join(TARBALL_CACHE_DIR, name)
+        if name.endswith('.partial') or not os.path.isdir(path):
+            continue
+        try:
+            last_used = os.stat(path).st_mtime
+        except OSError:
+            continue
+        entries.append((last_used, path, get_directory_size(path)))
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def supports_segmented_download(headers):
+    return 'accept-ranges' in headers and \
+        'content-length' in headers and \
+        headers['accept-ranges'] == 'bytes' and \
+        headers['content-length'] is not None
+
+
+def download_and_extract(url, progress=None):
+    """Download a remote file, extracting it on the fly if it is a tarball.
+    Tarballs are piped straight from the HTTP response into a directory so
+    they are never written to disk as an archive. Extracted directories are
+    cached by URL and validator (ETag or Last-Modified) and reused as long as
+    the remote resource is unchanged, up to ``RW_TARBALL_CACHE_MAX_BYTES``
+    bytes (20GiB by default) of extracted files. The cache lives in the
+    ``runway-tarballs`` directory of the system's temporary directory, which
+    can be deleted at any time no model is starting.
+
+    At most ``RW_MAX_CONCURRENT_DOWNLOADS`` transfers (4 by default) run at
+    the same time across the whole process.
+    """
+    if progress is None:
+        progress = DownloadProgress()
+    with download_slots:
+        try:
+            path = stream_download_and_extract(url, progress)
+        except:
+            progress.finish('failed')
+            raise
+    progress.finish()
+    return path
+
+
+def stream_download_and_extract(url, progress):
+    http = get_pool_manager()
+    head_response = http.request('HEAD', url)
+    check_response_status(head_response, url)
+    validator = get_validator(head_response.headers)
+    cache_dir = None
+    if validator is not None:
+        cache_dir = get_tarball_cache_dir(url, validator)
+        if os.path.isdir(cache_dir):
+            # mark the entry as recently used for prune_tarball_cache()
+            try:
+                os.utime(cache_dir)
+            except OSError:
+                pass
+            return cache_dir
+    progress.start(get_content_length(head_response.headers))
+    response = http.request('GET', url, preload_content=False)
+    stream = ProgressStream(response, progress)
+    try:
+        check_response_status(response, url)
+        is_tarball, head = sniff_tarball(stream)
+        if is_tarball:
+            if cache_dir is None:
+                return extract_tarball_stream(ReplayStream(head, stream), tempfile.mkdtemp())
+            os.makedirs(TARBALL_CACHE_DIR, exist_ok=True)
+            partial_dir = tempfile.mkdtemp(dir=TARBALL_CACHE_DIR, suffix='.partial')
+            try:
+                extract_tarball_stream(ReplayStream(head, stream), partial_dir)
+            except:
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                raise
+            try:
+                os.rename(partial_dir, cache_dir)
+            except OSError:
+                # Another process finished extracting the same archive first
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                if not os.path.isdir(cache_dir): raise
+            prune_tarball_cache(keep=cache_dir)
+            return cache_dir
+        if supports_segmented_download(head_response.headers):
+            # fetch the rest in parallel segments, starting after the bytes
+            # already read while sniffing
+            response.close()
+            return download_file(url, progress=progress, head=head)
+        tmp = tempfile.NamedTemporaryFile(suffix=get_file_suffix_from_url(url), delete=False)
+        with tmp:
+            tmp.write(head)
+            shutil.copyfileobj(stream, tmp, TAR_STREAM_CHUNK_SIZE)
+        return tmp.name
+    finally:
+        response.release_conn()
+
+
+class LazyPath(os.PathLike):
+    """A path-like object whose value is resolved in a background thread.
+    Resolution starts as soon as the object is created and only blocks the
+    caller when the path is first used, e.g. by ``open()``, ``os.fspath()`` or
+    ``str()``. Errors raised while resolving are re-raised on access.
+    """
+
+    def __init__(self, resolve, *args, **kwargs):
+        self.path = None
+        self.exc_info = None
+        self.resolved = threading.Event()
+        thread = threading.Thread(target=self.run, args=(resolve, args, kwargs))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, resolve, args, kwargs):
+        try:
+            self.path = resolve(*args, **kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.resolved.set()
+
+    def is_resolved(self):
+        return self.resolved.is_set()
+
+    def resolve(self, timeout=None):
+        self.resolved.wait(timeout)
+        if self.exc_info is not None:
+            reraise(*self.exc_info)
+        return self.path
+
+    def __fspath__(self):
+        return self.resolve()
+
+    def __str__(self):
+        return self.resolve()
+
+    def __repr__(self):
+        if self.is_resolved() and self.exc_info is None:
+            return 'LazyPath(%r)' % self.path
+        return 'LazyPath(<pending>)'
+
+
+def memory_map(path):
+    """Map a file into memory as a read-only ``numpy.memmap`` of bytes. Every
+    process that maps the same file shares a single copy of it in the page
+    cache instead of reading it into private memory.
+    """
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+class MemoryMappedDirectory(collections.abc.Mapping, os.PathLike):
+    """A read-only mapping of the relative paths of all files in a directory to
+    memory-mapped views of their contents (see ``memory_map()``). Files are
+    mapped on first access. The object is also path-like, so it can still be
+    passed to ``open()`` or ``os.path.join()`` as the directory itself.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mapped = {}
+        self.files = []
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                self.files.append(os.path.relpath(os.path.join(root, filename), path))
+        self.files.sort()
+
+    def __getitem__(self, relative_path):
+        if relative_path not in self.mapped:
+            if relative_path not in self.files:
+                raise KeyError(relative_path)
+            self.mapped[relative_path] = memory_map(os.path.join(self.path, relative_path))
+        return self.mapped[relative_path]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __fspath__(self):
+        return self.path
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return 'MemoryMappedDirectory(%r)' % self.path
+
+
 def gzip_compress(data):
     compressed_data = IO()
     g = gzip.GzipFile(fileobj=compressed_data, mode='w')
@@ -144,6 +564,8 @@ def gzip_decompress(data):
 def gzipped(f):
     @functools.wraps(f)
     def view_func(*args, **kwargs):
+        from flask import after_this_request, request
+
         @after_this_request
         def zipper(response):
             accept_encoding = request.headers.get('Accept-Encoding', '')
@@ -193,6 +615,7 @@ def timestamp_millis():
 
 
 def get_color_palette(name):
+    import colorcet
     palette = getattr(colorcet, name)
     return [[int(c[0]*255), int(c[1]*255), int(c[2]*255)] for c in palette]
 
@@ -208,12 +631,22 @@ def deserialize_data(data, fields):
         if name in data:
             ret[name] = field.deserialize(data[name])
         elif hasattr(field, 'default'):
-            ret[name] = field.default
+            ret[name] = deserialize_default(field)
         else:
             raise Exception('Missing field:', field.name)
     return ret
 
 
+def deserialize_default(field):
+    """Deserialize the default value of a field the same way as a supplied
+    value, so that e.g. the default path of a ``file(mmap=True)`` field is
+    memory-mapped. A default of ``None`` is passed through as is.
+    """
+    if field.default is None:
+        return None
+    return field.deserialize(field.default)
+
+
 def serialize_data(data, fields, output_formats=None):
     if output_formats is None:
         output_formats = {}
@@ -228,6 +661,342 @@ def serialize_data(data, fields, output_formats=None):
     return ret
     
 
+def compile_deserializer(fields):
+    """Compile ``deserialize_data()`` for a list of fields into a function of
+    the input data. The fields are only inspected once, when compiling, so
+    commands can compile their inputs when they are registered. Inputs that
+    are already deserialized (e.g. uploaded earlier over a websocket) can be
+    passed as a dict ``deserialized``, and take precedence over ``data``.
+    They are copied, so that a command modifying its inputs in place doesn't
+    change them for later calls. Missing fields get their default,
+    deserialized on each call like supplied values (see
+    ``deserialize_default()``).
+    """
+    plan = [(field.name, field.deserialize, field, hasattr(field, 'default')) for field in fields]
+
+    def deserialize(data, deserialized=None):
+        ret = {}
+        if deserialized:
+            ret.update({name: copy.deepcopy(value) for name, value in deserialized.items()})
+        for name, deserialize_field, field, has_default in plan:
+            if deserialized and name in deserialized:
+                continue
+            if name in data:
+                ret[name] = deserialize_field(data[name])
+            elif has_default:
+                ret[name] = deserialize_default(field)
+            else:
+                raise Exception('Missing field:', name)
+        return ret
+
+    return deserialize
+
+
+class BinaryData(object):
+    """The raw bytes of a serialized value, sent in a binary websocket frame
+    instead of inside the JSON of a message.
+
+    :param data: The bytes of the value
+    :type data: bytes
+    :param content_type: The MIME type of the bytes, e.g. ``image/jpeg``
+    :type content_type: string
+    """
+
+    __slots__ = ['data', 'content_type']
+
+    def __init__(self, data, content_type):
+        self.data = data
+        self.content_type = content_type
+
+
+def split_binary_data(data):
+    """Remove the ``BinaryData`` values from a dict of serialized outputs.
+    Returns the name, content type and size of each removed value, and their
+    bytes, in the same order.
+    """
+    binary_data = []
+    frames = []
+    for name, value in list(data.items()):
+        if isinstance(value, BinaryData):
+            del data[name]
+            binary_data.append(dict(name=name, contentType=value.content_type, size=len(value.data)))
+            frames.append(value.data)
+    return binary_data, frames
+
+
+def get_preview_serializer(field, size, quality, binary=False):
+    def serialize_preview(value, output_format=None):
+        return field.serialize_preview(value, size, quality, binary)
+    return serialize_preview
+
+
+def compile_serializer(fields, preview_size=None, preview_quality=60, binary=False):
+    """Compile ``serialize_data()`` for a list of fields into a function of
+    the output data and output formats, with a fast path for the common case
+    of a single field. If ``preview_size`` is set, the compiled function
+    serializes previews of the fields instead (see
+    ``BaseType.serialize_preview()``), ignoring output formats. If
+    ``binary`` is set, fields that can be sent in binary websocket frames
+    are serialized to ``BinaryData`` (see ``BaseType.serialize_binary()``).
+    """
+    if preview_size is not None:
+        plan = [(field.name, get_preview_serializer(field, preview_size, preview_quality, binary))
+                for field in fields]
+    elif binary:
+        plan = [(field.name, field.serialize_binary) for field in fields]
+    else:
+        plan = [(field.name, field.serialize) for field in fields]
+
+    if len(fields) == 1:
+        name, serialize_field = plan[0]
+
+        def serialize_single(data, output_formats=None):
+            if type(data) == dict:
+                data = data[name]
+            if output_formats:
+                return {name: serialize_field(data, output_formats.get(name))}
+            return {name: serialize_field(data)}
+
+        return serialize_single
+
+    def serialize(data, output_formats=None):
+        if output_formats:
+            return {name: serialize_field(data[name], output_formats.get(name)) for name, serialize_field in plan}
+        return {name: serialize_field(data[name]) for name, serialize_field in plan}
+
+    return serialize
+
+
+def estimate_size(obj):
+    """Roughly estimate the number of bytes of memory held by an object and
+    everything it references. Array-like objects that expose an integer
+    ``nbytes`` attribute (e.g. numpy arrays) are counted by the size of their
+    buffer, and PIL images by the size of their pixels. Modules, classes and
+    functions are not followed.
+    """
+    pil_image = sys.modules.get('PIL.Image')
+    seen = set()
+    stack = [obj]
+    total = 0
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (types.ModuleType, type, types.FunctionType, types.MethodType)):
+            continue
+        if pil_image is not None and isinstance(obj, pil_image.Image):
+            # the pixels of PIL images aren't held by Python objects
+            total += obj.width * obj.height * len(obj.getbands())
+            continue
+        try:
+            nbytes = getattr(obj, 'nbytes', None)
+        except Exception:
+            nbytes = None
+        if isinstance(nbytes, int):
+            total += nbytes
+            continue
+        total += sys.getsizeof(obj, 0)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return total
+
+
+class LRUCache(object):
+    """A least-recently-used cache bounded by a number of entries and,
+    optionally, by the total estimated size of its values in bytes. The most
+    recently inserted entry is never evicted to make room for itself.
+
+    :param max_size: The maximum number of entries, unbounded if None
+    :type max_size: int, optional
+    :param max_bytes: The maximum total size of all values, unbounded if None
+    :type max_bytes: int, optional
+    :param sizeof: A function returning the size of a value in bytes
+    :type sizeof: function, optional
+    """
+
+    def __init__(self, max_size=None, max_bytes=None, sizeof=estimate_size):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value):
+        self.pop(key)
+        nbytes = self.sizeof(value) if self.max_bytes is not None else 0
+        self.entries[key] = (value, nbytes)
+        self.total_bytes += nbytes
+        evicted = []
+        while len(self.entries) > 1 and self.is_over_budget():
+            evicted_key = next(iter(self.entries))
+            evicted.append((evicted_key, self.pop(evicted_key)))
+        return evicted
+
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value, nbytes = self.entries.pop(key)
+        self.total_bytes -= nbytes
+        return value
+
+    def is_over_budget(self):
+        if self.max_size is not None and len(self.entries) > self.max_size:
+            return True
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes
+
+    def contains_value(self, value):
+        return any(v is value for v, _ in self.entries.values())
+
+    def values(self):
+        return [v for v, _ in self.entries.values()]
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+
+SNAPSHOT_MMAP_MIN_BYTES = 2 ** 20
+
+
+class SnapshotPickler(pickle.Pickler):
+    """A pickler that stores numpy arrays of at least ``min_bytes`` as
+    separate ``.npy`` files next to the pickle, so they can be memory-mapped
+    when the snapshot is loaded.
+    """
+
+    def __init__(self, f, snapshot_dir, min_bytes=SNAPSHOT_MMAP_MIN_BYTES):
+        super(SnapshotPickler, self).__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.snapshot_dir = snapshot_dir
+        self.min_bytes = min_bytes
+        self.array_names = {}
+
+    def persistent_id(self, obj):
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or obj.nbytes < self.min_bytes:
+            return None
+        if id(obj) not in self.array_names:
+            name = '%d.npy' % len(self.array_names)
+            np.save(os.path.join(self.snapshot_dir, name), obj)
+            self.array_names[id(obj)] = name
+        return ('ndarray', self.array_names[id(obj)])
+
+
+class SnapshotUnpickler(pickle.Unpickler):
+
+    def __init__(self, f, snapshot_dir, mmap=True):
+        super(SnapshotUnpickler, self).__init__(f)
+        self.snapshot_dir = snapshot_dir
+        self.mmap = mmap
+        self.arrays = {}
+
+    def persistent_load(self, pid):
+        _, name = pid
+        if name not in self.arrays:
+            mmap_mode = 'c' if self.mmap else None
+            self.arrays[name] = np.load(os.path.join(self.snapshot_dir, name), mmap_mode=mmap_mode)
+        return self.arrays[name]
+
+
+def save_snapshot(obj, snapshot_dir, metadata=None):
+    """Pickle an object to a snapshot directory. Large numpy arrays are saved
+    as separate files that ``load_snapshot()`` memory-maps. The directory is
+    written under a temporary name and renamed into place once complete.
+    """
+    parent_dir = os.path.dirname(os.path.abspath(snapshot_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    partial_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.partial')
+    try:
+        with open(os.path.join(partial_dir, 'snapshot.pkl'), 'wb') as f:
+            SnapshotPickler(f, partial_dir).dump(obj)
+        with open(os.path.join(partial_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata or {}, f)
+        if os.path.isdir(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        os.rename(partial_dir, snapshot_dir)
+    except:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        raise
+
+
+def load_snapshot(snapshot_dir, mmap=True):
+    """Load an object saved by ``save_snapshot()``. Large numpy arrays are
+    memory-mapped copy-on-write, so they are read from disk on demand and
+    processes restoring the same snapshot share their pages until written.
+    """
+    with open(os.path.join(snapshot_dir, 'snapshot.pkl'), 'rb') as f:
+        return SnapshotUnpickler(f, snapshot_dir, mmap=mmap).load()
+
+
+def load_snapshot_metadata(snapshot_dir):
+    with open(os.path.join(snapshot_dir, 'metadata.json')) as f:
+        return json.load(f)
+
+
+def get_code_hash(fn):
+    """Hash the source file a function is defined in along with the source of
+    every loaded module in the same directory tree, e.g. the helper modules
+    of a model, falling back to the function's bytecode if the source isn't
+    available.
+    """
+    try:
+        source_file = os.path.abspath(inspect.getsourcefile(fn))
+    except TypeError:
+        return hashlib.sha1(fn.__code__.co_code).hexdigest()
+    root = os.path.dirname(source_file) + os.sep
+    paths = set([source_file])
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path is not None and path.endswith('.py') and os.path.abspath(path).startswith(root):
+            paths.add(os.path.abspath(path))
+    code_hash = hashlib.sha1()
+    try:
+        for path in sorted(paths):
+            with open(path, 'rb') as f:
+                code_hash.update(path.encode('utf8') + b'\n' + f.read())
+    except OSError:
+        return hashlib.sha1(fn.__code__.co_code).hexdigest()
+    return code_hash.hexdigest()
+
+
+def get_resource_version(path_or_url):
+    """Return a string that changes whenever the content of a local or remote
+    file or directory changes: the ETag or Last-Modified header of a URL, or
+    the size and modification time of local files. Returns ``None`` if the
+    server sends neither header.
+    """
+    if is_url(path_or_url):
+        response = get_pool_manager().request('HEAD', path_or_url)
+        check_response_status(response, path_or_url)
+        return get_validator(response.headers)
+    paths = [path_or_url]
+    if os.path.isdir(path_or_url):
+        paths = []
+        for root, _, filenames in os.walk(path_or_url):
+            paths.extend(os.path.join(root, filename) for filename in filenames)
+    versions = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        versions.append('%s:%d:%d' % (os.path.relpath(path, path_or_url), stat.st_size, stat.st_mtime_ns))
+    return ';'.join(versions)
+
+
 def generate_uuid():
     return uuid.uuid4().hex
 
@@ -242,11 +1011,12 @@ def adjust_dynamic_range(data, drange_in, drange_out):
         return data
 
 
-def encode_image(image, image_format):
+def encode_image(image, image_format, **save_options):
     buffer = IO()
     if image_format.upper() in ['PNG', 'JPEG']:
-        image.save(buffer, format=image_format)
+        image.save(buffer, format=image_format, **save_options)
     else:
+        import imageio
         data = np.array(image)
         adjusted = adjust_dynamic_range(data, [0, 255], [0, 1])
         imageio.plugins.freeimage.download()
@@ -254,6 +1024,37 @@ def encode_image(image, image_format):
     return buffer.getvalue()
 
 
+class PrecomputedJSON(object):
+    """A JSON object that is encoded, hashed and gzip-compressed once, so that
+    it can be served repeatedly without encoding it again. Per-response fields
+    can be merged in by ``render()``, which only encodes and compresses those
+    fields: the state of the compressor after the static fields is kept and
+    copied for every response.
+
+    The ETag covers the static fields only, and is weak since responses that
+    merge in different fields are equivalent but not identical.
+    """
+
+    def __init__(self, data):
+        body = json_dumps(data)
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.prefix = body[:-1]
+        self.separator = b',' if len(data) > 0 else b''
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.gzipped_prefix = self.compressor.compress(self.prefix)
+
+    def render(self, extra_data=None, gzipped=False):
+        if extra_data:
+            extra = json_dumps(extra_data)
+            suffix = self.separator + extra[1:]
+        else:
+            suffix = b'}'
+        if not gzipped:
+            return self.prefix + suffix
+        compressor = self.compressor.copy()
+        return self.gzipped_prefix + compressor.compress(suffix) + compressor.flush()
+
+
 def parse_output_formats_from_header(value):
     result = {}
     for item in map(str.strip, value.split(';')):
@@ -262,3 +1063,70 @@ def parse_output_formats_from_header(value):
         name, value = item.split('=', 1)
         result[name] = value
     return result
+
+
+def parse_model_options(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise InvalidArgumentError('X-Runway-Model-Options', 'header value must be JSON')
+
+
+class Deadline(object):
+    """The time by which a client expects the result of a command, given as
+    a number of milliseconds from now.
+    """
+
+    def __init__(self, millis):
+        self.millis = millis
+        self.expires_at = time.time() + millis / 1000.0
+
+    def remaining(self):
+        return max(0, self.expires_at - time.time())
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def check(self):
+        """Raise ``DeadlineExceededError`` if the deadline has passed."""
+        if self.expired():
+            raise DeadlineExceededError(self.millis)
+
+
+def parse_deadline(value, name='X-Runway-Deadline-Ms'):
+    try:
+        millis = float(value)
+    except (TypeError, ValueError):
+        raise InvalidArgumentError(name, 'value must be a number of milliseconds')
+    if millis < 0:
+        raise InvalidArgumentError(name, 'value must be a number of milliseconds')
+    return Deadline(int(millis) if millis.is_integer() else millis)
+
+
+# Returned by call_before_deadline() in place of raising DeadlineExceededError
+DEADLINE_EXCEEDED = object()
+
+
+def call_before_deadline(deadline, fn, *args):
+    """Call ``fn(*args)`` unless ``deadline`` has passed, e.g. while the call
+    was queued. Meant to run on a thread pool: if the deadline passes, before
+    or during the call, ``DEADLINE_EXCEEDED`` is returned instead of raising
+    ``DeadlineExceededError``, which gevent would report as a failure of the
+    pool with a traceback. The caller raises it instead.
+    """
+    try:
+        if deadline is not None:
+            deadline.check()
+        return fn(*args)
+    except DeadlineExceededError:
+        return DEADLINE_EXCEEDED
+
+
+def next_output(generator):
+    """Advance a generator command by one yield. Returns ``(False, output)``
+    for a yielded output, or ``(True, value)`` once the generator returns.
+    """
+    try:
+        return False, next(generator)
+    except StopIteration as err:
+        return True, getattr(err, 'value', None)
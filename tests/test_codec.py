@@ -0,0 +1,50 @@
+# Ensure that the local version of the runway module is used, not a pip
+# installed version
+import sys
+sys.path.insert(0, '..')
+sys.path.insert(0, '.')
+
+import json
+import pytest
+import numpy as np
+from runway.codec import load_codec, CODECS
+
+def get_codecs():
+    codecs = []
+    for name in CODECS:
+        try:
+            codecs.append(load_codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+@pytest.mark.parametrize('codec', get_codecs(), ids=lambda codec: codec[0])
+def test_codec_encodes_numpy_values(codec):
+    _, dumps, loads = codec
+    data = {
+        'vector': np.arange(4, dtype=np.float32),
+        'landmarks': np.array([[0.25, 0.5], [0.75, 1.0]]),
+        'strided': np.arange(10)[::2],
+        'scalar': np.float64(0.5),
+        'count': np.int64(3),
+        'flag': np.bool_(True),
+        'text': 'café'
+    }
+    encoded = dumps(data)
+    assert type(encoded) == bytes
+    assert json.loads(encoded.decode('utf8')) == {
+        'vector': [0, 1, 2, 3],
+        'landmarks': [[0.25, 0.5], [0.75, 1.0]],
+        'strided': [0, 2, 4, 6, 8],
+        'scalar': 0.5,
+        'count': 3,
+        'flag': True,
+        'text': 'café'
+    }
+    assert loads(encoded) == json.loads(encoded.decode('utf8'))
+
+@pytest.mark.parametrize('codec', get_codecs(), ids=lambda codec: codec[0])
+def test_codec_rejects_unknown_types(codec):
+    _, dumps, _ = codec
+    with pytest.raises(TypeError):
+        dumps({'value': object()})
@@ -0,0 +1,109 @@
+# Ensure that the local version of the runway module is used, not a pip
+# installed version
+import sys
+sys.path.insert(0, '..')
+sys.path.insert(0, '.')
+
+import os
+import json
+import base64
+import pytest
+from runway.model import RunwayModel
+from runway.data_types import text
+from runway.compression import CompressionPolicy, load_encodings, parse_accept_encoding, get_compressed_media_size
+from runway.exceptions import RequestTooLargeError
+from utils import *
+
+POLICY = CompressionPolicy()
+ENCODINGS = sorted(POLICY.encodings)
+
+JPEG_URI = 'data:image/jpeg;base64,' + base64.b64encode(os.urandom(30000)).decode('ascii')
+
+def make_model():
+    rw = RunwayModel()
+
+    @rw.command('echo', inputs={'text': text}, outputs={'text': text})
+    def echo(model, inputs):
+        return inputs['text']
+
+    rw.run(no_serve=True)
+    return rw
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding('gzip, br;q=0.5, zstd;q=0') == {'gzip': 1.0, 'br': 0.5, 'zstd': 0.0}
+    assert parse_accept_encoding(None) == {}
+
+def test_choose_encoding_prefers_zstd_then_brotli():
+    assert POLICY.choose_encoding('gzip, deflate') == 'gzip'
+    assert POLICY.choose_encoding('identity') is None
+    assert POLICY.choose_encoding('gzip;q=1, br;q=0.5') == 'gzip'
+    if 'zstd' in POLICY.encodings:
+        assert POLICY.choose_encoding('gzip, br, zstd') == 'zstd'
+    elif 'br' in POLICY.encodings:
+        assert POLICY.choose_encoding('gzip, br, zstd') == 'br'
+
+def test_old_brotli_versions_are_skipped(monkeypatch):
+    class Decompressor(object):
+        def process(self, data):
+            return data
+
+    class OldBrotli(object):
+        pass
+
+    OldBrotli.Decompressor = Decompressor
+    monkeypatch.setitem(sys.modules, 'brotli', OldBrotli)
+    encodings = load_encodings()
+    assert 'br' not in encodings
+    assert 'gzip' in encodings
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_decompress_request_body_round_trip(encoding):
+    data = json.dumps({'text': 'hello ' * 1000}).encode('utf8')
+    compressed = POLICY.encodings[encoding].compress(data, POLICY.get_level(encoding))
+    assert POLICY.decompress_request_body(compressed, encoding) == data
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_decompress_request_body_enforces_size_cap(encoding):
+    policy = CompressionPolicy(max_request_size=2 ** 16)
+    bomb = policy.encodings[encoding].compress(b'\0' * 2 ** 24, 1)
+    with pytest.raises(RequestTooLargeError):
+        policy.decompress_request_body(bomb, encoding)
+    with pytest.raises(RequestTooLargeError):
+        policy.decompress_request_body(b'\0' * (2 ** 16 + 1), None)
+    with pytest.raises(ValueError):
+        policy.decompress_request_body(b'not compressed', encoding)
+
+def test_compressed_media_size():
+    body = json.dumps({'image': JPEG_URI, 'caption': 'a cat'}).encode('utf8')
+    assert get_compressed_media_size(body) == len(JPEG_URI) + 1
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_command_responses_are_compressed(encoding):
+    client = get_test_client(make_model())
+    response = client.post('/echo', json={'text': 'hello ' * 1000}, headers={'Accept-Encoding': encoding})
+    assert response.headers['Content-Encoding'] == encoding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    body = POLICY.decompress_request_body(response.data, encoding)
+    assert json.loads(body) == {'text': 'hello ' * 1000}
+
+def test_small_and_media_responses_are_not_compressed():
+    client = get_test_client(make_model())
+    response = client.post('/echo', json={'text': 'hello'}, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    response = client.post('/echo', json={'text': JPEG_URI}, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.json == {'text': JPEG_URI}
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_compressed_request_bodies(encoding):
+    rw = make_model()
+    client = get_test_client(rw)
+    data = POLICY.encodings[encoding].compress(json.dumps({'text': 'hello'}).encode('utf8'), 1)
+    headers = {'Content-Type': 'application/json', 'Content-Encoding': encoding}
+    response = client.post('/echo', data=data, headers=headers)
+    assert response.json == {'text': 'hello'}
+
+    rw.compression.max_request_size = 8
+    response = client.post('/echo', data=data, headers=headers)
+    assert response.status_code == 413
+    assert response.json['error'] == 'Request body is larger than 8 bytes.'
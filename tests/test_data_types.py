@@ -5,6 +5,9 @@ sys.path.insert(0, '..')
 sys.path.insert(0, '.')
 
 import os
+import gzip
+import tarfile
+import tempfile
 from io import BytesIO as IO
 import base64
 import pytest
@@ -12,6 +15,9 @@ import numpy as np
 from PIL import Image
 from runway.data_types import *
 from runway.exceptions import *
+from runway.utils import sniff_tarball, ReplayStream, extract_tarball_stream, prune_tarball_cache
+import runway.utils
+from utils import serve_directory
 
 # UTIL FUNCTIONS ---------------------------------------------------------------
 def check_data_type_interface(data_type):
@@ -378,6 +384,118 @@ def test_file_deserialization_remote_directory():
     assert os.path.exists(path)
     check_expected_contents_for_0057_tar_download(path)
 
+def make_tarball(path, compression=''):
+    with tarfile.open(path, 'w:' + compression) as tar:
+        data = b'# Runway Python SDK\n'
+        info = tarfile.TarInfo('model-sdk-0.0.57/README.md')
+        info.size = len(data)
+        tar.addfile(info, IO(data))
+
+def test_sniff_tarball():
+    root = tempfile.mkdtemp()
+    for compression in ['', 'gz', 'bz2', 'xz']:
+        path = os.path.join(root, 'archive.tar.' + compression)
+        make_tarball(path, compression)
+        with open(path, 'rb') as f:
+            is_tarball, head = sniff_tarball(f)
+            assert is_tarball
+            rest = f.read()
+        with open(path, 'rb') as f:
+            assert head + rest == f.read()
+
+def test_sniff_tarball_not_a_tarball():
+    assert not sniff_tarball(IO(b'# Runway Python SDK\n'))[0]
+    assert not sniff_tarball(IO(gzip.compress(b'# Runway Python SDK\n')))[0]
+    assert not sniff_tarball(IO(b''))[0]
+
+def test_extract_tarball_stream():
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, 'archive.tar.gz')
+    make_tarball(path, 'gz')
+    with open(path, 'rb') as f:
+        is_tarball, head = sniff_tarball(f)
+        extracted_dir = extract_tarball_stream(ReplayStream(head, f), tempfile.mkdtemp())
+    check_expected_contents_for_0057_tar_download(extracted_dir)
+
+def test_file_deserialization_local_server_tarball_is_cached():
+    root = tempfile.mkdtemp()
+    make_tarball(os.path.join(root, 'archive.tar.gz'), 'gz')
+    with serve_directory(root) as url:
+        f = file(is_directory=True)
+        path = f.deserialize(url + '/archive.tar.gz')
+        check_expected_contents_for_0057_tar_download(path)
+        assert f.deserialize(url + '/archive.tar.gz') == path
+
+def test_file_deserialization_local_server_missing_file():
+    with serve_directory(tempfile.mkdtemp()) as url:
+        with pytest.raises(IOError):
+            file(is_directory=True).deserialize(url + '/archive.tar.gz')
+
+def test_prune_tarball_cache(monkeypatch):
+    cache_dir = tempfile.mkdtemp()
+    monkeypatch.setattr(runway.utils, 'TARBALL_CACHE_DIR', cache_dir)
+    for i, name in enumerate(['old', 'recent', 'new', 'extracting.partial']):
+        os.makedirs(os.path.join(cache_dir, name))
+        with open(os.path.join(cache_dir, name, 'weights'), 'wb') as f:
+            f.write(b'\0' * 100)
+        os.utime(os.path.join(cache_dir, name), (1000 + i, 1000 + i))
+    prune_tarball_cache(keep=os.path.join(cache_dir, 'old'), max_bytes=250)
+    assert sorted(os.listdir(cache_dir)) == ['extracting.partial', 'new', 'old']
+    prune_tarball_cache(keep=os.path.join(cache_dir, 'new'), max_bytes=100)
+    assert sorted(os.listdir(cache_dir)) == ['extracting.partial', 'new']
+
+def test_file_deserialization_local_server_file():
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'README.md'), 'w') as f:
+        f.write('# Runway Python SDK\n')
+    with serve_directory(root) as url:
+        path = file().deserialize(url + '/README.md')
+        assert path.endswith('.md')
+        check_expected_contents_for_0057_file_download(path)
+
+def test_file_deserialization_lazy():
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'README.md'), 'w') as f:
+        f.write('# Runway Python SDK\n')
+    with serve_directory(root) as url:
+        path = file(lazy=True).deserialize(url + '/README.md')
+        assert isinstance(path, os.PathLike)
+        check_expected_contents_for_0057_file_download(path)
+        assert path.is_resolved()
+        assert os.fspath(path) == str(path)
+
+def test_file_deserialization_lazy_local_path():
+    assert file(lazy=True).deserialize('README.md') == 'README.md'
+
+def test_file_deserialization_lazy_error_raised_on_access():
+    path = file(lazy=True).deserialize('http://localhost:1/README.md')
+    with pytest.raises(Exception):
+        open(path)
+
+def test_file_deserialization_mmap():
+    mapped = file(mmap=True).deserialize('README.md')
+    assert isinstance(mapped, np.memmap)
+    with open('README.md', 'rb') as f:
+        assert mapped.tobytes() == f.read()
+    with pytest.raises(ValueError):
+        mapped[0] = 0
+
+def test_file_deserialization_mmap_directory():
+    root = tempfile.mkdtemp()
+    make_tarball(os.path.join(root, 'archive.tar'))
+    with open(os.path.join(root, 'empty'), 'wb') as f:
+        pass
+    mapped = directory(mmap=True).deserialize(root)
+    assert os.fspath(mapped) == root
+    assert sorted(mapped.keys()) == ['archive.tar', 'empty']
+    with open(os.path.join(root, 'archive.tar'), 'rb') as f:
+        assert mapped['archive.tar'].tobytes() == f.read()
+    assert len(mapped['empty']) == 0
+
+def test_file_lazy_and_mmap():
+    with pytest.raises(InvalidArgumentError):
+        file(lazy=True, mmap=True)
+
 # IMAGE ------------------------------------------------------------------------
 def test_image_to_dict():
     img = image(channels=3, min_width=128, min_height=128, max_width=512, max_height=512)
@@ -413,6 +531,38 @@ def test_image_serialize_and_deserialize():
     assert(deserialize_np_img.mode == 'RGBA')
     assert(np.array(deserialize_np_img).shape[2] == 4)
 
+def test_image_serialize_preview():
+    img = Image.new('RGB', (800, 400), color=(200, 100, 50))
+    preview = image().serialize_preview(img, 200, quality=50)
+    assert preview.startswith('data:image/jpeg;base64,')
+    preview_pil = Image.open(IO(base64.b64decode(preview[preview.find(',')+1:])))
+    assert preview_pil.size == (200, 100)
+    assert len(preview) < len(image().serialize(img))
+    # images are never scaled up, and the original is left untouched
+    assert Image.open(IO(base64.b64decode(image().serialize_preview(img, 1024).split(',')[1]))).size == (800, 400)
+    assert img.size == (800, 400)
+
+    preview = image(channels=4).serialize_preview(np.zeros((64, 64, 4)), 32)
+    assert preview.startswith('data:image/png;base64,')
+    assert array(item_type=image).serialize_preview([img], 100)[0].startswith('data:image/jpeg;base64,')
+    assert number().serialize_preview(5, 100) == 5
+
+def test_serialize_binary():
+    img = Image.new('RGB', (64, 32))
+    binary = image().serialize_binary(img)
+    assert binary.content_type == 'image/jpeg'
+    assert Image.open(IO(binary.data)).size == (64, 32)
+    assert image().serialize_binary(img, 'PNG').content_type == 'image/png'
+    assert image().serialize_preview(img, 16, binary=True).content_type == 'image/jpeg'
+
+    binary = segmentation(label_to_id={'background': 0, 'person': 1}).serialize_binary(np.zeros((8, 8), dtype=np.uint8))
+    assert binary.content_type == 'image/png'
+    assert Image.open(IO(binary.data)).mode == 'RGB'
+
+    binary = vector(length=3).serialize_binary(np.array([1, 2.5, -1]))
+    assert np.frombuffer(binary.data, dtype='<f4').tolist() == [1, 2.5, -1]
+    assert text().serialize_binary('hello') == 'hello'
+
 def test_image_serialize_invalid_type():
     with pytest.raises(InvalidArgumentError):
         image().serialize(True)
@@ -691,3 +841,35 @@ def test_image_landmarks_deserialize_invalid_type():
         image_landmarks(2).deserialize([[0.5, 0.5]])
     with pytest.raises(InvalidArgumentError):
         image_landmarks(2).deserialize([[0.5, 0.5, 0.5], [0.5, 0.5, 0.5]])
+
+# WARMUP VALUES ----------------------------------------------------------------
+def test_warmup_values_deserialize():
+    types = [
+        any(),
+        array(item_type=number, min_length=3),
+        vector(length=16, sampling_mean=5, sampling_std=0.1),
+        category(choices=['day', 'night'], default='night'),
+        number(default=7),
+        text(min_length=4),
+        boolean(default=True),
+        image_point(),
+        image_bounding_box(),
+        image_landmarks(3),
+    ]
+    for data_type in types:
+        data_type.deserialize(data_type.warmup_value())
+    assert array(item_type=number, min_length=3).warmup_value() == [0, 0, 0]
+    assert len(vector(length=16).warmup_value()) == 16
+    assert category(choices=['day', 'night'], default='night').warmup_value() == 'night'
+    assert text(min_length=4).warmup_value() == 'aaaa'
+
+def test_image_warmup_value_has_declared_size():
+    value = image(width=64, height=32, channels=4).warmup_value()
+    img = Image.open(IO(base64.b64decode(value[value.find(',')+1:])))
+    assert img.size == (64, 32)
+    assert img.mode == 'RGBA'
+
+def test_file_warmup_value_needs_default():
+    assert file(default='weights.bin').warmup_value() == 'weights.bin'
+    with pytest.raises(InvalidArgumentError):
+        file().warmup_value()
@@ -91,3 +91,19 @@ def test_print_exception(capsys):
         assert 'in foo' in captured.err
         assert 'in bar' in captured.err
         assert 'raise RunwayError' in captured.err
+
+def test_model_not_ready_error():
+    expect = 'Model is not ready: STARTING.'
+    check_code_and_error(ModelNotReadyError, 503, expect, inpt='STARTING')
+
+def test_request_too_large_error():
+    expect = 'Request body is larger than 1024 bytes.'
+    check_code_and_error(RequestTooLargeError, 413, expect, inpt=1024)
+
+def test_deadline_exceeded_error():
+    expect = 'Deadline of 250ms exceeded.'
+    check_code_and_error(DeadlineExceededError, 504, expect, inpt=250)
+
+def test_unknown_input_handle_error():
+    expect = 'Unknown input handle: abc.'
+    check_code_and_error(UnknownInputHandleError, 404, expect, inpt='abc')
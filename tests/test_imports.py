@@ -0,0 +1,71 @@
+# Ensure that the local version of the runway module is used, not a pip
+# installed version
+import sys
+sys.path.insert(0, '..')
+sys.path.insert(0, '.')
+
+import os
+import json
+import subprocess
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules that are only needed to serve the model, parse segmentation maps or
+# encode EXR images, and so mustn't be loaded by `import runway`
+LAZY_MODULES = [
+    'flask',
+    'flask_cors',
+    'flask_sockets',
+    'werkzeug',
+    'geventwebsocket',
+    'gevent.pywsgi',
+    'scipy',
+    'imageio',
+    'colorcet',
+    'urllib3'
+]
+
+# The best of several `import runway` runs must fit in this many seconds
+IMPORT_TIME_BUDGET = 0.5
+
+def run_python(code, *args):
+    return subprocess.check_output(
+        [sys.executable] + list(args) + ['-c', code],
+        cwd=ROOT_DIR,
+        stderr=subprocess.STDOUT
+    ).decode('utf8')
+
+def get_import_time(module):
+    output = run_python('import %s' % module, '-X', 'importtime')
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.strip() == module:
+            return int(cumulative) / 1e6
+    raise Exception('No import time reported for %s' % module)
+
+def test_import_runway_does_not_load_lazy_modules():
+    output = run_python('import sys, json, runway; print(json.dumps(sorted(sys.modules)))')
+    loaded_modules = json.loads(output.splitlines()[-1])
+    assert [name for name in LAZY_MODULES if name in loaded_modules] == []
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires Python 3.7')
+def test_import_runway_time_budget():
+    import_time = min(get_import_time('runway') for _ in range(3))
+    assert import_time < IMPORT_TIME_BUDGET
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='os.register_at_fork requires Python 3.7')
+def test_import_runway_does_not_hook_forks():
+    output = run_python('\n'.join([
+        'import os, gevent',
+        'hooks = []',
+        'os.register_at_fork = lambda **kwargs: hooks.append(kwargs.get(\'after_in_child\'))',
+        'from runway.model import RunwayModel',
+        'print(hooks.count(gevent.reinit))',
+        'RunwayModel().get_inference_pool()',
+        'RunwayModel().get_inference_pool()',
+        'print(hooks.count(gevent.reinit))'
+    ]))
+    assert output.split() == ['0', '1']
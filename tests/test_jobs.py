@@ -0,0 +1,178 @@
+# Ensure that the local version of the runway module is used, not a pip
+# installed version
+import sys
+sys.path.insert(0, '..')
+sys.path.insert(0, '.')
+
+import time
+import pytest
+import gevent.lock
+from runway.jobs import Job, JobCancelled, JobRegistry, OutputStream
+from runway.utils import Deadline
+from runway.data_types import image, vector
+from runway.exceptions import DeadlineExceededError, RequestTooLargeError, UnknownInputHandleError, \
+    InvalidArgumentError
+
+def test_job_states():
+    job = Job('a', 'sample')
+    assert job.state == 'queued'
+    slots = gevent.lock.BoundedSemaphore(1)
+    job.acquire_slot(slots)
+    assert job.state == 'running'
+    assert slots.locked()
+    assert job.cancel()
+    assert job.state == 'cancelled'
+    assert not slots.locked()
+    with pytest.raises(JobCancelled):
+        job.check()
+    job.finish('done')
+    assert job.state == 'cancelled'
+    assert not job.cancel()
+
+def test_job_deadline():
+    job = Job('a', 'sample', Deadline(0))
+    with pytest.raises(DeadlineExceededError):
+        job.check()
+    slots = gevent.lock.BoundedSemaphore(1)
+    slots.acquire()
+    with pytest.raises(DeadlineExceededError):
+        job.acquire_slot(slots)
+
+def test_registry_reaps_finished_jobs():
+    registry = JobRegistry(ttl=0.1, max_finished=2)
+    registry.open_session('s')
+    jobs = [Job(str(i), 'sample') for i in range(3)]
+    for job in jobs:
+        registry.add('s', job)
+    assert registry.get('s', '0') is jobs[0]
+    for job in jobs:
+        job.finish('done')
+        registry.release('s', job)
+    assert registry.get('s', '0') is None
+    # only the latest finished jobs are kept
+    assert not registry.contains('s', '0')
+    assert registry.contains('s', '1') and registry.contains('s', '2')
+    assert registry.to_dict() == dict(
+        sessions=1, active=0, retained=2, submitted=3,
+        states=dict(queued=0, running=0, done=2, failed=0, cancelled=0)
+    )
+    time.sleep(0.15)
+    assert not registry.contains('s', '2')
+    assert registry.to_dict()['retained'] == 0
+
+def test_registry_close_session_cancels_jobs():
+    registry = JobRegistry()
+    registry.open_session('s')
+    running = Job('a', 'sample')
+    running.acquire_slot(None)
+    finished = Job('b', 'sample')
+    registry.add('s', running)
+    registry.add('s', finished)
+    finished.finish('failed')
+    registry.release('s', finished)
+    assert registry.to_dict()['states']['running'] == 1
+    registry.close_session('s')
+    assert running.state == 'cancelled'
+    assert not registry.contains('s', 'b')
+    # the cancelled job's greenlet exits after its session was closed
+    registry.release('s', running)
+    assert registry.to_dict() == dict(
+        sessions=0, active=0, retained=0, submitted=2,
+        states=dict(queued=0, running=0, done=0, failed=0, cancelled=0)
+    )
+
+def make_input(name, data_type):
+    data_type.name = name
+    return data_type
+
+def test_registry_session_inputs():
+    inputs = [make_input('image', image()), make_input('mask', image())]
+    registry = JobRegistry(max_input_bytes=100)
+    registry.open_session('s')
+    registry.put_input('s', 'a', image(), 'first', 60)
+    registry.put_input('s', 'b', image(), 'second', 30)
+    assert registry.get_inputs('s', {'image': 'b', 'mask': 'a'}, inputs) == {'image': 'second', 'mask': 'first'}
+    # the least recently used input is evicted once over budget
+    registry.put_input('s', 'c', image(), 'third', 40)
+    with pytest.raises(UnknownInputHandleError):
+        registry.get_inputs('s', {'image': 'b'}, inputs)
+    assert registry.get_inputs('s', {'image': 'a'}, inputs) == {'image': 'first'}
+    with pytest.raises(RequestTooLargeError):
+        registry.put_input('s', 'd', image(), 'huge', 101)
+    registry.close_session('s')
+    with pytest.raises(UnknownInputHandleError):
+        registry.get_inputs('s', {'image': 'a'}, inputs)
+
+def test_registry_session_inputs_check_data_types():
+    registry = JobRegistry()
+    registry.open_session('s')
+    registry.put_input('s', 'a', image(description='A photo'), 'photo', 10)
+    # names and descriptions don't matter, the data type and its settings do
+    assert registry.get_inputs('s', {'source': 'a'}, [make_input('source', image())]) == {'source': 'photo'}
+    with pytest.raises(InvalidArgumentError):
+        registry.get_inputs('s', {'z': 'a'}, [make_input('z', vector(length=2))])
+    with pytest.raises(InvalidArgumentError):
+        registry.get_inputs('s', {'source': 'a'}, [make_input('source', image(channels=4))])
+    with pytest.raises(InvalidArgumentError):
+        registry.get_inputs('s', {'other': 'a'}, [make_input('source', image())])
+
+def test_output_stream_interval():
+    sent = []
+    outputs = OutputStream(lambda output, final: sent.append((output, final)), interval=0.05)
+    for i in range(5):
+        outputs.put(i)
+    time.sleep(0.06)
+    outputs.put(5)
+    outputs.put(6)
+    # the last skipped output is sent when the generator returns nothing
+    outputs.close()
+    assert sent == [(0, False), (5, False), (6, True)]
+
+    sent = []
+    outputs = OutputStream(lambda output, final: sent.append((output, final)), interval=0.05)
+    outputs.put(0)
+    outputs.put(1)
+    outputs.close('result')
+    assert sent == [(0, False), ('result', True)]
+
+def test_output_stream_latest_only():
+    sent = []
+
+    def send(output, final):
+        # a slow client
+        gevent.sleep(0.05)
+        sent.append((output, final))
+
+    outputs = OutputStream(send, latest_only=True)
+    for i in range(10):
+        gevent.sleep(0.01)
+        outputs.put(i)
+    outputs.close()
+    assert sent[0] == (0, False)
+    assert sent[-1] == (9, True)
+    assert 2 < len(sent) < 6
+
+def test_output_stream_previews():
+    sent = []
+    outputs = OutputStream(lambda output, final: sent.append((output, final)), previews=True)
+    outputs.put(0)
+    outputs.put(1)
+    # the last preview is sent again in full when the generator returns nothing
+    outputs.close()
+    assert sent == [(0, False), (1, False), (1, True)]
+
+    sent = []
+    outputs = OutputStream(lambda output, final: sent.append((output, final)), previews=True)
+    outputs.put(0)
+    outputs.close('result')
+    assert sent == [(0, False), ('result', True)]
+
+def test_output_stream_sender_errors():
+    def send(output, final):
+        raise JobCancelled()
+
+    outputs = OutputStream(send, latest_only=True)
+    outputs.put(0)
+    gevent.sleep(0)
+    with pytest.raises(JobCancelled):
+        outputs.put(1)
@@ -0,0 +1,164 @@
+# Ensure that the local version of the runway module is used, not a pip
+# installed version
+import sys
+sys.path.insert(0, '..')
+sys.path.insert(0, '.')
+
+import os
+import json
+import tempfile
+import subprocess
+import pytest
+from runway.model import RunwayModel
+from runway.data_types import category, vector, image, number, text
+from runway.meta import extract_manifest, extract_manifest_statically, StaticExtractionError
+from utils import *
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODEL_SOURCE = '''
+import runway
+import torch
+from runway.data_types import category, vector as vec
+from your_code import model
+
+sample_inputs = {
+    "z": vec(length=512, description="The seed used to generate an output image."),
+    "category": category(choices=["day", "night"])
+}
+network = model(checkpoint="weights.pt")
+
+@runway.setup(options={"size": runway.number(default=3, min=1, max=10)})
+def setup(opts):
+    return network
+
+@runway.command("sample", inputs=sample_inputs, outputs={"image": runway.image(width=1024, height=1024)},
+                description="Generate an image.")
+def sample(model, inputs):
+    return {"image": model.sample(inputs["z"])}
+
+@runway.command("caption", inputs={"image": runway.image}, outputs={"caption": runway.text})
+def caption(model, inputs):
+    return model.caption(inputs["image"])
+
+if __name__ == "__main__":
+    runway.run()
+'''
+
+def write_model(source):
+    model_dir = tempfile.mkdtemp()
+    path = os.path.join(model_dir, 'runway_model.py')
+    with open(path, 'w') as f:
+        f.write(source)
+    return path
+
+def get_expected_manifest():
+    rw = RunwayModel()
+
+    @rw.setup(options={'size': number(default=3, min=1, max=10)})
+    def setup(opts):
+        pass
+
+    sample_inputs = {
+        'z': vector(length=512, description='The seed used to generate an output image.'),
+        'category': category(choices=['day', 'night'])
+    }
+    @rw.command('sample', inputs=sample_inputs, outputs={'image': image(width=1024, height=1024)},
+                description='Generate an image.')
+    def sample(model, inputs):
+        pass
+
+    @rw.command('caption', inputs={'image': image}, outputs={'caption': text})
+    def caption(model, inputs):
+        pass
+
+    return rw.get_manifest()
+
+def test_extract_manifest_statically():
+    assert extract_manifest_statically(MODEL_SOURCE) == get_expected_manifest()
+
+def test_extract_manifest_statically_fails_on_computed_declarations():
+    source = MODEL_SOURCE.replace('["day", "night"]', 'load_categories()')
+    with pytest.raises(StaticExtractionError):
+        extract_manifest_statically(source)
+    with pytest.raises(StaticExtractionError):
+        extract_manifest_statically('import runway\n')
+
+def test_extract_manifest_statically_fails_on_unresolved_declarations():
+    nested = MODEL_SOURCE.replace(
+        '@runway.command("caption"',
+        'def register():\n    @runway.command("caption", inputs={}, outputs={})\n    def hidden(model, inputs):\n'
+        '        pass\n\n@runway.command("caption"'
+    )
+    conditional = MODEL_SOURCE + '\nif torch.cuda.is_available():\n    @runway.command("fast", inputs={}, outputs={})\n' \
+        '    def fast(model, inputs):\n        pass\n'
+    called = MODEL_SOURCE + '\nrunway.command("echo", inputs={}, outputs={})(lambda model, inputs: inputs)\n'
+    instance = MODEL_SOURCE.replace('import runway\n', 'import runway\nfrom runway import RunwayModel\nrw = RunwayModel()\n')
+    for source in [nested, conditional, called, instance]:
+        with pytest.raises(StaticExtractionError, match='unable to resolve'):
+            extract_manifest_statically(source)
+
+def test_extract_manifest_statically_fails_on_declarations_in_imported_modules():
+    path = write_model(MODEL_SOURCE.replace('import torch\n', 'import torch\nimport extra_commands\n'))
+    model_dir = os.path.dirname(path)
+    assert extract_manifest_statically(MODEL_SOURCE, path, model_dir) == get_expected_manifest()
+    with open(os.path.join(model_dir, 'extra_commands.py'), 'w') as f:
+        f.write('import runway\n\n@runway.command("extra", inputs={}, outputs={})\ndef extra(model, inputs):\n    pass\n')
+    with open(path) as f:
+        source = f.read()
+    with pytest.raises(StaticExtractionError, match='extra_commands'):
+        extract_manifest_statically(source, path, model_dir)
+
+def test_meta_module_reports_failing_models():
+    path = write_model('import runway\n\ndef load():\n    raise Exception("no model")\n\n'
+                       '@runway.command("echo", inputs={"text": runway.category(choices=load())}, outputs={})\n'
+                       'def echo(model, inputs):\n    pass\n')
+    process = subprocess.run(
+        [sys.executable, '-m', 'runway.meta', path],
+        cwd=ROOT_DIR, env=dict(os.environ, PYTHONPATH=ROOT_DIR), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert process.returncode == 1
+    assert 'Exception: no model' in process.stderr.decode('utf8')
+    assert process.stderr.decode('utf8').strip().splitlines()[-1] == \
+        'Unable to extract manifest: running the model failed with exit status 1'
+
+def test_extract_manifest_falls_back_to_running_model(monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', ROOT_DIR)
+    path = write_model('''
+import runway
+from runway.data_types import category, text
+
+def load_categories():
+    return ["day", "night"]
+
+@runway.command("echo", inputs={"category": category(choices=load_categories())}, outputs={"text": text})
+def echo(model, inputs):
+    return inputs["category"]
+
+runway.run()
+''')
+    with pytest.raises(StaticExtractionError):
+        extract_manifest(path, fallback=False)
+    manifest = extract_manifest(path)
+    assert manifest['commands'][0]['inputs'][0]['oneOf'] == ['day', 'night']
+
+def test_meta_module_writes_manifest_served_by_meta_route():
+    path = write_model(MODEL_SOURCE)
+    manifest_path = os.path.join(os.path.dirname(path), 'manifest.json')
+    subprocess.check_call(
+        [sys.executable, '-m', 'runway.meta', path, '--output', manifest_path, '--no-fallback'],
+        cwd=ROOT_DIR
+    )
+    with open(manifest_path) as f:
+        assert json.load(f) == get_expected_manifest()
+
+    rw = RunwayModel()
+
+    @rw.setup
+    def setup():
+        pass
+
+    rw.run(manifest_path=manifest_path, no_serve=True)
+    manifest = get_manifest(get_test_client(rw))
+    assert manifest['options'] == get_expected_manifest()['options']
+    assert manifest['commands'] == get_expected_manifest()['commands']
@@ -10,17 +10,24 @@ import json
 import pytest
 import time
 import gzip
+import base64
+import tempfile
+import weakref
+import threading
+import numpy as np
+import gevent
 from time import sleep
 from runway.model import RunwayModel
 from runway.__version__ import __version__ as model_sdk_version
-from runway.data_types import category, text, number, array, image, vector, file, any as any_type
+from runway.data_types import category, text, number, boolean, array, image, vector, file, any as any_type
 from runway.exceptions import *
-from runway.utils import gzip_decompress, gzip_compress
+from runway.utils import gzip_decompress, gzip_compress, timestamp_millis
 from utils import *
 from deepdiff import DeepDiff
 from flask import abort
 from multiprocessing import Process
 from io import BytesIO as IO
+from PIL import Image
 
 from pytest_cov.embed import cleanup_on_sigterm
 cleanup_on_sigterm()
@@ -151,6 +158,169 @@ def test_model_healthcheck():
     assert response.is_json
     assert response.json == { 'status': 'RUNNING' }
 
+def test_model_setup_prefetches_file_options():
+
+    closure = dict(healthcheck=None)
+
+    root = tempfile.mkdtemp()
+    for name in ['weights.bin', 'vocab.txt']:
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(name.encode('utf8') * 100)
+
+    rw = RunwayModel()
+    client = get_test_client(rw)
+
+    @rw.setup(options={'weights': file, 'vocab': file, 'size': number(default=5)})
+    def setup(opts):
+        closure['healthcheck'] = client.get('/healthcheck').json
+        with open(opts['weights'], 'rb') as f:
+            assert f.read() == b'weights.bin' * 100
+        with open(opts['vocab'], 'rb') as f:
+            assert f.read() == b'vocab.txt' * 100
+        assert opts['size'] == 5
+
+    with serve_directory(root) as url:
+        rw.run(model_options={
+            'weights': url + '/weights.bin',
+            'vocab': url + '/vocab.txt'
+        })
+
+    assert closure['healthcheck'] == {
+        'status': 'STARTING',
+        'progress': {
+            'weights': {'status': 'done', 'bytesDownloaded': 1100, 'totalBytes': 1100},
+            'vocab': {'status': 'done', 'bytesDownloaded': 900, 'totalBytes': 900}
+        }
+    }
+    assert client.get('/healthcheck').json == {'status': 'RUNNING'}
+
+def test_model_default_file_options_are_deserialized():
+
+    closure = dict(opts=None, inputs=None)
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'weights': file(mmap=True, default='README.md'), 'vocab': file(lazy=True, default='LICENSE')})
+    def setup(opts):
+        closure['opts'] = opts
+
+    @rw.command('read', inputs={'weights': file(mmap=True, default='README.md')}, outputs={'size': number})
+    def read(model, inputs):
+        closure['inputs'] = inputs
+        return len(inputs['weights'])
+
+    rw.run()
+    with open('README.md', 'rb') as f:
+        readme = f.read()
+    assert isinstance(closure['opts']['weights'], np.memmap)
+    assert closure['opts']['weights'].tobytes() == readme
+    assert closure['opts']['vocab'] == 'LICENSE'
+
+    assert get_test_client(rw).post('/read', json={}).json == {'size': len(readme)}
+    assert isinstance(closure['inputs']['weights'], np.memmap)
+
+@timeout(10)
+def test_model_setup_reports_download_progress_while_downloading():
+
+    download_released = threading.Event()
+    data = b'weights' * 1000
+
+    rw = RunwayModel()
+    client = get_test_client(rw)
+
+    @rw.setup(options={'weights': file})
+    def setup(opts):
+        with open(opts['weights'], 'rb') as f:
+            return f.read()
+
+    with serve_slowly(data, 1024, download_released) as url:
+        greenlet = gevent.spawn(rw.initialize_model_in_background, {'weights': url + '/weights.bin'})
+        while True:
+            gevent.sleep(0.01)
+            health = client.get('/healthcheck').json
+            progress = health.get('progress', {}).get('weights')
+            if progress is not None and progress['bytesDownloaded'] > 0:
+                break
+        assert health['status'] == 'STARTING'
+        assert progress['status'] == 'downloading'
+        assert 0 < progress['bytesDownloaded'] < len(data)
+        assert progress['totalBytes'] == len(data)
+        assert not greenlet.ready()
+
+        download_released.set()
+        greenlet.join()
+
+    assert client.get('/healthcheck').json == {'status': 'RUNNING'}
+    assert rw.model == data
+
+def test_model_background_setup():
+
+    setup_released = threading.Event()
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'fail': boolean(default=False)})
+    def setup(opts):
+        setup_released.wait()
+        if opts['fail']:
+            raise Exception('setup failed')
+        return 'model'
+
+    @rw.command('echo', inputs={'input': text}, outputs={'output': text})
+    def echo(model, inputs):
+        return inputs['input']
+
+    client = get_test_client(rw)
+
+    greenlet = gevent.spawn(rw.initialize_model_in_background, {})
+    gevent.sleep(0)
+    assert client.get('/healthcheck').json == {'status': 'STARTING'}
+    response = client.post('/echo', json={'input': 'hello'})
+    assert response.status_code == 503
+    assert response.json['error'] == 'Model is not ready: STARTING.'
+
+    rw.setup_timeout = 5
+    gevent.spawn_later(0.1, setup_released.set)
+    assert client.post('/echo', json={'input': 'hello'}).json == {'output': 'hello'}
+    greenlet.join()
+    assert client.get('/healthcheck').json == {'status': 'RUNNING'}
+
+    rw = RunwayModel()
+    rw.setup(options={'fail': boolean(default=False)})(setup)
+    rw.command('echo', inputs={'input': text}, outputs={'output': text})(echo)
+    client = get_test_client(rw)
+    rw.initialize_model_in_background({'fail': True})
+    assert client.get('/healthcheck').json == {'status': 'FAILED'}
+    assert client.post('/echo', json={'input': 'hello'}).status_code == 503
+
+def test_model_warmup_runs_before_running():
+
+    closure = dict(inputs=[], status=[])
+
+    rw = RunwayModel()
+
+    @rw.setup
+    def setup():
+        return 'model'
+
+    inputs = {'z': vector(length=8), 'style': category(choices=['day', 'night'])}
+    @rw.command('sample', inputs=inputs, outputs={'z': vector(length=8)}, warmup=2)
+    def sample(model, inputs):
+        closure['inputs'].append(inputs)
+        closure['status'].append(rw.running_status)
+        return inputs['z']
+
+    @rw.command('broken', inputs={'input': number}, outputs={'output': number}, warmup=1)
+    def broken(model, inputs):
+        raise Exception('warmup failed')
+
+    rw.run()
+    assert rw.running_status == 'RUNNING'
+    assert closure['status'] == ['STARTING', 'STARTING']
+    assert [inputs['style'] for inputs in closure['inputs']] == ['day', 'day']
+    assert all(inputs['z'].shape == (8,) for inputs in closure['inputs'])
+    assert 'warmup' not in get_manifest(get_test_client(rw))['commands'][0]
+
 def test_model_setup_no_arguments():
 
     # use a dict to share state across function scopes. This makes up for the
@@ -216,6 +386,318 @@ def test_model_options_missing():
         with pytest.raises(MissingOptionError):
             rw.run(debug=True)
 
+def test_setup_route_swaps_model():
+
+    class Model(object):
+        def __init__(self, size):
+            self.size = size
+
+    closure = dict(models=[], started=threading.Event(), released=threading.Event())
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'size': number(default=1)})
+    def setup(opts):
+        if opts['size'] < 0:
+            raise Exception('negative size')
+        model = Model(opts['size'])
+        closure['models'].append(weakref.ref(model))
+        return model
+
+    @rw.command('size', inputs={'reload': number}, outputs={'size': number})
+    def size(model, inputs):
+        if inputs['reload']:
+            closure['started'].set()
+            closure['released'].wait()
+            # the command keeps using the model it started with
+            assert rw.model is not model
+        return model.size
+
+    rw.run()
+    client = get_test_client(rw)
+
+    assert client.post('/size', json={'reload': 0}).json == {'size': 1}
+    pending = gevent.spawn(client.post, '/size', json={'reload': 1})
+    while not closure['started'].is_set():
+        gevent.sleep(0.01)
+    assert client.post('/setup', json={'size': 2}).json == {'success': True}
+    closure['released'].set()
+    assert pending.get().json == {'size': 1}
+    assert client.post('/size', json={'reload': 0}).json == {'size': 2}
+    # the first model is released once the command using it finishes
+    assert closure['models'][0]() is None
+
+    response = client.post('/setup', json={'size': 3})
+    assert response.json == {'success': True}
+    assert closure['models'][1]() is None
+    assert client.post('/size', json={'reload': 0}).json == {'size': 3}
+
+    # a failed setup leaves the previous model in place
+    response = client.post('/setup', json={'size': -1})
+    assert response.status_code == 500
+    assert 'SetupError' in str(response.data)
+    assert client.get('/healthcheck').json == {'status': 'RUNNING'}
+    assert client.post('/size', json={'reload': 0}).json == {'size': 3}
+
+def test_model_cache_reuses_models_set_up_with_same_options():
+
+    closure = dict(setup_count=0)
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'network_size': category(choices=[256, 512]), 'seed': number})
+    def setup(opts):
+        closure['setup_count'] += 1
+        return opts['network_size']
+
+    @rw.command('size', inputs={'input': number}, outputs={'size': number})
+    def size(model, inputs):
+        return model
+
+    rw.run(model_cache_size=2)
+    client = get_test_client(rw)
+
+    client.post('/setup', json={'network_size': 512})
+    assert client.post('/size', json={'input': 0}).json == {'size': 512}
+    # options equal to their defaults are the same variant as missing options
+    client.post('/setup', json={'network_size': 256, 'seed': 0})
+    assert client.post('/size', json={'input': 0}).json == {'size': 256}
+    assert closure['setup_count'] == 2
+
+    # a third variant evicts the least recently used one
+    client.post('/setup', json={'network_size': 256, 'seed': 1})
+    client.post('/setup', json={'network_size': 256})
+    assert closure['setup_count'] == 3
+    client.post('/setup', json={'network_size': 512})
+    assert closure['setup_count'] == 4
+
+def test_model_cache_keeps_current_model_when_variant_evicts_it():
+
+    closure = dict(setup_count=0)
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'network_size': category(choices=[256, 512])})
+    def setup(opts):
+        closure['setup_count'] += 1
+        return opts['network_size']
+
+    @rw.command('size', inputs={'input': number}, outputs={'size': number})
+    def size(model, inputs):
+        return model
+
+    rw.run()
+    client = get_test_client(rw)
+    assert closure['setup_count'] == 1
+
+    # with a cache of one model, the variant evicts the current model's entry
+    response = client.post('/size', json={'input': 0}, headers={'X-Runway-Model-Options': '{"network_size": 512}'})
+    assert response.json == {'size': 512}
+    assert closure['setup_count'] == 2
+
+    # setting up the current options again reuses the model still loaded
+    assert client.post('/setup', json={'network_size': 256}).json == {'success': True}
+    assert client.post('/size', json={'input': 0}).json == {'size': 256}
+    assert closure['setup_count'] == 2
+
+def test_model_cache_memory_budget():
+
+    closure = dict(setup_count=0)
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'seed': number})
+    def setup(opts):
+        closure['setup_count'] += 1
+        return {'weights': np.zeros(1000, dtype=np.uint8)}
+
+    rw.run(model_cache_size=10, model_cache_memory=1500)
+    client = get_test_client(rw)
+
+    client.post('/setup', json={'seed': 1})
+    client.post('/setup', json={'seed': 0})
+    assert closure['setup_count'] == 3
+    assert len(rw.model_cache) == 1
+
+def test_model_options_header_picks_model_variant():
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'network_size': category(choices=[256, 512])})
+    def setup(opts):
+        return opts['network_size']
+
+    @rw.command('size', inputs={'input': number}, outputs={'size': number})
+    def size(model, inputs):
+        return model
+
+    rw.run(model_cache_size=2)
+    client = get_test_client(rw)
+
+    headers = {'X-Runway-Model-Options': json.dumps({'network_size': 512})}
+    assert client.post('/size', json={'input': 0}, headers=headers).json == {'size': 512}
+    assert client.post('/size', json={'input': 0}).json == {'size': 256}
+    assert rw.model == 256
+
+    headers = {'X-Runway-Model-Options': json.dumps({'network_size': 128})}
+    response = client.post('/size', json={'input': 0}, headers=headers)
+    assert response.status_code == 400
+
+    headers = {'X-Runway-Model-Options': '[512]'}
+    response = client.post('/size', json={'input': 0}, headers=headers)
+    assert response.status_code == 400
+
+def test_unloaded_model_is_set_up_again_by_next_command():
+
+    closure = dict(setup_count=0)
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'size': number(default=3)})
+    def setup(opts):
+        closure['setup_count'] += 1
+        return {'size': opts['size']}
+
+    @rw.command('size', inputs={'input': number}, outputs={'size': number})
+    def size(model, inputs):
+        return model['size']
+
+    rw.run()
+    client = get_test_client(rw)
+
+    rw.unload_model()
+    assert rw.model is None
+    assert client.get('/healthcheck').json == {'status': 'RUNNING', 'idle': True}
+    assert client.post('/size', json={'input': 0}).json == {'size': 3}
+    assert closure['setup_count'] == 2
+    assert client.get('/healthcheck').json == {'status': 'RUNNING'}
+
+    rw.unload_model(snapshot=True)
+    assert os.path.exists(rw.model_snapshot_path)
+    snapshot_path = rw.model_snapshot_path
+    assert client.post('/size', json={'input': 0}).json == {'size': 3}
+    assert closure['setup_count'] == 2
+    assert not os.path.exists(snapshot_path)
+
+def test_model_restored_from_snapshot_dir():
+
+    closure = dict(setup_count=0)
+    snapshot_dir = tempfile.mkdtemp()
+
+    def make_model():
+        rw = RunwayModel()
+
+        @rw.setup(options={'size': number(default=3)})
+        def setup(opts):
+            closure['setup_count'] += 1
+            return {'size': opts['size'], 'weights': np.arange(2 ** 20, dtype=np.float32)}
+
+        @rw.command('size', inputs={'input': number}, outputs={'size': number})
+        def size(model, inputs):
+            return model['size'] + float(model['weights'][1])
+
+        return rw
+
+    rw = make_model()
+    rw.run(snapshot_dir=snapshot_dir)
+    assert closure['setup_count'] == 1
+    assert rw.restored_snapshot is None
+    assert len(os.listdir(snapshot_dir)) == 1
+
+    rw = make_model()
+    rw.run(snapshot_dir=snapshot_dir)
+    assert closure['setup_count'] == 1
+    assert rw.restored_snapshot['setupDuration'] >= 0
+    assert isinstance(rw.model['weights'], np.memmap)
+    assert get_test_client(rw).post('/size', json={'input': 0}).json == {'size': 4}
+
+    rw = make_model()
+    rw.run(snapshot_dir=snapshot_dir, model_options={'size': 5})
+    assert closure['setup_count'] == 2
+    assert len(os.listdir(snapshot_dir)) == 2
+
+def test_model_snapshot_dir_tracks_file_versions():
+
+    closure = dict(setup_count=0)
+    snapshot_dir = tempfile.mkdtemp()
+    root = tempfile.mkdtemp()
+    local_path = os.path.join(root, 'local.bin')
+    remote_path = os.path.join(root, 'remote.bin')
+    for path in [local_path, remote_path]:
+        with open(path, 'wb') as f:
+            f.write(b'v1')
+
+    def run_model(url):
+        rw = RunwayModel()
+
+        @rw.setup(options={'local': file, 'remote': file})
+        def setup(opts):
+            closure['setup_count'] += 1
+            with open(opts['local'], 'rb') as f:
+                local = f.read()
+            with open(opts['remote'], 'rb') as f:
+                return local + f.read()
+
+        rw.run(snapshot_dir=snapshot_dir, model_options={'local': local_path, 'remote': url + '/remote.bin'})
+        return rw
+
+    with serve_directory(root) as url:
+        assert run_model(url).model == b'v1v1'
+        assert run_model(url).model == b'v1v1'
+        assert closure['setup_count'] == 1
+
+        with open(local_path, 'wb') as f:
+            f.write(b'v2')
+        assert run_model(url).model == b'v2v1'
+        assert closure['setup_count'] == 2
+
+        # Last-Modified has a resolution of one second
+        with open(remote_path, 'wb') as f:
+            f.write(b'v2')
+        os.utime(remote_path, (time.time() + 10, time.time() + 10))
+        assert run_model(url).model == b'v2v2'
+        assert closure['setup_count'] == 3
+
+def test_snapshot_code_hash_includes_helper_modules():
+    from runway.utils import get_code_hash
+
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'snapshot_model.py'), 'w') as f:
+        f.write('import snapshot_helper\n\ndef setup(opts):\n    return snapshot_helper.build()\n')
+    with open(os.path.join(root, 'snapshot_helper.py'), 'w') as f:
+        f.write('def build():\n    return 1\n')
+
+    sys.path.insert(0, root)
+    try:
+        import snapshot_model
+        code_hash = get_code_hash(snapshot_model.setup)
+        assert get_code_hash(snapshot_model.setup) == code_hash
+        with open(os.path.join(root, 'snapshot_helper.py'), 'w') as f:
+            f.write('def build():\n    return 2\n')
+        assert get_code_hash(snapshot_model.setup) != code_hash
+    finally:
+        sys.path.remove(root)
+        sys.modules.pop('snapshot_model', None)
+        sys.modules.pop('snapshot_helper', None)
+
+def test_model_unloaded_when_idle():
+
+    rw = RunwayModel()
+
+    @rw.setup
+    def setup():
+        return 'model'
+
+    rw.run()
+    rw.millis_last_command = timestamp_millis()
+    monitor = gevent.spawn(rw.unload_when_idle, 0.05)
+    try:
+        gevent.sleep(0.2)
+        assert rw.model_unloaded
+        assert rw.model is None
+    finally:
+        monitor.kill()
+
 def test_setup_invalid_category():
 
     rw = RunwayModel()
@@ -513,7 +995,7 @@ def test_post_command_json_mime_type_with_gzip():
 def test_post_command_json_mime_type_with_gzip_response():
 
     rw = RunwayModel()
-    rw.app.config['COMPRESS_MIN_SIZE'] = 0
+    rw.compression.min_size = 0
 
     @rw.command('times_two', inputs={ 'input': number }, outputs={ 'output': number })
     def times_two(model, args):
@@ -985,6 +1467,271 @@ def test_inference_async_cancel():
         if ws: ws.close()
         if proc: proc.terminate()
 
+@timeout(5)
+def test_inference_async_cancel_generator():
+    rw = RunwayModel()
+    marker_path = os.path.join(tempfile.mkdtemp(), 'closed')
+
+    @rw.command('count', inputs={ 'input': number }, outputs={ 'output': number }, concurrency=1)
+    def count(model, inputs):
+        try:
+            for i in range(int(inputs['input'])):
+                time.sleep(0.1)
+                yield i
+        finally:
+            with open(marker_path, 'w') as f:
+                f.write('closed')
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run)
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw)
+
+        ws.send(create_ws_message('submit', dict(command='count', id='a', inputData={'input': 100})))
+        assert json.loads(ws.recv())['type'] == 'started'
+        assert json.loads(ws.recv())['outputData'] == {'output': 0}
+
+        ws.send(create_ws_message('cancel', dict(id='a')))
+        response = json.loads(ws.recv())
+        while response['type'] == 'output':
+            response = json.loads(ws.recv())
+        assert response == {'type': 'cancelled', 'id': 'a'}
+
+        # the cancelled job's slot is free for the next job right away
+        ws.send(create_ws_message('submit', dict(command='count', id='b', inputData={'input': 1})))
+        messages = [json.loads(ws.recv()) for _ in range(3)]
+        assert [(m['type'], m['id']) for m in messages] == [('started', 'b'), ('output', 'b'), ('succeeded', 'b')]
+
+        # the generator was closed at its next yield
+        with open(marker_path) as f:
+            assert f.read() == 'closed'
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
+
+@timeout(5)
+def test_inference_async_cancel_while_model_starts():
+    rw = RunwayModel()
+
+    @rw.setup
+    def setup():
+        time.sleep(2)
+        return 'model'
+
+    @rw.command('test_command', inputs={ 'input': number }, outputs={ 'output': number })
+    def test_command(model, inputs):
+        return inputs['input']
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run, kwargs=dict(background_setup=True, setup_timeout=5))
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw)
+
+        start = time.time()
+        ws.send(create_ws_message('submit', dict(command='test_command', inputData={'input': 1}, id='first')))
+        ws.send(create_ws_message('cancel', dict(id='first')))
+        ws.send(create_ws_message('submit', dict(command='test_command', inputData={'input': 2}, id='second')))
+        messages = [json.loads(ws.recv()) for _ in range(3)]
+        assert [(m['type'], m['id']) for m in messages] == [
+            ('started', 'first'), ('cancelled', 'first'), ('started', 'second')
+        ]
+        # the session's messages are handled while the model is set up
+        assert time.time() - start < 1
+        messages = [json.loads(ws.recv()) for _ in range(2)]
+        assert [m['type'] for m in messages] == ['output', 'succeeded']
+        assert messages[0]['outputData'] == {'output': 2}
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
+
+def test_inference_async_output_interval():
+    rw = RunwayModel()
+
+    @rw.command('count', inputs={ 'input': number }, outputs={ 'output': number })
+    def count(model, inputs):
+        for i in range(int(inputs['input'])):
+            time.sleep(0.01)
+            yield i
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run)
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw)
+
+        ws.send(create_ws_message('submit', dict(command='count', inputData={'input': 20}, outputInterval=5000)))
+        messages = [json.loads(ws.recv()) for _ in range(4)]
+        assert [m['type'] for m in messages] == ['started', 'output', 'output', 'succeeded']
+        assert [m['outputData'] for m in messages[1:3]] == [{'output': 0}, {'output': 19}]
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
+
+def test_inference_async_previews():
+    rw = RunwayModel()
+
+    @rw.command('render', inputs={ 'steps': number }, outputs={ 'image': image }, preview_size=32)
+    def render(model, inputs):
+        for i in range(int(inputs['steps'])):
+            yield Image.new('RGB', (256, 128), color=(i * 50, 0, 0))
+
+    def image_size(data_uri):
+        return Image.open(IO(base64.b64decode(data_uri.split(',')[1]))).size
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run)
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw)
+
+        ws.send(create_ws_message('submit', dict(command='render', inputData={'steps': 2}, previewQuality=20)))
+        messages = [json.loads(ws.recv()) for _ in range(5)]
+        assert [m['type'] for m in messages] == ['started', 'output', 'output', 'output', 'succeeded']
+        sizes = [image_size(m['outputData']['image']) for m in messages[1:4]]
+        assert sizes == [(32, 16), (32, 16), (256, 128)]
+
+        ws.send(create_ws_message('submit', dict(command='render', inputData={'steps': 1}, previewSize=0)))
+        messages = [json.loads(ws.recv()) for _ in range(3)]
+        assert [m['type'] for m in messages] == ['started', 'output', 'succeeded']
+        assert image_size(messages[1]['outputData']['image']) == (256, 128)
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
+
+def test_inference_async_binary_frames():
+    rw = RunwayModel()
+
+    outputs = {'image': image, 'caption': text, 'z': vector(length=2)}
+    @rw.command('describe', inputs={ 'input': number }, outputs=outputs)
+    def describe(model, inputs):
+        return {'image': Image.new('RGB', (64, 32)), 'caption': 'black', 'z': np.array([0.5, 2])}
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run)
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw, '?binaryFrames=1')
+
+        ws.send(create_ws_message('submit', dict(command='describe', inputData={'input': 1})))
+        assert json.loads(ws.recv())['type'] == 'started'
+        message = json.loads(ws.recv())
+        assert message['type'] == 'output'
+        assert message['outputData'] == {'caption': 'black'}
+        frames = {}
+        for field in message['binaryData']:
+            frames[field['name']] = ws.recv()
+            assert len(frames[field['name']]) == field['size']
+        assert [field['contentType'] for field in message['binaryData']] == \
+            ['image/jpeg', 'application/octet-stream; dtype=float32']
+        assert Image.open(IO(frames['image'])).size == (64, 32)
+        assert np.frombuffer(frames['z'], dtype='<f4').tolist() == [0.5, 2]
+        assert json.loads(ws.recv())['type'] == 'succeeded'
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
+
+def test_inference_async_upload():
+    rw = RunwayModel()
+
+    @rw.command('scale', inputs={ 'z': vector(length=4096), 'amount': number }, outputs={ 'output': number })
+    def scale(model, inputs):
+        # modifies the uploaded input in place
+        inputs['z'] *= inputs['amount']
+        return inputs['z'][0]
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run)
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw)
+
+        z = [2.0] * 4096
+        ws.send(create_ws_message('upload', dict(id='u1', command='scale', input='z', data=z)))
+        response = json.loads(ws.recv())
+        assert response['type'] == 'uploaded'
+        assert response['id'] == 'u1'
+        assert response['size'] >= 4096 * 8
+        handle = response['handle']
+
+        # each job gets its own copy of the uploaded input
+        for amount in [2, 3]:
+            ws.send(create_ws_message('submit', dict(
+                command='scale', inputData={'amount': amount}, inputHandles={'z': handle}
+            )))
+            messages = [json.loads(ws.recv()) for _ in range(3)]
+            assert messages[1]['outputData'] == {'output': 2.0 * amount}
+
+        ws.send(create_ws_message('submit', dict(
+            command='scale', inputData={'amount': 1}, inputHandles={'z': 'missing'}
+        )))
+        response = json.loads(ws.recv())
+        assert response['type'] == 'failed'
+        assert response['error'] == 'Unknown input handle: missing.'
+
+        ws.send(create_ws_message('submit', dict(
+            command='scale', inputData={'z': z}, inputHandles={'amount': handle}
+        )))
+        response = json.loads(ws.recv())
+        assert response['type'] == 'failed'
+        assert 'uploaded for a different data type' in response['error']
+
+        ws.send(create_ws_message('upload', dict(id='u2', command='scale', input='nothing', data=z)))
+        response = json.loads(ws.recv())
+        assert response['type'] == 'failed'
+        assert response['id'] == 'u2'
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
+
+def test_estimate_size_of_images():
+    from runway.utils import estimate_size
+    assert estimate_size(Image.new('RGB', (64, 64))) == 64 * 64 * 3
+    assert estimate_size([Image.new('L', (10, 10)), np.zeros(10)]) >= 180
+
 def test_gpu_in_manifest_no_env_set():
 
     rw = RunwayModel()
@@ -1016,3 +1763,378 @@ def test_gpu_in_manifest_gpu_env_false():
 
     os.environ['GPU'] = '0'
     assert get_manifest(client)['GPU'] == False
+
+def test_manifest_and_usage_responses_support_etags():
+
+    rw = RunwayModel()
+
+    @rw.command('echo', inputs={'input': text}, outputs={'output': text})
+    def echo(model, inputs):
+        return inputs['input']
+
+    rw.run()
+    client = get_test_client(rw)
+
+    response = client.get('/meta')
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    assert response.json['commands'][0]['name'] == 'echo'
+    assert type(response.json['millisRunning']) == int
+
+    response = client.get('/meta', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip_decompress(response.data))['commands'][0]['name'] == 'echo'
+
+    response = client.get('/meta', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    response = client.get('/echo')
+    assert response.json['name'] == 'echo'
+    assert client.get('/echo', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    @rw.command('upper', inputs={'input': text}, outputs={'output': text})
+    def upper(model, inputs):
+        return inputs['input'].upper()
+
+    response = client.get('/meta', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(response.json['commands']) == 2
+
+def test_compiled_plans_match_generic_serialization():
+    from runway.utils import deserialize_data, serialize_data, compile_deserializer, compile_serializer
+
+    rw = RunwayModel()
+
+    @rw.command('caption', inputs={'prompt': text, 'steps': number(default=10), 'style': category(choices=['day', 'night'])},
+                outputs={'caption': text})
+    def caption(model, inputs):
+        return inputs['prompt']
+
+    command = rw.commands['caption']
+    input_data = {'prompt': 'a cat', 'style': 'night'}
+    assert command['deserialize_inputs'](input_data) == deserialize_data(input_data, command['inputs'])
+    assert command['serialize_outputs']('a cat') == serialize_data('a cat', command['outputs'])
+    assert command['serialize_outputs']({'caption': 'a cat'}) == {'caption': 'a cat'}
+
+    outputs = rw.commands['caption']['inputs']
+    output_data = {'prompt': 'a cat', 'steps': 3, 'style': 'day'}
+    assert compile_serializer(outputs)(output_data) == serialize_data(output_data, outputs)
+
+    required_field = image()
+    required_field.name = 'image'
+    with pytest.raises(Exception):
+        compile_deserializer([required_field])({})
+
+def test_command_outputs_numpy_values():
+
+    rw = RunwayModel()
+
+    @rw.command('stats', inputs={'input': vector(length=4)}, outputs={'stats': any_type})
+    def stats(model, inputs):
+        return {'stats': {'mean': inputs['input'].mean(), 'cumsum': np.cumsum(inputs['input'])}}
+
+    rw.run()
+    client = get_test_client(rw)
+    response = client.post('/stats', json={'input': [1, 2, 3, 4]})
+    assert response.json == {'stats': {'mean': 2.5, 'cumsum': [1, 3, 6, 10]}}
+
+def test_healthcheck_responds_while_command_runs():
+
+    rw = RunwayModel()
+
+    @rw.command('slow', inputs={'seconds': number}, outputs={'seconds': number})
+    def slow(model, inputs):
+        time.sleep(inputs['seconds'])
+        return inputs['seconds']
+
+    rw.run()
+    client = get_test_client(rw)
+    command = gevent.spawn(client.post, '/slow', json={'seconds': 2})
+    gevent.sleep(0.2)
+    durations = []
+    while not command.ready():
+        start = time.time()
+        response = client.get('/healthcheck')
+        durations.append(time.time() - start)
+        assert response.json == {'status': 'RUNNING'}
+        gevent.sleep(0.05)
+    assert command.get().json == {'seconds': 2}
+    assert len(durations) > 20
+    # the median is robust to the odd sample delayed by a loaded machine
+    assert np.median(durations) < 0.01
+    assert np.percentile(durations, 90) < 0.02
+
+def test_setup_on_inference_thread_shares_thread_local_state():
+
+    state = threading.local()
+    closure = dict(sizes=[])
+
+    rw = RunwayModel()
+
+    @rw.setup(options={'size': number(default=1)})
+    def setup(opts):
+        state.size = opts['size']
+        return opts['size']
+
+    @rw.command('size', inputs={'input': number}, outputs={'size': number})
+    def size(model, inputs):
+        closure['sizes'].append(getattr(state, 'size', None))
+        return model
+
+    rw.run(setup_on_inference_thread=True)
+    client = get_test_client(rw)
+    assert client.post('/size', json={'input': 0}).json == {'size': 1}
+    assert client.post('/setup', json={'size': 2}).json == {'success': True}
+    assert client.post('/size', json={'input': 0}).json == {'size': 2}
+    assert closure['sizes'] == [1, 2]
+
+    rw = RunwayModel()
+    rw.setup(options={'size': number(default=1)})(setup)
+    rw.command('size', inputs={'input': number}, outputs={'size': number})(size)
+    rw.run()
+    get_test_client(rw).post('/size', json={'input': 0})
+    assert closure['sizes'][-1] is None
+
+def test_inference_threads_must_be_positive():
+    rw = RunwayModel()
+    with pytest.raises(InvalidArgumentError):
+        rw.run(inference_threads=0)
+    with pytest.raises(InvalidArgumentError):
+        rw.run(inference_threads=2, setup_on_inference_thread=True)
+    os.environ['RW_INFERENCE_THREADS'] = '0'
+    try:
+        with pytest.raises(InvalidArgumentError):
+            rw.run()
+    finally:
+        del os.environ['RW_INFERENCE_THREADS']
+
+def test_command_concurrency_limit():
+
+    rw = RunwayModel()
+    running = []
+    max_running = []
+
+    @rw.command('limited', inputs={'input': number}, outputs={'output': number}, concurrency=2)
+    def limited(model, inputs):
+        running.append(inputs['input'])
+        max_running.append(len(running))
+        time.sleep(0.1)
+        running.remove(inputs['input'])
+        return inputs['input']
+
+    rw.run(inference_threads=4)
+    client = get_test_client(rw)
+    requests = [gevent.spawn(client.post, '/limited', json={'input': i}) for i in range(6)]
+    gevent.joinall(requests)
+    assert [request.get().json for request in requests] == [{'output': i} for i in range(6)]
+    assert max(max_running) == 2
+
+def test_metrics_report_event_loop_blocks():
+
+    rw = RunwayModel()
+
+    @rw.command('echo', inputs={'text': text}, outputs={'text': text})
+    def echo(model, inputs):
+        return inputs['text']
+
+    rw.run()
+    client = get_test_client(rw)
+    metrics = client.get('/metrics').json
+    assert metrics['eventLoop']['enabled'] == False
+    assert metrics['eventLoop']['blockedCount'] == 0
+    assert metrics['jobs']['sessions'] == 0
+    assert metrics['jobs']['states']['running'] == 0
+
+    rw.loop_monitor.threshold = 0.05
+    rw.loop_monitor.start()
+    try:
+        def block_loop():
+            with rw.loop_monitor.label('decode_image'):
+                time.sleep(0.5)
+        gevent.spawn(block_loop).join()
+        metrics = client.get('/metrics').json['eventLoop']
+    finally:
+        rw.loop_monitor.stop()
+    assert metrics['enabled'] == True
+    assert metrics['blockedCount'] >= 1
+    report = metrics['recentBlocks'][0]
+    assert report['command'] == 'decode_image'
+    assert report['thresholdMillis'] == 50
+    assert any('block_loop' in line for line in report['stack'])
+
+def test_command_deadline_stops_generator(capfd):
+
+    rw = RunwayModel()
+    state = dict(steps=0, closed=False)
+
+    @rw.command('iterate', inputs={'steps': number}, outputs={'steps': number})
+    def iterate(model, inputs):
+        try:
+            for step in range(int(inputs['steps'])):
+                state['steps'] += 1
+                time.sleep(0.05)
+                yield step
+        finally:
+            state['closed'] = True
+
+    rw.run()
+    client = get_test_client(rw)
+    response = client.post('/iterate', json={'steps': 3}, headers={'X-Runway-Deadline-Ms': '5000'})
+    assert response.json == {'steps': 2}
+
+    state['steps'] = 0
+    start = time.time()
+    response = client.post('/iterate', json={'steps': 100}, headers={'X-Runway-Deadline-Ms': '200'})
+    assert response.status_code == 504
+    assert response.json['error'] == 'Deadline of 200ms exceeded.'
+    assert time.time() - start < 1
+    gevent.sleep(0.2)
+    assert state['closed']
+    assert state['steps'] < 10
+    # the inference pool doesn't report the expected error as a failure
+    assert 'failed with DeadlineExceededError' not in capfd.readouterr().err
+
+    response = client.post('/iterate', json={'steps': 1}, headers={'X-Runway-Deadline-Ms': 'soon'})
+    assert response.status_code == 400
+
+def test_command_deadline_drops_queued_requests():
+
+    rw = RunwayModel()
+    calls = []
+
+    @rw.command('slow', inputs={'input': number}, outputs={'output': number}, concurrency=1)
+    def slow(model, inputs):
+        calls.append(inputs['input'])
+        time.sleep(0.3)
+        return inputs['input']
+
+    rw.run(inference_threads=2)
+    client = get_test_client(rw)
+    first = gevent.spawn(client.post, '/slow', json={'input': 1})
+    gevent.sleep(0.05)
+    response = client.post('/slow', json={'input': 2}, headers={'X-Runway-Deadline-Ms': '100'})
+    assert response.status_code == 504
+    assert first.get().json == {'output': 1}
+    gevent.sleep(0.1)
+    assert calls == [1]
+
+def test_command_deadline_keeps_model_leased_until_command_returns():
+
+    closure = dict(started=threading.Event(), released=threading.Event())
+
+    class Model(object):
+        pass
+
+    rw = RunwayModel()
+
+    @rw.setup
+    def setup():
+        return Model()
+
+    @rw.command('slow', inputs={'input': number}, outputs={'output': number})
+    def slow(model, inputs):
+        closure['started'].set()
+        closure['released'].wait()
+        return inputs['input']
+
+    rw.run(inference_threads=2)
+    client = get_test_client(rw)
+    model = weakref.ref(rw.model)
+    response = client.post('/slow', json={'input': 1}, headers={'X-Runway-Deadline-Ms': '100'})
+    assert response.status_code == 504
+    assert closure['started'].is_set()
+
+    # the command still runs, so the model can't be unloaded or released
+    assert not rw.is_idle(0)
+    unloader = gevent.spawn(rw.unload_when_idle, 0.01)
+    try:
+        gevent.sleep(0.1)
+        assert not rw.model_unloaded
+        assert model() is not None
+
+        closure['released'].set()
+        while not rw.model_unloaded:
+            gevent.sleep(0.01)
+    finally:
+        closure['released'].set()
+        unloader.kill()
+    assert model() is None
+
+@timeout(5)
+def test_inference_async_deadline_drops_queued_jobs():
+    rw = RunwayModel()
+    marker = os.path.join(tempfile.mkdtemp(), 'ran')
+
+    @rw.command('slow', inputs={'input': number}, outputs={'output': number})
+    def slow(model, inputs):
+        time.sleep(0.5)
+        return inputs['input']
+
+    @rw.command('mark', inputs={'input': number}, outputs={'output': number})
+    def mark(model, inputs):
+        open(marker, 'w').close()
+        return inputs['input']
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run)
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw)
+
+        ws.send(create_ws_message('submit', dict(id='slow', command='slow', inputData={'input': 1})))
+        ws.send(create_ws_message('submit', dict(id='mark', command='mark', inputData={'input': 2}, deadline=100)))
+
+        results = {}
+        while len(results) < 2:
+            response = json.loads(ws.recv())
+            if response['type'] in ['succeeded', 'failed']:
+                results[response['id']] = response
+        assert results['slow']['type'] == 'succeeded'
+        assert results['mark']['type'] == 'failed'
+        assert results['mark']['error'] == 'Deadline of 100ms exceeded.'
+
+        # the queued job was dropped instead of running once the thread freed up
+        time.sleep(0.2)
+        assert not os.path.exists(marker)
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
+
+@timeout(5)
+def test_inference_async_deadline():
+    rw = RunwayModel()
+
+    @rw.command('test_command', inputs={ 'input': number }, outputs = { 'output': text })
+    def test_command(model, inputs):
+        yield 'hello world'
+
+    ws = None
+    proc = None
+
+    try:
+        os.environ['RW_NO_SERVE'] = '0'
+        proc = Process(target=rw.run)
+        proc.start()
+
+        time.sleep(0.5)
+        ws = get_test_ws_client(rw)
+
+        ws.send(create_ws_message('submit', dict(command='test_command', inputData={'input': 5}, deadline=0)))
+
+        response = json.loads(ws.recv())
+        assert response['type'] == 'failed'
+        assert response['error'] == 'Deadline of 0ms exceeded.'
+
+    finally:
+        os.environ['RW_NO_SERVE'] = '1'
+        if ws: ws.close()
+        if proc: proc.terminate()
@@ -1,8 +1,11 @@
 from functools import wraps
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
 import errno
 import os
 import signal
 import json
+import threading
 from websocket import create_connection
 from runway import RunwayModel
 
@@ -11,9 +14,9 @@ def get_test_client(rw_model):
     rw_model.app.config['TESTING'] = True
     return rw_model.app.test_client()
 
-def get_test_ws_client(rw_model):
+def get_test_ws_client(rw_model, query=''):
     assert isinstance(rw_model, RunwayModel)
-    return create_connection('ws://localhost:9000/')
+    return create_connection('ws://localhost:9000/' + query)
 
 def get_manifest(client):
     response = client.get('/meta')
@@ -42,3 +45,62 @@ def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
         return wraps(func)(wrapper)
 
     return decorator
+
+class StaticFileHandler(SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        return os.path.join(self.server.root, path.split('?')[0].lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+@contextmanager
+def serve_directory(root):
+    server = HTTPServer(('localhost', 0), StaticFileHandler)
+    server.root = root
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://localhost:%d' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+class SlowFileHandler(BaseHTTPRequestHandler):
+    """Serves ``server.data`` at any path, pausing after the first
+    ``server.split`` bytes until ``server.released`` is set.
+    """
+
+    def send_data_headers(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.data)))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.send_data_headers()
+
+    def do_GET(self):
+        self.send_data_headers()
+        self.wfile.write(self.server.data[:self.server.split])
+        self.wfile.flush()
+        self.server.released.wait()
+        self.wfile.write(self.server.data[self.server.split:])
+
+    def log_message(self, *args):
+        pass
+
+@contextmanager
+def serve_slowly(data, split, released):
+    server = HTTPServer(('localhost', 0), SlowFileHandler)
+    server.data = data
+    server.split = split
+    server.released = released
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://localhost:%d' % server.server_address[1]
+    finally:
+        released.set()
+        server.shutdown()
+        server.server_close()